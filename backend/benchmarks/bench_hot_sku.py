@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Benchmark concurrent checkouts of one product: one stock row against stock slots.
+
+Usage: python benchmarks/bench_hot_sku.py <config_uri> [threads=16] [seconds=5] [hold_ms=5] [slots=8]
+
+Creates a product with plenty of stock and has `threads` buyers check it
+out in a loop for `seconds` each way:
+
+- row: the former path, a conditional UPDATE of `products.stock`
+- slots: `Inventory.take`, one of the product's `slots` stock slots
+
+Each checkout transaction then waits `hold_ms` before committing, standing
+in for the rest of create_order (order and item inserts, serialization),
+during which the stock row stays locked. Meaningful on PostgreSQL; SQLite
+locks the whole database for every write either way. The product and its
+ledger entries are deleted afterwards.
+"""
+import statistics
+import sys
+import threading
+import time
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import delete, update
+from sqlalchemy.orm import sessionmaker
+
+from ecommerce_api.database import make_engine
+from ecommerce_api.inventory import Inventory
+from ecommerce_api.models.inventory import StockMovement
+from ecommerce_api.models.product import Product
+
+
+def checkout_row(dbsession, product_id):
+    taken = dbsession.execute(
+        update(Product)
+        .where(Product.id == product_id, Product.stock >= 1)
+        .values(stock=Product.stock - 1)
+    ).rowcount
+    assert taken == 1, 'out of stock'
+
+
+def run(dbmaker, checkout, threads, seconds, hold):
+    """Return (checkouts per second, p50 ms, p99 ms)."""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def buyer():
+        mine = []
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            dbsession = dbmaker()
+            try:
+                checkout(dbsession)
+                time.sleep(hold)
+                dbsession.commit()
+            finally:
+                dbsession.close()
+            mine.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=buyer) for _ in range(threads)]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return len(latencies) / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = dict(get_appsettings(config_uri))
+    threads = int(options.get('threads', 16))
+    seconds = float(options.get('seconds', 5))
+    hold = float(options.get('hold_ms', 5)) / 1000
+    slots = int(options.get('slots', 8))
+
+    settings['sqlalchemy.pool_size'] = str(threads)
+    engine = make_engine(settings)
+    dbmaker = sessionmaker(bind=engine)
+    # The maintenance thread is not started: nothing calls ensure_running
+    inventory = Inventory(engine, dbmaker, slots=slots, reservation_ttl=None, maintenance_interval=None)
+    inventory.ensure_running = lambda: None
+
+    dbsession = dbmaker()
+    product = Product(title='Benchmark hot SKU', price=1, category='Benchmark', stock=10**9)
+    dbsession.add(product)
+    dbsession.flush()
+    product_id = product.id
+    inventory.initialize(dbsession, product_id, 10**9)
+    dbsession.commit()
+    dbsession.close()
+
+    cases = [
+        ('row', lambda session: checkout_row(session, product_id)),
+        (f'slots ({slots})', lambda session: inventory.take(session, product_id, 1, 'order')),
+    ]
+    print(f'{engine.dialect.name}: {threads} buyers, {seconds:g} s each, '
+          f'stock locked {hold * 1000:g} ms per checkout\n')
+    print(f"{'path':<12} {'checkouts/s':>12} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        for label, checkout in cases:
+            rate, p50, p99 = run(dbmaker, checkout, threads, seconds, hold)
+            print(f'{label:<12} {rate:>12.0f} {p50:>8.1f} {p99:>8.1f}')
+    finally:
+        dbsession = dbmaker()
+        dbsession.execute(delete(StockMovement).where(StockMovement.product_id == product_id))
+        inventory.forget(dbsession, product_id)
+        dbsession.execute(delete(Product).where(Product.id == product_id))
+        dbsession.commit()
+        dbsession.close()
+
+
+if __name__ == '__main__':
+    main()
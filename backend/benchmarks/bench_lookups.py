@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark the single-row lookups done by the detail and auth views.
+
+Usage: python benchmarks/bench_lookups.py <config_uri> [runs=5000]
+
+Compares the per-lookup cost of the former `query(...).filter(...).first()`
+pattern with `Session.get` (with an empty identity map, and with the row
+already loaded earlier in the request), and for email lookups with a
+lambda statement and with the prebuilt statement the views use. Against a local database most of the difference is
+Python overhead: building the query, computing its cache key and
+processing the result.
+"""
+import statistics
+import sys
+import time
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import lambda_stmt, select
+from sqlalchemy.orm import sessionmaker
+
+from ecommerce_api.database import make_engine
+from ecommerce_api.models.lookups import get_user_by_email
+from ecommerce_api.models.product import Product
+from ecommerce_api.models.user import User
+
+
+def time_lookup(dbsession, lookup, runs, clear):
+    """Return the median and p95 of `lookup()` in microseconds."""
+    timings = []
+    for _ in range(runs):
+        if clear:
+            dbsession.expunge_all()
+        started = time.perf_counter()
+        row = lookup()
+        timings.append((time.perf_counter() - started) * 1e6)
+        assert row is not None
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    runs = int(options.get('runs', 5000))
+
+    engine = make_engine(settings)
+    dbsession = sessionmaker(bind=engine)()
+    product_id = dbsession.query(Product.id).limit(1).scalar()
+    email = dbsession.query(User.email).limit(1).scalar()
+    if product_id is None or email is None:
+        print('The database needs at least one product and one user')
+        sys.exit(1)
+
+    cases = [
+        ('product by id: query().first()', True,
+         lambda: dbsession.query(Product).filter(Product.id == product_id).first()),
+        ('product by id: Session.get', True,
+         lambda: dbsession.get(Product, product_id)),
+        ('product by id: Session.get, loaded', False,
+         lambda: dbsession.get(Product, product_id)),
+        ('user by email: query().first()', True,
+         lambda: dbsession.query(User).filter(User.email == email).first()),
+        ('user by email: lambda statement', True,
+         lambda: dbsession.scalars(lambda_stmt(lambda: select(User).where(User.email == email))).first()),
+        ('user by email: prebuilt statement', True,
+         lambda: get_user_by_email(dbsession, email)),
+    ]
+
+    print(f'{engine.dialect.name} ({engine.driver}), {runs} lookups each (microseconds)\n')
+    print(f"{'lookup':<38} {'p50':>8} {'p95':>8}")
+    try:
+        for label, clear, lookup in cases:
+            # Warm up the statement caches and the connection
+            time_lookup(dbsession, lookup, 50, clear)
+            p50, p95 = time_lookup(dbsession, lookup, runs, clear)
+            print(f'{label:<38} {p50:>8.1f} {p95:>8.1f}')
+    finally:
+        dbsession.close()
+
+
+if __name__ == '__main__':
+    main()
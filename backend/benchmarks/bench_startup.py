@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Benchmark worker start-up time.
+
+Usage: python benchmarks/bench_startup.py <config_uri> [runs=10]
+
+Starts a fresh interpreter `runs` times, builds the application and
+serves one /healthz request, then reports the median and p95 of each
+phase. Workers are added and removed with load, so this is the latency
+of scaling up. Compare development.ini against production.ini to see
+the cost of the debug toolbar and configuration introspection.
+"""
+import statistics
+import sys
+
+from pyramid.scripts.common import parse_vars
+
+from ecommerce_api.scripts.startup_report import measure_startup
+
+PHASES = ['import_ms', 'get_app_ms', 'first_request_ms', 'total_ms']
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    runs = int(options.get('runs', 10))
+
+    # The first start pays for compiling bytecode; leave it out
+    measure_startup(config_uri)
+    results = [measure_startup(config_uri) for _ in range(runs)]
+
+    print(f'{config_uri}: {runs} cold starts (milliseconds)\n')
+    print(f"{'phase':<18} {'p50':>8} {'p95':>8}")
+    for phase in PHASES:
+        timings = sorted(result[phase] for result in results)
+        p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+        print(f'{phase[:-3]:<18} {statistics.median(timings):>8.1f} {p95:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark autocomplete lookups in the in-memory suggest index.
+
+Usage: python benchmarks/bench_suggest.py <config_uri> [synthetic=100000] [runs=2000]
+
+Builds the index from the products in the database, then adds
+`synthetic` generated products (in memory only) so the lookups run
+against a catalogue of realistic size. Times prefixes of one to four
+characters and two-word queries, and for comparison the ILIKE query
+behind `GET /api/products?search=` that the search box used before.
+"""
+import random
+import statistics
+import string
+import sys
+import time
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+from sqlalchemy.orm import sessionmaker
+
+from ecommerce_api.database import make_engine
+from ecommerce_api.models.product import Product
+from ecommerce_api.suggest import SuggestIndex
+
+CATEGORIES = ['Electronics', 'Clothing', 'Home', 'Garden', 'Sports', 'Toys', 'Books', 'Beauty']
+
+
+def fake_word(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9)))
+
+
+def synthetic_rows(count, vocabulary, rng):
+    first_id = 10**9
+    for offset in range(count):
+        title = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(2, 5))).title()
+        yield (first_id + offset, title, None, rng.choice(CATEGORIES),
+               round(rng.uniform(0, 5), 1), rng.randint(0, 200))
+
+
+def time_calls(call, queries, runs):
+    """Return the p50 and p99 of `call(query)` in milliseconds."""
+    timings = []
+    for i in range(runs):
+        started = time.perf_counter()
+        call(queries[i % len(queries)])
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    synthetic = int(options.get('synthetic', 100000))
+    runs = int(options.get('runs', 2000))
+    rng = random.Random(42)
+
+    engine = make_engine(settings)
+    dbsession = sessionmaker(bind=engine)()
+    rows = dbsession.query(Product.id, Product.title, Product.image_url,
+                           Product.category, Product.rating, Product.stock).all()
+    dbsession.close()
+    vocabulary = [fake_word(rng) for _ in range(max(synthetic // 5, 100))]
+    rows += list(synthetic_rows(synthetic, vocabulary, rng))
+
+    index = SuggestIndex(sessionmaker(bind=engine), refresh_interval=0)
+    started = time.perf_counter()
+    index.load(rows)
+    build_ms = (time.perf_counter() - started) * 1000
+    stats = index.stats()
+    print(f"Index: {stats['products']} products, {stats['terms']} terms, built in {build_ms:.0f} ms")
+
+    # A product write as the views apply it after commit
+    timings = []
+    for product_id, title, image, category, rating, stock in rows[-200:]:
+        started = time.perf_counter()
+        index.upsert(product_id, title + ' ' + fake_word(rng), image, category, rating, stock)
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f'Incremental update: {statistics.median(timings):.3f} ms median\n')
+
+    cases = [
+        (f'{length}-character prefix', [rng.choice(vocabulary)[:length] for _ in range(200)])
+        for length in (1, 2, 3, 4)
+    ]
+    cases.append(('two words', [f'{rng.choice(vocabulary)} {rng.choice(vocabulary)[:3]}' for _ in range(200)]))
+
+    print(f"{'suggest lookup':<28} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, queries in cases:
+        time_calls(lambda query: index.search(query, 8), queries, 100)
+        p50, p99 = time_calls(lambda query: index.search(query, 8), queries, runs)
+        print(f'{label:<28} {p50:>8.3f} {p99:>8.3f}')
+
+    # The query the search box ran on every keystroke before
+    dbsession = sessionmaker(bind=engine)()
+    try:
+        titles = [title for (title,) in dbsession.query(Product.title).limit(200)] or ['a']
+        queries = [f'%{title[:3]}%' for title in titles]
+        search = lambda term: dbsession.query(Product).filter(
+            Product.title.ilike(term) | Product.description.ilike(term)
+        ).limit(20).all()
+        p50, p99 = time_calls(search, queries, min(runs, 500))
+        print(f"{'ILIKE search (database)':<28} {p50:>8.3f} {p99:>8.3f}")
+    finally:
+        dbsession.close()
+
+
+if __name__ == '__main__':
+    main()
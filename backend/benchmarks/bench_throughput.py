@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark request throughput of serve_prefork with 1..N workers.
+
+Usage: python benchmarks/bench_throughput.py <config_uri> [workers=1,2,4] [seconds=10]
+           [clients=16] [threads=4] [path=/api/products?per_page=20] [port=8765]
+
+For each worker count, starts serve_prefork on 127.0.0.1:<port>, drives
+it with `clients` keep-alive client processes for `seconds`, and reports
+requests per second, latency percentiles and the speed-up over one
+worker. Run it on a machine with at least as many cores as the largest
+worker count plus the clients' share, or the clients become the limit.
+"""
+import http.client
+import multiprocessing
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+from pyramid.scripts.common import parse_vars
+
+
+def wait_until_serving(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/healthz')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'serve_prefork did not start on port {port}')
+
+
+def client(args):
+    """Issue requests over one keep-alive connection until time runs out."""
+    port, path, seconds = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, errors
+
+
+def run_load(port, path, seconds, clients):
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [(port, path, seconds)] * clients)
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    return latencies, errors
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    worker_counts = [int(count) for count in options.get('workers', '1,2,4').split(',')]
+    seconds = float(options.get('seconds', 10))
+    clients = int(options.get('clients', 16))
+    threads = options.get('threads', '4')
+    path = options.get('path', '/api/products?per_page=20')
+    port = int(options.get('port', 8765))
+
+    print(f'{path}: {clients} clients, {seconds:g}s per run, {os.cpu_count()} CPUs\n')
+    print(f"{'workers':>7} {'req/s':>9} {'speed-up':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    baseline = None
+    for workers in worker_counts:
+        server = subprocess.Popen(
+            ['serve_prefork', config_uri, '--workers', str(workers), '--threads', threads,
+             '--listen', f'127.0.0.1:{port}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            wait_until_serving(port)
+            # Warm up the pools and caches before measuring
+            run_load(port, path, 1, clients)
+            latencies, errors = run_load(port, path, seconds, clients)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+        throughput = len(latencies) / seconds
+        baseline = baseline or throughput
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+        print(f'{workers:>7} {throughput:>9.0f} {throughput / baseline:>8.2f}x '
+              f'{statistics.median(latencies) if latencies else 0:>8.1f} {p99:>8.1f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark the admin user search at scale.
+
+Usage: python benchmarks/bench_user_search.py <config_uri> [users=1000000] [runs=20]
+
+Tops the users table up to the requested size with synthetic rows
+(bench-user-N@example.com), then times the search queries issued by
+GET /api/users with the indexes enabled and with index scans disabled,
+which is how the query ran before the trigram migration.
+"""
+import statistics
+import sys
+import time
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripts.common import parse_vars
+from sqlalchemy import engine_from_config, func, text
+from sqlalchemy.orm import sessionmaker
+
+from ecommerce_api.models.user import User
+
+SEARCHES = [
+    ('substring', 'mith'),
+    ('first name', 'olivia'),
+    ('email prefix', 'bench-user-4242@'),
+    ('exact email', 'bench-user-999999@example.com'),
+]
+
+FIRST_NAMES = ['Olivia', 'Liam', 'Emma', 'Noah', 'Ava', 'John', 'Sophia', 'Lucas', 'Mia', 'Ethan']
+LAST_NAMES = ['Smith', 'Johnson', 'Brown', 'Taylor', 'Anderson', 'Thomas', 'Jackson', 'White']
+
+
+def ensure_users(connection, total):
+    """Insert synthetic users until the table holds `total` rows."""
+    existing = connection.execute(text('SELECT count(*) FROM users')).scalar()
+    missing = total - existing
+    if missing <= 0:
+        return existing
+
+    print(f'Inserting {missing} synthetic users...')
+    started = time.perf_counter()
+    connection.execute(text("""
+        INSERT INTO users (email, first_name, last_name, password_hash,
+                           is_active, is_admin, created_at, updated_at)
+        SELECT 'bench-user-' || n || '@example.com',
+               (CAST(:first_names AS text[]))[1 + n % :first_count] || n % 97,
+               (CAST(:last_names AS text[]))[1 + n % :last_count],
+               'x', true, false, now(), now()
+        FROM generate_series(:start, :stop) AS n
+        ON CONFLICT DO NOTHING
+    """), {
+        'first_names': FIRST_NAMES, 'first_count': len(FIRST_NAMES),
+        'last_names': LAST_NAMES, 'last_count': len(LAST_NAMES),
+        'start': existing, 'stop': total - 1,
+    })
+    connection.execute(text('ANALYZE users'))
+    print(f'  done in {time.perf_counter() - started:.1f}s')
+    return total
+
+
+def build_query(dbsession, term, ranked):
+    """Mirror get_users: email prefix path, otherwise ILIKE ranked by similarity."""
+    query = dbsession.query(User.id)
+    if '@' in term:
+        return query.filter(func.lower(User.email).like(term.lower() + '%'))
+
+    pattern = f'%{term}%'
+    query = query.filter(
+        User.email.ilike(pattern) |
+        User.first_name.ilike(pattern) |
+        User.last_name.ilike(pattern)
+    )
+    if ranked:
+        rank = func.greatest(
+            func.similarity(User.email, term),
+            func.similarity(User.first_name, term),
+            func.similarity(User.last_name, term)
+        )
+        query = query.order_by(rank.desc(), User.id)
+    return query.limit(10)
+
+
+def time_query(dbsession, query, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        query.all()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    users = int(options.get('users', 1000000))
+    runs = int(options.get('runs', 20))
+
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+    if engine.dialect.name != 'postgresql':
+        print('This benchmark requires PostgreSQL')
+        sys.exit(1)
+
+    with engine.begin() as connection:
+        total = ensure_users(connection, users)
+        has_trigram = connection.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        ).scalar()
+    if not has_trigram:
+        print('pg_trgm is not installed: substring searches run unranked and unindexed')
+
+    session_factory = sessionmaker(bind=engine)
+    print(f'\n{total} users, {runs} runs per query (milliseconds)\n')
+    print(f"{'search':<14} {'term':<32} {'indexed p50':>12} {'p95':>8} {'seq scan p50':>13} {'p95':>8}")
+
+    for label, term in SEARCHES:
+        dbsession = session_factory()
+        try:
+            query = build_query(dbsession, term, ranked=bool(has_trigram))
+            indexed = time_query(dbsession, query, runs)
+            dbsession.execute(text('SET LOCAL enable_indexscan = off'))
+            dbsession.execute(text('SET LOCAL enable_bitmapscan = off'))
+            scanned = time_query(dbsession, query, max(3, runs // 5))
+        finally:
+            dbsession.rollback()
+            dbsession.close()
+        print(f'{label:<14} {term:<32} {indexed[0]:>12.2f} {indexed[1]:>8.2f} '
+              f'{scanned[0]:>13.2f} {scanned[1]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,13 @@ import os
 import datetime
 from pyramid.config import Configurator
 from pyramid.renderers import JSON
+from pyramid.settings import asbool
 from pyramid.security import Allow, Everyone
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.authentication import SessionAuthenticationPolicy
 from pyramid.session import SignedCookieSessionFactory
 from pyramid.interfaces import IAuthenticationPolicy
-from sqlalchemy import engine_from_config
-from sqlalchemy.orm import sessionmaker, configure_mappers
+from sqlalchemy.orm import configure_mappers
 from zope.sqlalchemy import register as zregister
 from zope.interface import implementer
 
@@ -58,16 +58,10 @@ class SessionBasedAuthenticationPolicy:
         """Return headers for forgetting the user (not used in session auth)."""
         return []
 
-def main(global_config, **settings):
-    """ This function returns a Pyramid WSGI application.
-    """
-    config = Configurator(settings=settings)
-    # Transaction manager
-    config.include('pyramid_tm')
-    
-    # Set up session-based authentication
+def make_session_factory(settings):
+    """Return the session factory, shared with serve_order_events to read logins."""
     session_secret = settings.get('session.secret', 'your-secret-key-change-in-production')
-    session_factory = SignedCookieSessionFactory(
+    return SignedCookieSessionFactory(
         secret=session_secret,
         timeout=86400,  # 24 hours in seconds
         cookie_name='ecommerce_session',
@@ -75,7 +69,18 @@ def main(global_config, **settings):
         secure=False,  # Set to True in production with HTTPS
         httponly=True
     )
-    config.set_session_factory(session_factory)    # Configure authentication and authorization policies
+
+def main(global_config, **settings):
+    """ This function returns a Pyramid WSGI application.
+    """
+    # Introspection only feeds the debug toolbar; production.ini turns it off
+    introspection = asbool(settings.get('app.introspection', True))
+    config = Configurator(settings=settings, introspection=introspection)
+    # Transaction manager
+    config.include('pyramid_tm')
+    
+    # Set up session-based authentication
+    config.set_session_factory(make_session_factory(settings))    # Configure authentication and authorization policies
     authn_policy = SessionBasedAuthenticationPolicy()
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(ACLAuthorizationPolicy())
@@ -86,9 +91,36 @@ def main(global_config, **settings):
     json_renderer.add_adapter(datetime.datetime, lambda obj, request: obj.isoformat())
     config.add_renderer('json', json_renderer)
     
-    # Set up database
-    engine = engine_from_config(settings, prefix='sqlalchemy.')
-    config.registry.dbmaker = sessionmaker(bind=engine)
+    # Metrics registry, then the database engine and its instrumented pool
+    config.include('.metrics')
+    config.include('.database')
+    
+    # Liveness and readiness probes
+    config.include('.health')
+    
+    # Slow query recorder (enabled by slowlog.threshold_ms)
+    config.include('.slowlog')
+    
+    # Request tracing spans (enabled by tracing.sample_rate)
+    config.include('.tracing')
+    
+    # tracemalloc profiling from the admin API (enabled by memprof.enabled)
+    config.include('.memprof')
+
+    # Single-flight coalescing of identical reads (views with coalesce=True)
+    config.include('.coalesce')
+    
+    # In-memory prefix index for /api/products/suggest
+    config.include('.suggest')
+    
+    # Idempotency-Key support for retried POST requests
+    config.include('.idempotency')
+    
+    # Sharded stock counters, cart reservations and the stock ledger
+    config.include('.inventory')
+    
+    # Request capture for replay_traffic (enabled by capture.path)
+    config.include('.capture')
     
     # Configure CORS
     config.include('cornice')
@@ -106,7 +138,8 @@ def main(global_config, **settings):
             response.headers.update({
                 'Access-Control-Allow-Origin': origin,
                 'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,PATCH,OPTIONS',
-                'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept, Authorization, X-Client-Version, X-Registration-Source',
+                'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept, Authorization, If-Match, Last-Event-ID, traceparent, X-Client-Version, X-Registration-Source',
+                'Access-Control-Expose-Headers': 'ETag',
                 'Access-Control-Allow-Credentials': 'true',
             })
     
@@ -125,6 +158,8 @@ def main(global_config, **settings):
     
     config.add_request_method(add_db_to_request, 'db', reify=True)
     
-    config.scan()
+    # Only the views carry @view_config; scanning the whole package would
+    # also import the scripts and their dependencies
+    config.scan('.views')
     
     return config.make_wsgi_app()
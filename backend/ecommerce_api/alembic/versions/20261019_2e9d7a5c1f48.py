@@ -0,0 +1,31 @@
+"""add order statistics to users
+
+Revision ID: 2e9d7a5c1f48
+Revises: c7e35b18f4d2
+Create Date: 2026-10-19 12:41:53.118702
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2e9d7a5c1f48'
+down_revision = 'c7e35b18f4d2'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('users', sa.Column('order_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('lifetime_spend', sa.Float(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('last_order_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_users_lifetime_spend'), 'users', ['lifetime_spend'], unique=False)
+    op.create_index(op.f('ix_users_last_order_at'), 'users', ['last_order_at'], unique=False)
+    # Existing statistics are filled in with `rebuild_user_stats <config_uri>`
+
+def downgrade():
+    op.drop_index(op.f('ix_users_last_order_at'), table_name='users')
+    op.drop_index(op.f('ix_users_lifetime_spend'), table_name='users')
+    op.drop_column('users', 'last_order_at')
+    op.drop_column('users', 'lifetime_spend')
+    op.drop_column('users', 'order_count')
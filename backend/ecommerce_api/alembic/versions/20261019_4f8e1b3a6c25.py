@@ -0,0 +1,59 @@
+"""add composite indexes for endpoint filters and sorts
+
+Revision ID: 4f8e1b3a6c25
+Revises: 9b0c4d6e2a13
+Create Date: 2026-10-19 15:37:12.804431
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f8e1b3a6c25'
+down_revision = '9b0c4d6e2a13'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns). On very large unpartitioned tables consider
+# creating these by hand with CREATE INDEX CONCURRENTLY and stamping.
+INDEXES = [
+    ('ix_products_category_id', 'products', ['category', 'id']),
+    ('ix_products_category_price', 'products', ['category', 'price']),
+    ('ix_products_category_rating', 'products', ['category', 'rating']),
+    ('ix_products_price', 'products', ['price']),
+    ('ix_products_rating', 'products', ['rating']),
+    ('ix_products_created_at', 'products', ['created_at']),
+    ('ix_orders_user_id_created_at', 'orders', ['user_id', 'created_at']),
+    ('ix_orders_created_at', 'orders', ['created_at']),
+    ('ix_orders_status_created_at', 'orders', ['status', 'created_at']),
+    ('ix_orders_total', 'orders', ['total']),
+    ('ix_order_items_order_id', 'order_items', ['order_id']),
+    ('ix_order_items_product_id', 'order_items', ['product_id']),
+]
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+    # Superseded by the composite indexes that lead with the same column
+    op.drop_index('ix_products_category', table_name='products')
+    op.drop_index('ix_orders_user_id', table_name='orders')
+
+    # The admin user list sorts by last order date descending with
+    # customers who never ordered last. SQLite cannot declare NULLS LAST
+    # in an index and keeps the plain one.
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_users_last_order_at', table_name='users')
+        op.create_index('ix_users_last_order_at', 'users',
+                        [sa.text('last_order_at DESC NULLS LAST')], unique=False)
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_users_last_order_at', table_name='users')
+        op.create_index('ix_users_last_order_at', 'users', ['last_order_at'], unique=False)
+    op.create_index('ix_orders_user_id', 'orders', ['user_id'], unique=False)
+    op.create_index('ix_products_category', 'products', ['category'], unique=False)
+
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
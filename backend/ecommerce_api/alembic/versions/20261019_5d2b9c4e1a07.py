@@ -0,0 +1,83 @@
+"""baseline schema
+
+Revision ID: 5d2b9c4e1a07
+Revises: 
+Create Date: 2026-10-19 09:12:44.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b9c4e1a07'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.String(length=100), nullable=False),
+        sa.Column('first_name', sa.String(length=50), nullable=False),
+        sa.Column('last_name', sa.String(length=50), nullable=False),
+        sa.Column('password_hash', sa.String(length=255), nullable=False),
+        sa.Column('is_active', sa.Boolean(), nullable=False),
+        sa.Column('is_admin', sa.Boolean(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_users')),
+        sa.UniqueConstraint('email', name=op.f('uq_users_email'))
+    )
+    op.create_table('products',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=200), nullable=False),
+        sa.Column('description', sa.Text(), nullable=True),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('category', sa.String(length=100), nullable=False),
+        sa.Column('image_url', sa.String(length=500), nullable=True),
+        sa.Column('rating', sa.Float(), nullable=True),
+        sa.Column('stock', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_products'))
+    )
+    op.create_index(op.f('ix_products_category'), 'products', ['category'], unique=False)
+    op.create_table('orders',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Enum('processing', 'shipped', 'delivered', 'cancelled', name='order_status'), nullable=True),
+        sa.Column('subtotal', sa.Float(), nullable=False),
+        sa.Column('shipping_cost', sa.Float(), nullable=True),
+        sa.Column('tax', sa.Float(), nullable=True),
+        sa.Column('total', sa.Float(), nullable=False),
+        sa.Column('shipping_address', sa.JSON(), nullable=False),
+        sa.Column('payment_method', sa.String(length=50), nullable=False),
+        sa.Column('tracking_number', sa.String(length=100), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], name=op.f('fk_orders_user_id_users')),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_orders'))
+    )
+    op.create_index(op.f('ix_orders_user_id'), 'orders', ['user_id'], unique=False)
+    op.create_table('order_items',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['order_id'], ['orders.id'], name=op.f('fk_order_items_order_id_orders')),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], name=op.f('fk_order_items_product_id_products')),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_order_items'))
+    )
+
+def downgrade():
+    op.drop_table('order_items')
+    op.drop_index(op.f('ix_orders_user_id'), table_name='orders')
+    op.drop_table('orders')
+    sa.Enum(name='order_status').drop(op.get_bind(), checkfirst=True)
+    op.drop_index(op.f('ix_products_category'), table_name='products')
+    op.drop_table('products')
+    op.drop_table('users')
@@ -0,0 +1,61 @@
+"""add stock slots, reservations and movements
+
+Revision ID: 7c2f5e9a3b16
+Revises: e3a9c71b5d04
+Create Date: 2026-10-19 17:02:48.109364
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2f5e9a3b16'
+down_revision = 'e3a9c71b5d04'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    # Products get their slots from products.stock on first use
+    op.create_table('stock_slots',
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('slot', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.CheckConstraint('quantity >= 0', name=op.f('ck_stock_slots_quantity_not_negative')),
+        sa.ForeignKeyConstraint(['product_id'], ['products.id'], name=op.f('fk_stock_slots_product_id_products'), ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('product_id', 'slot', name=op.f('pk_stock_slots'))
+    )
+    op.create_table('stock_reservations',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Enum('held', 'ordered', 'released', 'expired', name='reservation_status'), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], name=op.f('fk_stock_reservations_user_id_users')),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_stock_reservations'))
+    )
+    op.create_index('ix_stock_reservations_status_expires_at', 'stock_reservations', ['status', 'expires_at'], unique=False)
+    op.create_index(op.f('ix_stock_reservations_user_id'), 'stock_reservations', ['user_id'], unique=False)
+    op.create_table('stock_movements',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('reason', sa.String(length=20), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=True),
+        sa.Column('reservation_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_stock_movements'))
+    )
+    op.create_index('ix_stock_movements_product_id_id', 'stock_movements', ['product_id', 'id'], unique=False)
+
+def downgrade():
+    op.drop_index('ix_stock_movements_product_id_id', table_name='stock_movements')
+    op.drop_table('stock_movements')
+    op.drop_index(op.f('ix_stock_reservations_user_id'), table_name='stock_reservations')
+    op.drop_index('ix_stock_reservations_status_expires_at', table_name='stock_reservations')
+    op.drop_table('stock_reservations')
+    sa.Enum(name='reservation_status').drop(op.get_bind(), checkfirst=True)
+    op.drop_table('stock_slots')
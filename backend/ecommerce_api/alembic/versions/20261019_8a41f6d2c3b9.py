@@ -0,0 +1,49 @@
+"""add order summary columns
+
+Revision ID: 8a41f6d2c3b9
+Revises: 5d2b9c4e1a07
+Create Date: 2026-10-19 10:03:27.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a41f6d2c3b9'
+down_revision = '5d2b9c4e1a07'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+BACKFILL = sa.text("""
+    UPDATE orders SET
+        item_count = (SELECT count(*) FROM order_items oi WHERE oi.order_id = orders.id),
+        unit_count = (SELECT coalesce(sum(oi.quantity), 0) FROM order_items oi
+                      WHERE oi.order_id = orders.id),
+        first_item_title = (SELECT p.title FROM order_items oi
+                            JOIN products p ON p.id = oi.product_id
+                            WHERE oi.order_id = orders.id ORDER BY oi.id LIMIT 1),
+        first_item_image = (SELECT p.image_url FROM order_items oi
+                            JOIN products p ON p.id = oi.product_id
+                            WHERE oi.order_id = orders.id ORDER BY oi.id LIMIT 1)
+    WHERE orders.id >= :start AND orders.id < :end
+""")
+
+def upgrade():
+    op.add_column('orders', sa.Column('item_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('orders', sa.Column('unit_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('orders', sa.Column('first_item_title', sa.String(length=200), nullable=True))
+    op.add_column('orders', sa.Column('first_item_image', sa.String(length=500), nullable=True))
+
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text('SELECT max(id) FROM orders')).scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        connection.execute(BACKFILL, {'start': start, 'end': start + BATCH_SIZE})
+
+def downgrade():
+    op.drop_column('orders', 'first_item_image')
+    op.drop_column('orders', 'first_item_title')
+    op.drop_column('orders', 'unit_count')
+    op.drop_column('orders', 'item_count')
@@ -0,0 +1,51 @@
+"""add trigram indexes for user search
+
+Revision ID: 9b0c4d6e2a13
+Revises: 2e9d7a5c1f48
+Create Date: 2026-10-19 14:08:31.560917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b0c4d6e2a13'
+down_revision = '2e9d7a5c1f48'
+branch_labels = None
+depends_on = None
+
+TRIGRAM_COLUMNS = ('email', 'first_name', 'last_name')
+
+def upgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != 'postgresql':
+        return
+
+    # Prefix lookups on lowercased email addresses
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS ix_users_email_lower_pattern '
+        'ON users (lower(email) text_pattern_ops)'
+    )
+
+    available = connection.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if not available:
+        print('pg_trgm is not available on this server; user search will not use trigram indexes')
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in TRIGRAM_COLUMNS:
+        op.execute(
+            f'CREATE INDEX IF NOT EXISTS ix_users_{column}_trgm '
+            f'ON users USING gin ({column} gin_trgm_ops)'
+        )
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for column in TRIGRAM_COLUMNS:
+        op.execute(f'DROP INDEX IF EXISTS ix_users_{column}_trgm')
+    op.execute('DROP INDEX IF EXISTS ix_users_email_lower_pattern')
@@ -0,0 +1,22 @@
+"""add replayed headers to idempotency keys
+
+Revision ID: a9d3f5b27c61
+Revises: f27b9d4c6a38
+Create Date: 2026-10-19 21:12:37.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9d3f5b27c61'
+down_revision = 'f27b9d4c6a38'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('idempotency_keys', sa.Column('response_headers', sa.JSON(), nullable=True))
+
+def downgrade():
+    op.drop_column('idempotency_keys', 'response_headers')
@@ -0,0 +1,28 @@
+"""add version columns for optimistic locking
+
+Revision ID: b58d3e0f7a21
+Revises: 7c2f5e9a3b16
+Create Date: 2026-10-19 17:48:12.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b58d3e0f7a21'
+down_revision = '7c2f5e9a3b16'
+branch_labels = None
+depends_on = None
+
+TABLES = ('products', 'orders', 'users')
+
+def upgrade():
+    # A constant default adds the column without rewriting the table on
+    # PostgreSQL 11+; on a partitioned orders table it reaches every partition
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.drop_column(table, 'version')
@@ -0,0 +1,31 @@
+"""add inventory state
+
+Revision ID: c3e8a1d6f052
+Revises: a9d3f5b27c61
+Create Date: 2026-10-19 22:03:18.417590
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8a1d6f052'
+down_revision = 'a9d3f5b27c61'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('inventory_state',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('rebalanced_at', sa.DateTime(), nullable=True),
+        sa.Column('full_pass_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_inventory_state'))
+    )
+    # No passes yet: the first one covers every product
+    op.execute('INSERT INTO inventory_state (id) VALUES (1)')
+    op.create_index('ix_stock_movements_created_at', 'stock_movements', ['created_at'], unique=False)
+
+def downgrade():
+    op.drop_index('ix_stock_movements_created_at', table_name='stock_movements')
+    op.drop_table('inventory_state')
@@ -0,0 +1,61 @@
+"""add product snapshot to order items
+
+Revision ID: c7e35b18f4d2
+Revises: 8a41f6d2c3b9
+Create Date: 2026-10-19 11:26:05.447310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e35b18f4d2'
+down_revision = '8a41f6d2c3b9'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+BACKFILL = sa.text("""
+    UPDATE order_items SET
+        product_title = products.title,
+        product_image = products.image_url,
+        product_category = products.category
+    FROM products
+    WHERE products.id = order_items.product_id
+      AND order_items.id >= :start AND order_items.id < :end
+""")
+
+def upgrade():
+    op.add_column('order_items', sa.Column('product_title', sa.String(length=200), nullable=True))
+    op.add_column('order_items', sa.Column('product_image', sa.String(length=500), nullable=True))
+    op.add_column('order_items', sa.Column('product_category', sa.String(length=100), nullable=True))
+
+    # Order items keep their snapshot when the product is deleted
+    with op.batch_alter_table('order_items') as batch_op:
+        batch_op.alter_column('product_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.drop_constraint('fk_order_items_product_id_products', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_order_items_product_id_products', 'products',
+            ['product_id'], ['id'], ondelete='SET NULL'
+        )
+
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text('SELECT max(id) FROM order_items')).scalar() or 0
+    for start in range(0, max_id + 1, BATCH_SIZE):
+        connection.execute(BACKFILL, {'start': start, 'end': start + BATCH_SIZE})
+
+def downgrade():
+    op.execute('DELETE FROM order_items WHERE product_id IS NULL')
+    with op.batch_alter_table('order_items') as batch_op:
+        batch_op.drop_constraint('fk_order_items_product_id_products', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_order_items_product_id_products', 'products',
+            ['product_id'], ['id']
+        )
+        batch_op.alter_column('product_id', existing_type=sa.Integer(), nullable=False)
+
+    op.drop_column('order_items', 'product_category')
+    op.drop_column('order_items', 'product_image')
+    op.drop_column('order_items', 'product_title')
@@ -0,0 +1,47 @@
+"""add product change feed
+
+Revision ID: d41a6c8e2f95
+Revises: b58d3e0f7a21
+Create Date: 2026-10-19 18:26:37.804113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41a6c8e2f95'
+down_revision = 'b58d3e0f7a21'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('product_changes',
+        sa.Column('token', sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('deleted', sa.Boolean(), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('token', name=op.f('pk_product_changes'))
+    )
+    op.create_index('ix_product_changes_product_id_token', 'product_changes', ['product_id', 'token'], unique=False)
+    op.create_table('change_feed_state',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('last_token', sa.BigInteger(), nullable=False),
+        sa.Column('horizon', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_change_feed_state'))
+    )
+    # Existing products become the first changes, with their ids as
+    # tokens, so a client can sync the whole catalogue from token 0
+    op.execute(
+        'INSERT INTO product_changes (token, product_id, deleted, changed_at) '
+        'SELECT id, id, false, updated_at FROM products'
+    )
+    op.execute(
+        'INSERT INTO change_feed_state (id, last_token, horizon) '
+        'SELECT 1, COALESCE(MAX(id), 0), 0 FROM products'
+    )
+
+def downgrade():
+    op.drop_table('change_feed_state')
+    op.drop_index('ix_product_changes_product_id_token', table_name='product_changes')
+    op.drop_table('product_changes')
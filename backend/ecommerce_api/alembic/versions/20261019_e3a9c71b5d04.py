@@ -0,0 +1,38 @@
+"""add idempotency keys
+
+Revision ID: e3a9c71b5d04
+Revises: 4f8e1b3a6c25
+Create Date: 2026-10-19 16:21:05.442871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9c71b5d04'
+down_revision = '4f8e1b3a6c25'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('idempotency_keys',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('scope', sa.String(length=64), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('fingerprint', sa.String(length=64), nullable=False),
+        sa.Column('lock_token', sa.String(length=32), nullable=True),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('response_status', sa.Integer(), nullable=True),
+        sa.Column('response_content_type', sa.String(length=255), nullable=True),
+        sa.Column('response_body', sa.LargeBinary(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_idempotency_keys')),
+        sa.UniqueConstraint('scope', 'key', name=op.f('uq_idempotency_keys_scope'))
+    )
+    op.create_index('ix_idempotency_keys_expires_at', 'idempotency_keys', ['expires_at'], unique=False)
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_expires_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,34 @@
+"""add order events
+
+Revision ID: f27b9d4c6a38
+Revises: d41a6c8e2f95
+Create Date: 2026-10-19 19:04:51.226790
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27b9d4c6a38'
+down_revision = 'd41a6c8e2f95'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('order_events',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('order_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('tracking_number', sa.String(length=100), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_order_events'))
+    )
+    op.create_index('ix_order_events_user_id_id', 'order_events', ['user_id', 'id'], unique=False)
+    op.create_index(op.f('ix_order_events_created_at'), 'order_events', ['created_at'], unique=False)
+
+def downgrade():
+    op.drop_index(op.f('ix_order_events_created_at'), table_name='order_events')
+    op.drop_index('ix_order_events_user_id_id', table_name='order_events')
+    op.drop_table('order_events')
@@ -0,0 +1,198 @@
+"""Traffic capture for replaying the production request mix.
+
+Enabled by `capture.path`. A tween above pyramid_tm records one JSON line
+per request (a `capture.sample_rate` share of them) with what replay_traffic
+needs to re-issue it, and nothing that identifies a customer:
+
+- `ts`: start time (epoch seconds); `ms`: duration including the commit;
+- `method`, `route` (matched route name), `path`, `status`;
+- `query`: the query parameters, with the values of the parameters in
+  `capture.redact_params` (`name` or `route:name`) replaced by `<str>`;
+- `body`: the shape of a JSON body: numbers, booleans and the strings of
+  the keys in `capture.body_fields` are kept, other strings become `<str>`;
+- `user`: `anonymous`, `customer` or `admin`, and `session`, a keyed hash
+  of the user id that tells the requests of one user apart.
+
+Lines are written by a background thread, so the request only pays for
+a queue put; when the queue is full the entry is dropped and counted in
+`capture_dropped_total`. The file is rotated at `capture.max_mb` and the
+last `capture.backups` files are kept, gzipped. Under serve_prefork put
+`{pid}` in the path so every worker writes its own file.
+"""
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import shutil
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from pyramid.settings import aslist
+
+log = logging.getLogger(__name__)
+
+REDACTED = '<str>'
+
+def body_shape(value, keep=frozenset()):
+    """Return `value` with the strings outside the `keep` keys redacted."""
+    if isinstance(value, dict):
+        return {
+            key: item if key in keep and isinstance(item, str) else body_shape(item, keep)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [body_shape(item, keep) for item in value]
+    if isinstance(value, str):
+        return REDACTED
+    return value
+
+def _gzip_rotator(source, destination):
+    with open(source, 'rb') as plain, gzip.open(destination, 'wb') as packed:
+        shutil.copyfileobj(plain, packed)
+    os.remove(source)
+
+class TrafficCapture:
+    """Queue of captured requests, written to a rotating file by one thread."""
+
+    def __init__(self, path, secret, sample_rate=1.0, redact_params=(), body_fields=(),
+                 max_bytes=50 * 1024 * 1024, backups=5, queue_size=10000, metrics=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.redact_params = frozenset(redact_params)
+        self.body_fields = frozenset(body_fields)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.metrics = metrics
+        self._secret = secret.encode('utf-8')
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def session_key(self, user_id):
+        """Return a stable pseudonym of the user, not reversible without the secret."""
+        return hmac.new(self._secret, str(user_id).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def describe(self, request, response, started, duration):
+        """Return the capture entry of a finished request."""
+        route = request.matched_route.name if request.matched_route is not None else None
+        query = [
+            [name, REDACTED if name in self.redact_params or f'{route}:{name}' in self.redact_params
+             else value]
+            for name, value in request.GET.items()
+        ]
+        entry = {
+            'ts': round(started, 3),
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'query': query,
+            'status': response.status_code if response is not None else 500,
+            'ms': round(duration * 1000, 2),
+        }
+        if request.content_length and request.content_type == 'application/json':
+            try:
+                entry['body'] = body_shape(request.json_body, self.body_fields)
+            except ValueError:
+                entry['body'] = REDACTED
+        user_id = request.session.get('user_id')
+        if user_id:
+            roles = request.session.get('user_roles', [])
+            entry['user'] = 'admin' if 'admin' in roles else 'customer'
+            entry['session'] = self.session_key(user_id)
+        else:
+            entry['user'] = 'anonymous'
+        return entry
+
+    def record(self, entry):
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._count('capture_dropped_total')
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # A forked worker starts with a copy of the parent's queue
+            self._queue = queue.Queue(maxsize=self._queue.maxsize)
+            thread = threading.Thread(target=self._write, args=(self._queue,),
+                                      name='traffic-capture', daemon=True)
+            thread.start()
+
+    def _write(self, entries):
+        handler = RotatingFileHandler(
+            self.path.format(pid=os.getpid()),
+            maxBytes=self.max_bytes,
+            backupCount=self.backups,
+            delay=True,
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.namer = lambda name: name + '.gz'
+        handler.rotator = _gzip_rotator
+        while True:
+            entry = entries.get()
+            line = json.dumps(entry, separators=(',', ':'), default=str)
+            handler.emit(logging.makeLogRecord({'msg': line}))
+            self._count('capture_records_total')
+
+def capture_tween_factory(handler, registry):
+    """Record the requests chosen by the capture's sample rate."""
+    capture = registry.traffic_capture
+
+    def capture_tween(request):
+        if not capture.sampled():
+            return handler(request)
+        started = time.time()
+        timer = time.perf_counter()
+        response = None
+        try:
+            response = handler(request)
+            return response
+        finally:
+            duration = time.perf_counter() - timer
+            try:
+                capture.record(capture.describe(request, response, started, duration))
+            except Exception:
+                log.exception('Could not capture request to %s', request.path)
+
+    return capture_tween
+
+def includeme(config):
+    settings = config.get_settings()
+    path = settings.get('capture.path')
+    if not path:
+        config.registry.traffic_capture = None
+        return
+
+    config.registry.traffic_capture = TrafficCapture(
+        path,
+        secret=settings.get('session.secret', ''),
+        sample_rate=float(settings.get('capture.sample_rate', 1.0)),
+        redact_params=aslist(settings.get('capture.redact_params',
+                                          'email password token users:search')),
+        body_fields=aslist(settings.get('capture.body_fields',
+                                        'status category payment_method')),
+        max_bytes=int(float(settings.get('capture.max_mb', 50)) * 1024 * 1024),
+        backups=int(settings.get('capture.backups', 5)),
+        metrics=getattr(config.registry, 'metrics', None),
+    )
+    config.add_tween(
+        'ecommerce_api.capture.capture_tween_factory',
+        over='pyramid_tm.tm_tween_factory',
+    )
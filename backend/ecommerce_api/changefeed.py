@@ -0,0 +1,111 @@
+"""Change feed of the product catalogue, for clients that cache it.
+
+Every write to a product appends an entry to `product_changes` in the
+same transaction: the product views, the stock refresh of the inventory
+maintenance thread and the import scripts all call record_changes. A
+client keeps the token of the last change it read and asks
+`GET /api/products/changes?since=<token>` for the products changed after
+it, and the ids of the products deleted.
+
+Tokens come from the single `change_feed_state` row. Taking a token
+locks that row until the writing transaction commits, so changes commit
+in token order: once a client has read a token, no change with a lower
+token can commit later and be missed.
+
+compact_product_changes deletes changes superseded by a later change to
+the same product, and tombstones older than `changefeed.tombstone_days`.
+A client whose token is older than the removed tombstones, or that has
+no token yet, is told to reset: drop its cache, load the catalogue with
+`GET /api/products` and continue from the returned token.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+
+from .models.changefeed import ChangeFeedState, ProductChange
+from .models.product import Product
+
+STATE_ID = 1
+
+# `reset`: the client must reload the catalogue; `token`: where to
+# continue from; `has_more`: more changes follow straight away
+ChangeSet = namedtuple('ChangeSet', 'reset token products deleted has_more')
+
+def _take_tokens(dbsession, count):
+    """Return the last of `count` new tokens, locking the state row."""
+    taken = dbsession.execute(
+        update(ChangeFeedState)
+        .where(ChangeFeedState.id == STATE_ID)
+        .values(last_token=ChangeFeedState.last_token + count)
+    ).rowcount
+    if not taken:
+        # Tables created with create_all rather than the migrations
+        dbsession.execute(insert(ChangeFeedState).values(id=STATE_ID, last_token=count, horizon=0))
+        return count
+    return dbsession.execute(
+        select(ChangeFeedState.last_token).where(ChangeFeedState.id == STATE_ID)
+    ).scalar_one()
+
+def record_changes(dbsession, product_ids, deleted=False):
+    """Record that the products were written, or deleted, in this transaction.
+
+    Call it after the product writes so the state row, the most contended
+    lock taken, is held for as little of the transaction as possible.
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    last = _take_tokens(dbsession, len(product_ids))
+    now = datetime.utcnow()
+    dbsession.execute(insert(ProductChange), [
+        {'token': token, 'product_id': product_id, 'deleted': deleted, 'changed_at': now}
+        for token, product_id in zip(range(last - len(product_ids) + 1, last + 1), product_ids)
+    ])
+
+def force_reset(dbsession):
+    """Make every client reload the catalogue.
+
+    For bulk loads that write products without record_changes.
+    """
+    last = _take_tokens(dbsession, 1)
+    dbsession.execute(
+        update(ChangeFeedState).where(ChangeFeedState.id == STATE_ID).values(horizon=last)
+    )
+
+def read_changes(dbsession, since, limit):
+    """Return the ChangeSet of up to `limit` changes after token `since`."""
+    last_token, horizon = dbsession.execute(
+        select(ChangeFeedState.last_token, ChangeFeedState.horizon)
+        .where(ChangeFeedState.id == STATE_ID)
+    ).first() or (0, 0)
+    # A token ahead of the feed comes from another database, e.g. before
+    # a restore from backup
+    if since is None or since < horizon or since > last_token:
+        return ChangeSet(True, last_token, [], [], False)
+
+    rows = dbsession.execute(
+        select(ProductChange.token, ProductChange.product_id, ProductChange.deleted)
+        .where(ProductChange.token > since)
+        .order_by(ProductChange.token)
+        .limit(limit + 1)
+    ).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # A product's latest change in the page decides what the client gets
+    latest = {}
+    for _, product_id, deleted in rows:
+        latest[product_id] = deleted
+    written = [product_id for product_id, deleted in latest.items() if not deleted]
+    products = dbsession.scalars(
+        select(Product).where(Product.id.in_(written)).order_by(Product.id)
+    ).all() if written else []
+    deleted = sorted(product_id for product_id, deleted in latest.items() if deleted)
+
+    if has_more:
+        token = rows[-1].token
+    else:
+        # Every change up to last_token had committed before the page was read
+        token = max(last_token, since, rows[-1].token if rows else 0)
+    return ChangeSet(False, token, products, deleted, has_more)
@@ -0,0 +1,165 @@
+"""Single-flight coalescing of identical concurrent reads.
+
+A view registered with `coalesce=True` runs once for concurrent identical
+requests: the first one (the leader) runs the view, the others with the
+same key wait for it and get a copy of its rendered response instead of
+running the same queries again. Requests are identical when they have
+the same route, method, matchdict and query parameters (sorted, without
+those in `coalesce.ignore_params`) and the same class of principal
+(anonymous, user or admin). Only views whose response depends on nothing
+else may opt in.
+
+Nothing is cached: a request that arrives after the leader finished runs
+the view again. Waiters hold no database connection.
+
+- A waiter that has waited `coalesce.wait_timeout` seconds runs the view
+  itself.
+- If the leader raises, its waiters raise the same exception rather than
+  retrying against a failing database. HTTP errors are responses of
+  their own that other tweens modify, so their waiters run the view.
+- Streamed responses cannot be copied; their waiters run the view.
+- Conditional requests and other methods than GET and HEAD are never
+  coalesced.
+
+Counted in `coalesce_requests_total{route,role}`, where role is leader,
+follower (served by another request's result), fallback (ran the view
+after a timeout, a streamed response or an HTTP error) or bypass; the
+coalescing rate is follower / total. Timeouts are also counted in
+`coalesce_timeouts_total` and shared exceptions in
+`coalesce_errors_shared_total`. `coalesce_in_flight` is the number of
+computations currently in flight.
+"""
+import threading
+
+from pyramid.httpexceptions import HTTPException
+from pyramid.response import Response
+from pyramid.settings import asbool, aslist
+
+# Headers that belong to the leader's request only
+PRIVATE_HEADERS = frozenset(['set-cookie'])
+
+class Flight:
+    """One in-flight computation and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def principal_class(request):
+    principals = request.effective_principals
+    if 'role:admin' in principals:
+        return 'admin'
+    if request.authenticated_userid is not None:
+        return 'user'
+    return 'anonymous'
+
+def shareable(response):
+    """Return (status, headers, body) of a buffered response, or None if it streams."""
+    if not isinstance(response.app_iter, (list, tuple)):
+        return None
+    headers = [(name, value) for name, value in response.headerlist
+               if name.lower() not in PRIVATE_HEADERS]
+    return response.status, headers, response.body
+
+class Coalescer:
+    """The computations in flight, by request key."""
+
+    def __init__(self, wait_timeout=5.0, ignore_params=(), metrics=None):
+        self.wait_timeout = wait_timeout
+        self.ignore_params = frozenset(ignore_params)
+        self.metrics = metrics
+        self._flights = {}
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.describe('coalesce_requests_total', 'Coalescable requests by role')
+            metrics.describe('coalesce_timeouts_total', 'Waiters that gave up on the leader')
+            metrics.describe('coalesce_errors_shared_total', "Waiters that raised the leader's exception")
+            metrics.describe('coalesce_in_flight', 'Computations waited on by identical requests')
+            metrics.gauge('coalesce_in_flight', lambda: len(self._flights))
+
+    def _count(self, name, route, **labels):
+        if self.metrics is not None:
+            self.metrics.incr(name, route=route, **labels)
+
+    def count_request(self, route, role):
+        self._count('coalesce_requests_total', route, role=role)
+
+    def key(self, request, route):
+        params = sorted(
+            (name, value) for name, value in request.GET.items() if name not in self.ignore_params
+        )
+        return (
+            route,
+            request.method,
+            tuple(sorted(request.matchdict.items())) if request.matchdict else (),
+            tuple(params),
+            principal_class(request),
+        )
+
+    def run(self, key, route, compute):
+        """Return compute()'s response, sharing one computation per key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if leader:
+            try:
+                response = compute()
+                flight.result = shareable(response)
+                return response
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+                self.count_request(route, 'leader')
+
+        if not flight.done.wait(self.wait_timeout):
+            self._count('coalesce_timeouts_total', route)
+            self.count_request(route, 'fallback')
+            return compute()
+        if isinstance(flight.error, HTTPException) or (flight.error is None and flight.result is None):
+            self.count_request(route, 'fallback')
+            return compute()
+        self.count_request(route, 'follower')
+        if flight.error is not None:
+            self._count('coalesce_errors_shared_total', route)
+            raise flight.error
+        status, headers, body = flight.result
+        return Response(status=status, headerlist=list(headers), body=body)
+
+def coalescing_view(view, info):
+    """View deriver applying the `coalesce=True` view option."""
+    coalescer = info.registry.coalescer
+    if not info.options.get('coalesce') or coalescer is None:
+        return view
+    route = info.options.get('route_name') or getattr(info.original_view, '__name__', 'view')
+
+    def coalesced_view(context, request):
+        if (request.method not in ('GET', 'HEAD') or request.if_none_match
+                or request.if_modified_since is not None):
+            coalescer.count_request(route, 'bypass')
+            return view(context, request)
+        return coalescer.run(coalescer.key(request, route), route, lambda: view(context, request))
+
+    return coalesced_view
+
+coalescing_view.options = ('coalesce',)
+
+def includeme(config):
+    settings = config.get_settings()
+    if asbool(settings.get('coalesce.enabled', True)):
+        config.registry.coalescer = Coalescer(
+            wait_timeout=float(settings.get('coalesce.wait_timeout', 5)),
+            ignore_params=aslist(settings.get('coalesce.ignore_params', '_')),
+            metrics=getattr(config.registry, 'metrics', None),
+        )
+    else:
+        config.registry.coalescer = None
+    # Registered either way, so views can always pass coalesce=True
+    config.add_view_deriver(coalescing_view, under='decorated_view', over='rendered_view')
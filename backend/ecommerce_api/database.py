@@ -0,0 +1,240 @@
+"""Engine, session factory and connection pool setup.
+
+Pool settings are read from the usual `sqlalchemy.pool_*` keys and
+validated at startup. With a queue pool, every checkout is timed into the
+`db_pool_wait_ms` histogram and a request that had to wait for a free
+connection is logged with its route.
+"""
+import logging
+import os
+import threading
+import time
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)
+
+# psycopg's own default: a statement is prepared on the server after it
+# has been executed this many times on a connection
+DEFAULT_PREPARE_THRESHOLD = 5
+
+BOOLEAN_VALUES = {'true': True, 'yes': True, 'on': True, '1': True,
+                  'false': False, 'no': False, 'off': False, '0': False}
+
+# setting -> (parser, validity check, description of valid values).
+# SQLAlchemy reads all of the numeric ones as integers.
+POOL_SETTINGS = {
+    'pool_size': (int, lambda value: value >= 1, 'an integer >= 1'),
+    'max_overflow': (int, lambda value: value >= -1, 'an integer >= -1 (-1 for no limit)'),
+    'pool_timeout': (int, lambda value: value >= 1, 'a whole number of seconds >= 1'),
+    'pool_recycle': (int, lambda value: value == -1 or value > 0, 'a number of seconds > 0, or -1'),
+    'pool_pre_ping': (lambda raw: BOOLEAN_VALUES[str(raw).strip().lower()], lambda value: True, 'true or false'),
+}
+QUEUE_POOL_SETTINGS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+def current_route():
+    """Return the matched route name (or path) of the current request."""
+    request = get_current_request()
+    if request is None:
+        return None
+    if request.matched_route is not None:
+        return request.matched_route.name
+    return request.path
+
+def pool_options(settings, prefix, pool_class):
+    """Parse and validate the pool settings, raising ConfigurationError."""
+    options = {}
+    for name, (parse, is_valid, expected) in POOL_SETTINGS.items():
+        raw = settings.get(prefix + name)
+        if raw is None or str(raw).strip() == '':
+            continue
+        try:
+            value = parse(raw)
+        except (KeyError, TypeError, ValueError):
+            value = None
+        if value is None or not is_valid(value):
+            raise ConfigurationError(f'{prefix}{name} must be {expected}, got {raw!r}')
+        options[name] = value
+
+    unsupported = [name for name in QUEUE_POOL_SETTINGS if name in options]
+    if unsupported and not issubclass(pool_class, QueuePool):
+        raise ConfigurationError(
+            f'{", ".join(prefix + name for name in unsupported)} cannot be used with '
+            f'{pool_class.__name__}, the pool used for this database URL'
+        )
+    return options
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that times how long each checkout waits for a connection."""
+
+    metrics = None
+    wait_warning = None
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        pool.wait_warning = self.wait_warning
+        return pool
+
+    def _do_get(self):
+        saturated = 0 <= self._max_overflow and self.checkedout() >= self.size() + self._max_overflow
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self._record_wait(time.perf_counter() - started, saturated, timed_out)
+
+    def _record_wait(self, waited, saturated, timed_out):
+        if self.metrics is not None:
+            self.metrics.observe('db_pool_wait_ms', waited * 1000)
+        if timed_out:
+            if self.metrics is not None:
+                self.metrics.incr('db_pool_timeouts_total')
+            log.warning('No database connection for route %s after %.0f ms: %s',
+                        current_route(), waited * 1000, self.status())
+        elif saturated and self.wait_warning is not None and waited >= self.wait_warning:
+            if self.metrics is not None:
+                self.metrics.incr('db_pool_saturated_waits_total')
+            log.warning('Route %s waited %.0f ms for a database connection: %s',
+                        current_route(), waited * 1000, self.status())
+
+def instrument_pool(engine, metrics):
+    """Count pool events and expose the pool counters as gauges."""
+    metrics.describe('db_pool_checkouts_total', 'Connections checked out of the pool')
+    metrics.describe('db_pool_connects_total', 'New database connections opened')
+    metrics.describe('db_pool_invalidations_total', 'Connections invalidated (e.g. after a disconnect)')
+    metrics.describe('db_pool_timeouts_total', 'Checkouts that hit pool_timeout')
+    metrics.describe('db_pool_saturated_waits_total', 'Checkouts that waited on a saturated pool')
+    metrics.describe('db_pool_wait_ms', 'Time to obtain a connection from the pool')
+
+    event.listen(engine, 'checkout', lambda *args: metrics.incr('db_pool_checkouts_total'))
+    event.listen(engine, 'connect', lambda *args: metrics.incr('db_pool_connects_total'))
+    event.listen(engine, 'invalidate', lambda *args: metrics.incr('db_pool_invalidations_total'))
+    event.listen(engine, 'soft_invalidate',
+                 lambda *args: metrics.incr('db_pool_invalidations_total', kind='soft'))
+
+    if isinstance(engine.pool, QueuePool):
+        metrics.describe('db_pool_size', 'Configured pool size')
+        metrics.describe('db_pool_checked_out', 'Connections currently checked out')
+        metrics.describe('db_pool_overflow', 'Connections open beyond pool_size')
+        # Read through the engine: dispose() replaces the pool object
+        metrics.gauge('db_pool_size', lambda: engine.pool.size())
+        metrics.gauge('db_pool_checked_out', lambda: engine.pool.checkedout())
+        metrics.gauge('db_pool_overflow', lambda: max(engine.pool.overflow(), 0))
+
+def make_engine(settings, prefix='sqlalchemy.', metrics=None, wait_warning_ms=None):
+    """Create the engine configured by the `sqlalchemy.*` settings.
+
+    With the psycopg (v3) driver, repeated statements are prepared on the
+    server; `db.prepare_threshold` sets after how many executions, and
+    `none` disables it, which is required behind a transaction-pooling
+    PgBouncer. psycopg2, which SQLAlchemy picks for plain `postgresql://`
+    URLs, has no server-side prepared statements; use
+    `postgresql+psycopg://` for them.
+    """
+    kwargs = {}
+    url = make_url(settings[prefix + 'url'])
+    pool_class = url.get_dialect().get_pool_class(url)
+    kwargs.update(pool_options(settings, prefix, pool_class))
+    if pool_class is QueuePool:
+        kwargs['poolclass'] = MeteredQueuePool
+
+    if url.get_backend_name() == 'postgresql' and url.get_driver_name() == 'psycopg':
+        threshold = settings.get('db.prepare_threshold', str(DEFAULT_PREPARE_THRESHOLD))
+        kwargs['connect_args'] = {
+            'prepare_threshold': None if threshold.lower() == 'none' else int(threshold)
+        }
+    elif url.get_backend_name() == 'postgresql' and 'db.prepare_threshold' in settings:
+        log.warning('db.prepare_threshold has no effect with the %s driver; '
+                    'use a postgresql+psycopg:// URL', url.get_driver_name())
+
+    engine = engine_from_config(settings, prefix=prefix, **kwargs)
+    if isinstance(engine.pool, MeteredQueuePool):
+        engine.pool.metrics = metrics
+        if wait_warning_ms is not None:
+            engine.pool.wait_warning = wait_warning_ms / 1000
+    if metrics is not None:
+        instrument_pool(engine, metrics)
+    return engine
+
+class PoolWarmer:
+    """Open the pool's connections before the first requests need them.
+
+    Runs in a background thread started by the readiness probe, which
+    reports the application as not ready until the pool is warm. Started
+    per process so that forked workers warm their own pool.
+    """
+
+    def __init__(self, engine, connections, retry_interval=5):
+        self.engine = engine
+        self.connections = connections
+        self.retry_interval = retry_interval
+        self.ready = connections == 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        if self.connections == 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.ready = False
+            thread = threading.Thread(target=self._run, name='pool-warmer', daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.warm()
+                return
+            except Exception as e:
+                log.warning('Connection pool warm-up failed, retrying in %ss: %s', self.retry_interval, e)
+                time.sleep(self.retry_interval)
+
+    def warm(self):
+        """Check out `connections` connections at once, then return them."""
+        started = time.perf_counter()
+        opened = []
+        try:
+            for _ in range(self.connections):
+                opened.append(self.engine.connect())
+        finally:
+            for connection in opened:
+                connection.close()
+        self.ready = True
+        log.info('Opened %d database connections in %.0f ms',
+                 self.connections, (time.perf_counter() - started) * 1000)
+
+def includeme(config):
+    settings = config.get_settings()
+    wait_warning_ms = settings.get('db.pool_wait_warning_ms')
+    engine = make_engine(
+        settings,
+        metrics=getattr(config.registry, 'metrics', None),
+        wait_warning_ms=float(wait_warning_ms) if wait_warning_ms else None,
+    )
+    config.registry.dbengine = engine
+    config.registry.dbmaker = sessionmaker(bind=engine)
+
+    # A forked worker must not reuse the parent's pooled connections. With
+    # close=False the parent's connections are left alone for the parent.
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+    # Warm the whole steady-state pool unless configured otherwise
+    default_warm = engine.pool.size() if isinstance(engine.pool, QueuePool) else 0
+    warm = int(settings.get('db.pool_warm_connections', default_warm))
+    if isinstance(engine.pool, QueuePool):
+        warm = min(warm, engine.pool.size())
+    config.registry.pool_warmer = PoolWarmer(engine, warm)
@@ -0,0 +1,107 @@
+"""Cheap health and readiness checks for load balancers.
+
+The readiness check never inspects the database schema on the request
+path. A background thread refreshes a cached schema/migration check and
+`/readyz` only reads the cached result plus the pool counters.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from .models import Base
+
+log = logging.getLogger(__name__)
+
+def pool_status(engine):
+    """Return the pool counters and whether every connection is in use."""
+    pool = engine.pool
+    status = {'class': type(pool).__name__}
+    if not hasattr(pool, 'checkedout'):
+        return status
+    
+    status.update({
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+        'max_overflow': getattr(pool, '_max_overflow', 0),
+    })
+    capacity = status['size'] + max(status['max_overflow'], 0)
+    status['saturated'] = status['max_overflow'] >= 0 and status['checked_out'] >= capacity
+    return status
+
+class SchemaCheck:
+    """Periodically verify that the tables and migrations match the code."""
+    
+    def __init__(self, engine, interval):
+        self.engine = engine
+        self.interval = interval
+        # Read by the first refresh: loading alembic costs ~150 ms at startup
+        self.expected_revisions = None
+        self.result = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _script_heads():
+        from alembic.config import Config
+        from alembic.script import ScriptDirectory
+        config = Config()
+        config.set_main_option('script_location', 'ecommerce_api:alembic')
+        return set(ScriptDirectory.from_config(config).get_heads())
+    
+    def ensure_running(self):
+        """Start the refresh thread in this process if it is not running.
+        
+        Checked on every call so that worker processes forked from a
+        preloaded application start their own thread.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.result = None
+            thread = threading.Thread(target=self._run, name='schema-check', daemon=True)
+            thread.start()
+    
+    def _run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+    
+    def refresh(self):
+        """Run the check now and cache the result."""
+        result = {'checked_at': datetime.utcnow().isoformat()}
+        try:
+            if self.expected_revisions is None:
+                self.expected_revisions = self._script_heads()
+            with self.engine.connect() as connection:
+                tables = set(inspect(connection).get_table_names())
+                revisions = set()
+                if 'alembic_version' in tables:
+                    revisions = set(connection.execute(
+                        text('SELECT version_num FROM alembic_version')
+                    ).scalars())
+            missing = sorted(set(Base.metadata.tables) - tables)
+            result.update({
+                'ok': not missing and revisions == self.expected_revisions,
+                'missing_tables': missing,
+                'revision': sorted(revisions),
+                'expected_revision': sorted(self.expected_revisions),
+            })
+        except Exception as e:
+            log.warning('Schema check failed: %s', e)
+            result.update({'ok': False, 'error': str(e)})
+        self.result = result
+        return result
+
+def includeme(config):
+    settings = config.get_settings()
+    interval = float(settings.get('health.schema_check_interval', 30))
+    config.registry.schema_check = SchemaCheck(config.registry.dbengine, interval)
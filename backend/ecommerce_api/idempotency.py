@@ -0,0 +1,310 @@
+"""`Idempotency-Key` support for POST requests.
+
+A client that retries a request sends the same `Idempotency-Key` header
+each time. The first request with a key claims it by inserting a row in
+`idempotency_keys`, runs as usual, and its response is stored in the same
+transaction as the changes it made. A later request with the key:
+
+- gets the stored response replayed, with `Idempotent-Replayed: true`,
+  without running the view;
+- waits while the first request is still in flight, then gets its
+  response (409 if it takes longer than `idempotency.wait_timeout`);
+- is refused with 422 if its method, path or body differ from the first.
+
+The replayed response has the stored status, body and the headers in
+REPLAYED_HEADERS. Responses that log a user in or out set the session
+cookie, which must not be stored, so `idempotency.exclude_paths` (the
+auth routes by default) ignore the header. Keys are scoped per user;
+elsewhere, a request with a key and no logged-in user gets 400.
+
+Server errors are not stored: the key is released so a retry runs the
+request again. Keys expire after `idempotency.ttl_hours` and are deleted
+by the purge_idempotency_keys script.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from pyramid.httpexceptions import HTTPBadRequest, HTTPConflict, HTTPUnprocessableEntity
+from pyramid.response import Response
+from pyramid.settings import aslist
+from pyramid.tweens import EXCVIEW
+from sqlalchemy import bindparam, delete, select, update
+from sqlalchemy.exc import IntegrityError
+from zope.sqlalchemy import mark_changed
+
+from .models.idempotency import IdempotencyKey
+
+log = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# Response headers stored with the body, besides Content-Type
+REPLAYED_HEADERS = ('ETag', 'Location', 'Last-Modified')
+
+KEY_BY_SCOPE = select(IdempotencyKey).where(
+    IdempotencyKey.scope == bindparam('scope'),
+    IdempotencyKey.key == bindparam('key'),
+)
+
+# The attempt holding a key: its row id and lock token
+Claim = namedtuple('Claim', 'id token scope key')
+
+def request_scope(request):
+    """Return the key space of the request's user, or None if nobody is logged in."""
+    user_id = request.authenticated_userid
+    return f'user:{user_id}' if user_id else None
+
+def request_fingerprint(request):
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path_qs}\n'.encode('utf-8'))
+    digest.update(request.body)
+    return digest.hexdigest()
+
+def replay(row):
+    response = Response(body=row.response_body or b'', status=row.response_status)
+    if row.response_content_type:
+        response.headers['Content-Type'] = row.response_content_type
+    else:
+        del response.content_type
+    for name, value in row.response_headers or ():
+        response.headers[name] = value
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+class IdempotencyStore:
+    """Claims keys, stores responses and lets duplicate requests wait."""
+
+    def __init__(self, dbmaker, ttl, lock_timeout, wait_timeout, metrics=None):
+        self.dbmaker = dbmaker
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.metrics = metrics
+        # (scope, key) -> Event set when the attempt in this process ends,
+        # so local duplicates wake up at once instead of at the next poll
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def begin(self, scope, key, fingerprint):
+        """Claim the key, or return the response to send instead.
+
+        Returns a Claim when the request should run.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        delay = 0.02
+        waited = False
+        while True:
+            outcome = self._try_claim(scope, key, fingerprint)
+            if outcome is not None:
+                if waited and not isinstance(outcome, Claim):
+                    self._count('idempotency_waits_total')
+                return outcome
+
+            # Another attempt is in flight
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._count('idempotency_conflicts_total')
+                response = HTTPConflict(json={
+                    'error': f'A request with this {HEADER} is still in progress'
+                })
+                response.headers['Retry-After'] = '1'
+                return response
+            waited = True
+            self._wait(scope, key, min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+    def _try_claim(self, scope, key, fingerprint):
+        """Return a Claim, a response, or None while another attempt is in flight."""
+        session = self.dbmaker()
+        try:
+            row = session.scalars(KEY_BY_SCOPE, {'scope': scope, 'key': key}).first()
+            now = datetime.utcnow()
+
+            if row is not None and row.expires_at <= now:
+                session.delete(row)
+                session.commit()
+                row = None
+
+            if row is None:
+                token = uuid.uuid4().hex
+                row = IdempotencyKey(
+                    scope=scope, key=key, fingerprint=fingerprint,
+                    lock_token=token, locked_at=now, expires_at=now + self.ttl,
+                )
+                session.add(row)
+                try:
+                    session.commit()
+                except IntegrityError:
+                    # Claimed by a concurrent request: wait for it
+                    session.rollback()
+                    return None
+                return Claim(row.id, token, scope, key)
+
+            if row.fingerprint != fingerprint:
+                return HTTPUnprocessableEntity(json={
+                    'error': f'This {HEADER} was already used for a different request'
+                })
+
+            if row.response_status is not None:
+                self._count('idempotency_replays_total')
+                return replay(row)
+
+            if row.locked_at <= now - self.lock_timeout:
+                # The process running the first attempt died without
+                # releasing the key
+                token = uuid.uuid4().hex
+                taken = session.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.id == row.id, IdempotencyKey.lock_token == row.lock_token)
+                    .values(lock_token=token, locked_at=now)
+                ).rowcount
+                session.commit()
+                if taken:
+                    log.warning('Took over %s %r from a stale attempt', HEADER, key)
+                    return Claim(row.id, token, scope, key)
+            return None
+        finally:
+            session.close()
+
+    def _wait(self, scope, key, timeout):
+        with self._lock:
+            event = self._finished.get((scope, key))
+        if event is None:
+            time.sleep(timeout)
+        else:
+            event.wait(timeout)
+
+    def started(self, claim):
+        with self._lock:
+            self._finished[(claim.scope, claim.key)] = threading.Event()
+
+    def finished(self, claim):
+        with self._lock:
+            event = self._finished.pop((claim.scope, claim.key), None)
+        if event is not None:
+            event.set()
+
+    def complete(self, dbsession, claim, response):
+        """Store `response` in the request's transaction.
+
+        Returns False if the claim was taken over meanwhile.
+        """
+        # The request may not have changed anything else, and an unchanged
+        # session is rolled back rather than committed
+        mark_changed(dbsession)
+        return dbsession.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.id == claim.id, IdempotencyKey.lock_token == claim.token)
+            .values(
+                lock_token=None,
+                response_status=response.status_code,
+                response_content_type=response.headers.get('Content-Type'),
+                response_body=response.body,
+                response_headers=[
+                    [name, response.headers[name]] for name in REPLAYED_HEADERS
+                    if name in response.headers
+                ],
+            )
+        ).rowcount == 1
+
+    def release(self, claim):
+        """Delete the key so that a retry runs the request again."""
+        session = self.dbmaker()
+        try:
+            session.execute(
+                delete(IdempotencyKey)
+                .where(IdempotencyKey.id == claim.id, IdempotencyKey.lock_token == claim.token)
+            )
+            session.commit()
+        except Exception:
+            log.exception('Could not release %s %r', HEADER, claim.key)
+        finally:
+            session.close()
+        self.finished(claim)
+
+def idempotency_tween_factory(handler, registry):
+    """Apply `Idempotency-Key` to the configured methods.
+
+    Runs inside the pyramid_tm transaction so that the stored response
+    commits or rolls back together with the request's changes.
+    """
+    store = registry.idempotency
+    methods = registry.idempotency_methods
+    exclude_paths = registry.idempotency_exclude_paths
+
+    def idempotency_tween(request):
+        key = request.headers.get(HEADER)
+        if key is None or request.method not in methods or request.path in exclude_paths:
+            return handler(request)
+        if not key.strip() or len(key) > MAX_KEY_LENGTH:
+            return HTTPBadRequest(json={
+                'error': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'
+            })
+        scope = request_scope(request)
+        if scope is None:
+            # Anonymous clients cannot be told apart, so their keys would collide
+            return HTTPBadRequest(json={'error': f'{HEADER} requires a logged-in user'})
+
+        claim = store.begin(scope, key, request_fingerprint(request))
+        if not isinstance(claim, Claim):
+            return claim
+
+        store.started(claim)
+        # Non-empty once the key no longer needs releasing
+        settled = []
+
+        def end_attempt(request):
+            # Runs once the transaction has ended; releasing earlier could
+            # block on locks the request's own transaction still holds
+            if settled:
+                store.finished(claim)
+            else:
+                store.release(claim)
+        request.add_finished_callback(end_attempt)
+
+        response = handler(request)
+        if response.status_code >= 500:
+            return response
+
+        if not store.complete(request.db, claim, response):
+            # Another attempt took the key over: roll this one back
+            request.tm.doom()
+            settled.append('taken over')
+            return HTTPConflict(json={
+                'error': f'A request with this {HEADER} is still in progress'
+            })
+
+        request.tm.get().addAfterCommitHook(lambda success: success and settled.append('stored'))
+        return response
+
+    return idempotency_tween
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.idempotency = IdempotencyStore(
+        config.registry.dbmaker,
+        ttl=timedelta(hours=float(settings.get('idempotency.ttl_hours', 24))),
+        lock_timeout=timedelta(seconds=float(settings.get('idempotency.lock_timeout', 60))),
+        wait_timeout=float(settings.get('idempotency.wait_timeout', 10)),
+        metrics=getattr(config.registry, 'metrics', None),
+    )
+    config.registry.idempotency_methods = frozenset(
+        method.upper() for method in aslist(settings.get('idempotency.methods', 'POST'))
+    )
+    config.registry.idempotency_exclude_paths = frozenset(aslist(settings.get(
+        'idempotency.exclude_paths', '/api/auth/login /api/auth/register /api/auth/logout'
+    )))
+    config.add_tween(
+        'ecommerce_api.idempotency.idempotency_tween_factory',
+        under='pyramid_tm.tm_tween_factory',
+        over=EXCVIEW,
+    )
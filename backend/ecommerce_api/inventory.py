@@ -0,0 +1,496 @@
+"""Product stock kept in several counter slots, with reservations and a ledger.
+
+Each product's stock is split across `inventory.slots` rows of
+`stock_slots`. A checkout takes its quantity from one slot chosen at
+random with a conditional UPDATE, so buyers of a popular product lock
+different rows instead of all queueing on the product row. On PostgreSQL
+slots locked by other transactions are skipped. Only when no single slot
+holds enough are all of the product's slots locked and drawn from
+together.
+
+Every change is appended to `stock_movements`; a product's movements add
+up to its stock. Cart reservations take stock at once and give it back
+when they are released or expire.
+
+A background thread per process expires reservations, evens out the
+slots of products whose stock moved and refreshes `Product.stock`, which
+is therefore a total that usually lags checkouts by up to
+`inventory.maintenance_interval` seconds, and at worst by an hour.
+
+Products get their slots when created, or on first use from the stock
+they already have (for example after import_products).
+"""
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, func, select, text, update
+
+from .changefeed import record_changes
+from .models.inventory import InventoryState, StockMovement, StockReservation, StockSlot
+from .models.product import Product
+
+log = logging.getLogger(__name__)
+
+# Reservations expired per transaction by the maintenance thread
+EXPIRE_BATCH_SIZE = 500
+# Movements are created before their transaction commits, so each pass
+# also reads those created this long before the previous pass started
+RESCAN_MARGIN = timedelta(minutes=2)
+# Passes over every product with slots, in case a movement committed
+# later than that
+FULL_PASS_INTERVAL = timedelta(hours=1)
+STATE_ID = 1
+# dbsession.info key of the products whose slots are cached on commit
+PENDING_KEY = 'inventory_slots_pending'
+# Key of the PostgreSQL advisory lock held while rebalancing, so only one
+# process does it at a time
+REBALANCE_LOCK_KEY = 0x1A5E7
+
+class OutOfStock(Exception):
+    def __init__(self, product_id, requested, available):
+        super().__init__(f'Product {product_id}: {requested} requested, {available} available')
+        self.product_id = product_id
+        self.requested = requested
+        self.available = available
+
+class ReservationError(Exception):
+    """A reservation that cannot be used or released by this request."""
+
+def split(total, parts):
+    """Split `total` into `parts` near-equal non-negative integers."""
+    base, extra = divmod(max(total, 0), parts)
+    return [base + 1 if index < extra else base for index in range(parts)]
+
+class Inventory:
+    """Stock changes in the caller's transaction, plus background maintenance."""
+
+    def __init__(self, engine, dbmaker, slots, reservation_ttl, maintenance_interval, metrics=None):
+        self.engine = engine
+        self.dbmaker = dbmaker
+        self.slots = slots
+        self.reservation_ttl = reservation_ttl
+        self.maintenance_interval = maintenance_interval
+        self.metrics = metrics
+        # Products known to have their slots, to skip the check
+        self._initialized = set()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.incr(name, value)
+
+    @staticmethod
+    def _skip_locked(dbsession):
+        return dbsession.bind.dialect.name == 'postgresql'
+
+    def _record(self, dbsession, product_id, quantity, reason, order_id=None, reservation_id=None):
+        dbsession.add(StockMovement(
+            product_id=product_id, quantity=quantity, reason=reason,
+            order_id=order_id, reservation_id=reservation_id,
+        ))
+
+    def initialize(self, dbsession, product_id, quantity):
+        """Create the slots of a new product holding `quantity` in total."""
+        dbsession.execute(StockSlot.__table__.insert(), [
+            {'product_id': product_id, 'slot': slot, 'quantity': share}
+            for slot, share in enumerate(split(quantity, self.slots))
+        ])
+        self._record(dbsession, product_id, max(quantity, 0), 'initial')
+
+    def ensure_slots(self, dbsession, product_id):
+        """Create the product's slots from `Product.stock` if it has none.
+
+        Returns False if the product does not exist.
+        """
+        if product_id in self._initialized:
+            return True
+        has_slots = select(StockSlot.slot).where(StockSlot.product_id == product_id).limit(1)
+        if dbsession.execute(has_slots).first() is not None:
+            # The slots may have been created by this very transaction
+            self._cache_on_commit(dbsession, product_id)
+            return True
+        # The product row lock makes concurrent first uses wait for the
+        # one creating the slots
+        stock = dbsession.execute(
+            select(Product.stock).where(Product.id == product_id).with_for_update()
+        ).first()
+        if stock is None:
+            return False
+        if dbsession.execute(has_slots).first() is None:
+            self.initialize(dbsession, product_id, stock[0] or 0)
+        self._cache_on_commit(dbsession, product_id)
+        return True
+
+    def _cache_on_commit(self, dbsession, product_id):
+        """Remember that the product has slots once the transaction commits.
+
+        Slots created by a transaction that rolls back would otherwise be
+        assumed to exist, and every later take() of the product would fail.
+        """
+        pending = dbsession.info.get(PENDING_KEY)
+        if pending is None:
+            pending = dbsession.info[PENDING_KEY] = set()
+            event.listen(dbsession, 'after_commit', self._commit_pending)
+            event.listen(dbsession, 'after_soft_rollback', self._discard_pending)
+        pending.add(product_id)
+
+    def _commit_pending(self, dbsession):
+        pending = dbsession.info[PENDING_KEY]
+        self._initialized.update(pending)
+        pending.clear()
+
+    @staticmethod
+    def _discard_pending(dbsession, previous_transaction):
+        dbsession.info[PENDING_KEY].clear()
+
+    def forget(self, dbsession, product_id):
+        """Delete a deleted product's slots. Its ledger is kept."""
+        dbsession.execute(delete(StockSlot).where(StockSlot.product_id == product_id))
+        self._initialized.discard(product_id)
+        dbsession.info.get(PENDING_KEY, set()).discard(product_id)
+
+    def _pick_unlocked_slot(self, dbsession, product_id, quantity):
+        return dbsession.execute(
+            select(StockSlot.slot)
+            .where(StockSlot.product_id == product_id, StockSlot.quantity >= quantity)
+            .order_by(func.random())
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar()
+
+    def take(self, dbsession, product_id, quantity, reason, order_id=None, reservation_id=None):
+        """Remove `quantity` from the product's stock, raising OutOfStock."""
+        self.ensure_running()
+        if not self.ensure_slots(dbsession, product_id):
+            raise OutOfStock(product_id, quantity, 0)
+
+        taken = False
+        if self._skip_locked(dbsession):
+            slot = self._pick_unlocked_slot(dbsession, product_id, quantity)
+            if slot is not None:
+                dbsession.execute(
+                    update(StockSlot)
+                    .where(StockSlot.product_id == product_id, StockSlot.slot == slot)
+                    .values(quantity=StockSlot.quantity - quantity)
+                )
+                taken = True
+        if not taken:
+            # Every slot is busy or too small: try each one, waiting for locks
+            for slot in random.sample(range(self.slots), self.slots):
+                taken = dbsession.execute(
+                    update(StockSlot)
+                    .where(StockSlot.product_id == product_id, StockSlot.slot == slot,
+                           StockSlot.quantity >= quantity)
+                    .values(quantity=StockSlot.quantity - quantity)
+                ).rowcount == 1
+                if taken:
+                    break
+        if not taken:
+            self._take_across_slots(dbsession, product_id, quantity)
+
+        self._record(dbsession, product_id, -quantity, reason, order_id, reservation_id)
+
+    def _lock_slots(self, dbsession, product_id):
+        """Return the product's (slot, quantity) rows, locked."""
+        # Locked in slot order, like every multi-slot update, to avoid deadlocks
+        statement = (
+            select(StockSlot.slot, StockSlot.quantity)
+            .where(StockSlot.product_id == product_id)
+            .order_by(StockSlot.slot)
+            .with_for_update()
+        )
+        slots = dbsession.execute(statement).all()
+        if not slots and product_id in self._initialized:
+            # Cached before an import in another process replaced the
+            # catalog; the product (maybe a new one with the old id) has
+            # no slots yet
+            self._initialized.discard(product_id)
+            if self.ensure_slots(dbsession, product_id):
+                slots = dbsession.execute(statement).all()
+        return slots
+
+    def _take_across_slots(self, dbsession, product_id, quantity):
+        slots = self._lock_slots(dbsession, product_id)
+        available = sum(share for _, share in slots)
+        if available < quantity:
+            self._count('inventory_out_of_stock_total')
+            raise OutOfStock(product_id, quantity, available)
+        self._count('inventory_multi_slot_takes_total')
+
+        remaining = quantity
+        for slot, share in sorted(slots, key=lambda row: -row[1]):
+            part = min(share, remaining)
+            dbsession.execute(
+                update(StockSlot)
+                .where(StockSlot.product_id == product_id, StockSlot.slot == slot)
+                .values(quantity=StockSlot.quantity - part)
+            )
+            remaining -= part
+            if not remaining:
+                break
+
+    def give(self, dbsession, product_id, quantity, reason, order_id=None, reservation_id=None):
+        """Add `quantity` back to the product's stock.
+
+        Returns False, recording nothing, if the product no longer exists.
+        """
+        if not self.ensure_slots(dbsession, product_id):
+            return False
+        slot = None
+        if self._skip_locked(dbsession):
+            slot = self._pick_unlocked_slot(dbsession, product_id, 0)
+        if slot is None:
+            slot = random.randrange(self.slots)
+        add = update(StockSlot).values(quantity=StockSlot.quantity + quantity)
+        given = dbsession.execute(
+            add.where(StockSlot.product_id == product_id, StockSlot.slot == slot)
+        ).rowcount
+        if not given:
+            # Created with fewer slots than inventory.slots now says
+            dbsession.execute(add.where(
+                StockSlot.product_id == product_id,
+                StockSlot.slot == select(func.min(StockSlot.slot))
+                .where(StockSlot.product_id == product_id).scalar_subquery()
+            ))
+        self._record(dbsession, product_id, quantity, reason, order_id, reservation_id)
+        return True
+
+    def set_stock(self, dbsession, product_id, quantity):
+        """Set the product's total stock, e.g. after a stock count."""
+        self.ensure_slots(dbsession, product_id)
+        slots = self._lock_slots(dbsession, product_id)
+        current = sum(share for _, share in slots)
+        for (slot, _), share in zip(slots, split(quantity, len(slots))):
+            dbsession.execute(
+                update(StockSlot)
+                .where(StockSlot.product_id == product_id, StockSlot.slot == slot)
+                .values(quantity=share)
+            )
+        if quantity != current:
+            self._record(dbsession, product_id, quantity - current, 'adjust')
+
+    def available(self, dbsession, product_id):
+        """Return the product's current stock, summed over its slots."""
+        if not self.ensure_slots(dbsession, product_id):
+            return 0
+        return dbsession.execute(
+            select(func.coalesce(func.sum(StockSlot.quantity), 0))
+            .where(StockSlot.product_id == product_id)
+        ).scalar()
+
+    def reserve(self, dbsession, user_id, product_id, quantity):
+        """Hold `quantity` for the user's cart, raising OutOfStock."""
+        reservation = StockReservation(
+            product_id=product_id, user_id=user_id, quantity=quantity, status='held',
+            expires_at=datetime.utcnow() + self.reservation_ttl,
+        )
+        dbsession.add(reservation)
+        dbsession.flush()
+        self.take(dbsession, product_id, quantity, 'reserve', reservation_id=reservation.id)
+        return reservation
+
+    def _held_reservation(self, dbsession, reservation_id, user_id):
+        reservation = dbsession.get(StockReservation, reservation_id, with_for_update=True)
+        if reservation is None or reservation.user_id != user_id:
+            raise ReservationError(f'Reservation {reservation_id} not found')
+        if reservation.status != 'held' or reservation.expires_at <= datetime.utcnow():
+            raise ReservationError(f'Reservation {reservation_id} has expired or was already used')
+        return reservation
+
+    def release(self, dbsession, reservation_id, user_id):
+        """Give a held reservation's stock back, raising ReservationError."""
+        reservation = self._held_reservation(dbsession, reservation_id, user_id)
+        reservation.status = 'released'
+        self.give(dbsession, reservation.product_id, reservation.quantity, 'release',
+                  reservation_id=reservation.id)
+        return reservation
+
+    def use_reservation(self, dbsession, reservation_id, user_id, product_id, quantity, order_id):
+        """Turn a held reservation into an order item; its stock is already taken."""
+        reservation = self._held_reservation(dbsession, reservation_id, user_id)
+        if reservation.product_id != product_id or reservation.quantity != quantity:
+            raise ReservationError(f'Reservation {reservation_id} is for a different product or quantity')
+        reservation.status = 'ordered'
+        reservation.order_id = order_id
+        return reservation
+
+    def ensure_running(self):
+        """Start the maintenance thread in this process if it is not running.
+
+        Checked on every call so that worker processes forked from a
+        preloaded application start their own thread.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='inventory', daemon=True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.expire_reservations()
+                self.rebalance()
+            except Exception as e:
+                log.warning('Inventory maintenance failed: %s', e)
+            time.sleep(self.maintenance_interval)
+
+    def expire_reservations(self):
+        """Give back the stock of held reservations past their expiry."""
+        expired = 0
+        while True:
+            session = self.dbmaker()
+            try:
+                with session.begin():
+                    reservations = session.scalars(
+                        select(StockReservation)
+                        .where(StockReservation.status == 'held',
+                               StockReservation.expires_at <= datetime.utcnow())
+                        .order_by(StockReservation.expires_at)
+                        .limit(EXPIRE_BATCH_SIZE)
+                        .with_for_update(skip_locked=True)
+                    ).all()
+                    for reservation in reservations:
+                        reservation.status = 'expired'
+                        self.give(session, reservation.product_id, reservation.quantity, 'expire',
+                                  reservation_id=reservation.id)
+            finally:
+                session.close()
+            expired += len(reservations)
+            if len(reservations) < EXPIRE_BATCH_SIZE:
+                break
+        if expired:
+            self._count('inventory_reservations_expired_total', expired)
+            log.info('Expired %d stock reservations', expired)
+        return expired
+
+    def rebalance(self):
+        """Even out the slots of products whose stock moved and refresh Product.stock.
+
+        A pass covers the products with movements created since the
+        previous pass started, less RESCAN_MARGIN for transactions that
+        committed after it, and every FULL_PASS_INTERVAL all products with
+        slots. Where it got to is kept in `inventory_state`, shared by all
+        processes.
+        """
+        postgresql = self.engine.dialect.name == 'postgresql'
+        products = []
+        # One connection throughout, as it holds the advisory lock
+        with self.engine.connect() as connection:
+            session = self.dbmaker(bind=connection)
+            try:
+                if postgresql:
+                    locked = session.execute(
+                        text('SELECT pg_try_advisory_lock(:key)'), {'key': REBALANCE_LOCK_KEY}
+                    ).scalar()
+                    session.commit()
+                    if not locked:
+                        return 0
+                try:
+                    started = datetime.utcnow()
+                    state = session.get(InventoryState, STATE_ID)
+                    full = (state is None or state.rebalanced_at is None or state.full_pass_at is None
+                            or state.full_pass_at <= started - FULL_PASS_INTERVAL)
+                    if full:
+                        products = session.scalars(select(StockSlot.product_id).distinct()).all()
+                    else:
+                        products = session.scalars(
+                            select(StockMovement.product_id).distinct()
+                            .where(StockMovement.created_at >= state.rebalanced_at - RESCAN_MARGIN)
+                        ).all()
+                    session.commit()
+                    skipped = 0
+                    for product_id in products:
+                        # One transaction per product: the slots of a busy
+                        # product are only locked while they are rewritten
+                        skipped += not self._rebalance_product(session, product_id)
+                        session.commit()
+                    if not skipped:
+                        # Otherwise the next pass reads the same movements again
+                        self._save_pass(session, started, full)
+                        session.commit()
+                finally:
+                    if postgresql:
+                        session.rollback()
+                        session.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': REBALANCE_LOCK_KEY})
+                        session.commit()
+            finally:
+                session.close()
+        return len(products)
+
+    @staticmethod
+    def _save_pass(session, started, full):
+        state = session.get(InventoryState, STATE_ID)
+        if state is None:
+            state = InventoryState(id=STATE_ID)
+            session.add(state)
+        state.rebalanced_at = started
+        if full:
+            state.full_pass_at = started
+
+    def _rebalance_product(self, session, product_id):
+        """Rebalance and refresh one product; False if it was skipped."""
+        # The product row first, like update_product and the first use
+        # of a product; one being edited is left for the next pass
+        if session.execute(
+            select(Product.id).where(Product.id == product_id).with_for_update(skip_locked=True)
+        ).first() is None:
+            # Locked, or deleted: then there is nothing to refresh
+            return not session.execute(
+                select(func.count()).select_from(Product).where(Product.id == product_id)
+            ).scalar()
+        # Slots locked by checkouts are left out; moving stock between the
+        # others keeps the product's total unchanged
+        locked = session.execute(
+            select(StockSlot.slot, StockSlot.quantity)
+            .where(StockSlot.product_id == product_id)
+            .order_by(StockSlot.slot)
+            .with_for_update(skip_locked=True)
+        ).all()
+        shares = [share for _, share in locked]
+        if len(locked) > 1 and max(shares) - min(shares) > 1:
+            for (slot, share), target in zip(locked, split(sum(shares), len(locked))):
+                if share != target:
+                    session.execute(
+                        update(StockSlot)
+                        .where(StockSlot.product_id == product_id, StockSlot.slot == slot)
+                        .values(quantity=target)
+                    )
+            self._count('inventory_rebalances_total')
+
+        total = session.execute(
+            select(func.coalesce(func.sum(StockSlot.quantity), 0))
+            .where(StockSlot.product_id == product_id)
+        ).scalar()
+        refreshed = session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.stock.is_distinct_from(total))
+            .values(stock=total, updated_at=Product.updated_at)
+        ).rowcount
+        if refreshed:
+            # Synced catalogues show the stock too
+            record_changes(session, [product_id])
+        return True
+
+def includeme(config):
+    settings = config.get_settings()
+    slots = int(settings.get('inventory.slots', 8))
+    if slots < 1:
+        from pyramid.exceptions import ConfigurationError
+        raise ConfigurationError(f'inventory.slots must be at least 1, got {slots}')
+    config.registry.inventory = Inventory(
+        config.registry.dbengine,
+        config.registry.dbmaker,
+        slots=slots,
+        reservation_ttl=timedelta(seconds=float(settings.get('inventory.reservation_ttl', 900))),
+        maintenance_interval=float(settings.get('inventory.maintenance_interval', 30)),
+        metrics=getattr(config.registry, 'metrics', None),
+    )
@@ -0,0 +1,220 @@
+"""Memory profiling with tracemalloc, driven from the admin API.
+
+Enabled by `memprof.enabled`; otherwise nothing is installed and the
+admin endpoints answer 404. Even when enabled, tracemalloc only runs
+between `POST /api/admin/memory/start` and `/stop`, as it slows every
+allocation down. While it runs:
+
+- snapshots can be taken (`POST /api/admin/memory/snapshots`, the last
+  `memprof.max_snapshots` are kept) and diffed to find what grew;
+- a `memprof.sample_rate` share of requests is measured by a tween under
+  pyramid_tm: the peak of traced memory during the request above where
+  it started, the memory still held when the view returned (result
+  sets, identity map, serialized dicts; the session is closed after
+  this), and the allocation sites of the latter, added up per route.
+
+The peak is process-wide: only one request is measured at a time, but
+other threads' allocations count too, so it is exact with one thread per
+worker and an upper bound otherwise. State is per process; every
+response names the pid that served it.
+"""
+import linecache
+import os
+import random
+import threading
+import time
+import tracemalloc
+from collections import Counter, deque
+
+from pyramid.settings import asbool
+
+from .process import current_rss
+
+# Allocations of the profiler itself
+IGNORED_FILES = (tracemalloc.__file__, linecache.__file__, '<frozen importlib._bootstrap>',
+                 '<unknown>')
+GROUPINGS = ('lineno', 'filename', 'traceback')
+PROFILER_PATH = '/api/admin/memory'
+
+def _filtered(snapshot):
+    return snapshot.filter_traces([tracemalloc.Filter(False, name) for name in IGNORED_FILES])
+
+def _site(stat_or_diff):
+    frame = stat_or_diff.traceback[0]
+    return f'{frame.filename}:{frame.lineno}'
+
+def describe_statistic(statistic, group_by):
+    """Return a Statistic or StatisticDiff as a dict."""
+    entry = {
+        'site': _site(statistic),
+        'sizeKb': round(statistic.size / 1024, 1),
+        'count': statistic.count,
+    }
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        entry['sizeDiffKb'] = round(statistic.size_diff / 1024, 1)
+        entry['countDiff'] = statistic.count_diff
+    if group_by == 'traceback':
+        entry['traceback'] = statistic.traceback.format()
+    return entry
+
+class RouteMemory:
+    """Measurements of a route's sampled requests."""
+
+    def __init__(self):
+        self.requests = 0
+        self.peak_total = 0
+        self.peak_max = 0
+        self.held_total = 0
+        self.sites = Counter()
+
+    def to_dict(self, top):
+        return {
+            'requests': self.requests,
+            'meanPeakKb': round(self.peak_total / self.requests / 1024, 1),
+            'maxPeakKb': round(self.peak_max / 1024, 1),
+            'meanHeldKb': round(self.held_total / self.requests / 1024, 1),
+            'topSites': [
+                {'site': site, 'meanKb': round(size / self.requests / 1024, 1)}
+                for site, size in self.sites.most_common(top)
+            ],
+        }
+
+class MemoryProfiler:
+    """tracemalloc sessions, snapshots and per-route request measurements."""
+
+    def __init__(self, sample_rate=0.1, frames=10, max_snapshots=5, sites_per_request=20):
+        self.sample_rate = sample_rate
+        self.frames = frames
+        self.sites_per_request = sites_per_request
+        self.snapshots = deque(maxlen=max_snapshots)
+        self.routes = {}
+        self.started_at = None
+        self._next_id = 1
+        self._lock = threading.Lock()
+        # Held by the request being measured
+        self._measuring = threading.Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=None):
+        with self._lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start(frames or self.frames)
+            self.started_at = time.time()
+            self.snapshots.clear()
+            self.routes = {}
+            return True
+
+    def stop(self):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                return False
+            tracemalloc.stop()
+            self.started_at = None
+            # Snapshots are useless without tracing and hold a lot of memory
+            self.snapshots.clear()
+            return True
+
+    def current_snapshot(self):
+        """Return a snapshot of now, without keeping it."""
+        return _filtered(tracemalloc.take_snapshot())
+
+    def take_snapshot(self, label=None):
+        snapshot = self.current_snapshot()
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            entry = {
+                'id': snapshot_id,
+                'label': label,
+                'takenAt': time.time(),
+                'tracedKb': round(sum(stat.size for stat in snapshot.statistics('filename')) / 1024, 1),
+                'rssKb': current_rss() // 1024,
+            }
+            self.snapshots.append((entry, snapshot))
+        return entry
+
+    def get_snapshot(self, snapshot_id):
+        for entry, snapshot in list(self.snapshots):
+            if entry['id'] == snapshot_id:
+                return snapshot
+        return None
+
+    def status(self):
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'pid': os.getpid(),
+            'tracing': self.tracing,
+            'startedAt': self.started_at,
+            'frames': tracemalloc.get_traceback_limit() if self.tracing else None,
+            'tracedKb': round(current / 1024, 1),
+            'tracedPeakKb': round(peak / 1024, 1),
+            'overheadKb': round(tracemalloc.get_tracemalloc_memory() / 1024, 1),
+            'rssKb': current_rss() // 1024,
+            'snapshots': [entry for entry, _ in self.snapshots],
+            'sampleRate': self.sample_rate,
+        }
+
+    def route_report(self, top=10):
+        with self._lock:
+            return {route: memory.to_dict(top) for route, memory in sorted(self.routes.items())}
+
+    def measure(self, request, handler):
+        """Run the request, measuring it if it is sampled and no other request is measured."""
+        if random.random() >= self.sample_rate or not self._measuring.acquire(blocking=False):
+            return handler(request)
+        try:
+            before = self.current_snapshot()
+            start, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            response = handler(request)
+            if not tracemalloc.is_tracing():
+                return response  # Stopped meanwhile
+            current, peak = tracemalloc.get_traced_memory()
+            after = self.current_snapshot()
+        finally:
+            self._measuring.release()
+
+        route = request.matched_route.name if request.matched_route is not None else '(unmatched)'
+        diff = after.compare_to(before, 'lineno')
+        with self._lock:
+            memory = self.routes.setdefault(route, RouteMemory())
+            memory.requests += 1
+            memory.peak_total += peak - start
+            memory.peak_max = max(memory.peak_max, peak - start)
+            memory.held_total += max(current - start, 0)
+            for statistic in diff[:self.sites_per_request]:
+                if statistic.size_diff > 0:
+                    memory.sites[_site(statistic)] += statistic.size_diff
+        return response
+
+def memprof_tween_factory(handler, registry):
+    """Measure sampled requests while tracemalloc is running."""
+    profiler = registry.memory_profiler
+
+    def memprof_tween(request):
+        # The profiler's own endpoints take snapshots of their own
+        if not tracemalloc.is_tracing() or request.path.startswith(PROFILER_PATH):
+            return handler(request)
+        return profiler.measure(request, handler)
+
+    return memprof_tween
+
+def includeme(config):
+    settings = config.get_settings()
+    if not asbool(settings.get('memprof.enabled', False)):
+        config.registry.memory_profiler = None
+        return
+
+    config.registry.memory_profiler = MemoryProfiler(
+        sample_rate=float(settings.get('memprof.sample_rate', 0.1)),
+        frames=int(settings.get('memprof.frames', 10)),
+        max_snapshots=int(settings.get('memprof.max_snapshots', 5)),
+    )
+    config.add_tween(
+        'ecommerce_api.memprof.memprof_tween_factory',
+        under='pyramid_tm.tm_tween_factory',
+    )
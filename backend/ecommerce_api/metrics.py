@@ -0,0 +1,123 @@
+"""In-process metrics: counters, callback gauges and histograms.
+
+Values live in the process that records them and are listed at
+/api/admin/metrics, as JSON or in the Prometheus text format with
+`?format=prometheus`.
+"""
+import bisect
+import threading
+
+# Upper bounds in milliseconds
+DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def series_key(name, labels):
+    """Return the Prometheus series name, e.g. `name{route="products"}`."""
+    if not labels:
+        return name
+    pairs = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': round(self.sum, 3), 'max': round(self.max, 3), 'buckets': buckets}
+
+class Metrics:
+    """Thread-safe registry of named metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def incr(self, name, value=1, **labels):
+        key = series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = series_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, callback):
+        """Register `callback()`, read whenever the metrics are collected."""
+        self._gauges[name] = callback
+
+    def _read_gauges(self):
+        values = {}
+        for name, callback in self._gauges.items():
+            try:
+                values[name] = callback()
+            except Exception:
+                values[name] = None
+        return values
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: histogram.to_dict() for key, histogram in self._histograms.items()}
+        return {'counters': counters, 'gauges': self._read_gauges(), 'histograms': histograms}
+
+    def prometheus(self):
+        """Return every metric in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def header(key, kind):
+            name = key.split('{', 1)[0]
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for key, value in sorted(snapshot['counters'].items()):
+            header(key, 'counter')
+            lines.append(f'{key} {value}')
+        for key, value in sorted(snapshot['gauges'].items()):
+            if value is None:
+                continue
+            header(key, 'gauge')
+            lines.append(f'{key} {value}')
+        for key, histogram in sorted(snapshot['histograms'].items()):
+            header(key, 'histogram')
+            name, _, labels = key.partition('{')
+            labels = labels.rstrip('}')
+            for bound, count in histogram['buckets'].items():
+                bucket_labels = ','.join(filter(None, [labels, f'le="{bound}"']))
+                lines.append(f'{name}_bucket{{{bucket_labels}}} {count}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{name}_sum{suffix} {histogram["sum"]}')
+            lines.append(f'{name}_count{suffix} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+def includeme(config):
+    config.registry.metrics = Metrics()
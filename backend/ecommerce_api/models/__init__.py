@@ -2,4 +2,7 @@
 from .base import Base, TimestampMixin
 from .user import User
 from .product import Product
-from .order import Order, OrderItem
+from .order import Order, OrderEvent, OrderItem
+from .idempotency import IdempotencyKey
+from .inventory import InventoryState, StockMovement, StockReservation, StockSlot
+from .changefeed import ChangeFeedState, ProductChange
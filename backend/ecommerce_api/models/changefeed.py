@@ -0,0 +1,37 @@
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Index, Integer
+
+from .base import Base
+
+class ProductChange(Base):
+    """A write to a product, for clients syncing the catalogue.
+    
+    Only a product's latest change is needed; compact_product_changes
+    deletes the ones superseded since, and tombstones once they are old.
+    """
+    __tablename__ = 'product_changes'
+    __table_args__ = (
+        # Finding the changes a product's latest one supersedes
+        Index('ix_product_changes_product_id_token', 'product_id', 'token'),
+    )
+    
+    # From ChangeFeedState.last_token, so in commit order
+    token = Column(BigInteger, primary_key=True, autoincrement=False)
+    # Not a foreign key: tombstones outlive their product
+    product_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ChangeFeedState(Base):
+    """The single row that hands out change tokens.
+    
+    Writers increment `last_token` and keep the row locked until they
+    commit. `horizon` is the oldest token the feed can still answer from:
+    a client that read less than that has missed deleted tombstones.
+    """
+    __tablename__ = 'change_feed_state'
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    last_token = Column(BigInteger, nullable=False, default=0)
+    horizon = Column(BigInteger, nullable=False, default=0)
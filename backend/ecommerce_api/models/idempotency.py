@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from sqlalchemy import JSON, Column, DateTime, Index, Integer, LargeBinary, String, UniqueConstraint
+
+from .base import Base
+
+class IdempotencyKey(Base):
+    """An `Idempotency-Key` sent by a client and the response to replay for it.
+    
+    A row is inserted when the first request with the key starts and holds
+    `lock_token` while that request is in flight. The response is stored
+    in the same transaction as the request's own changes.
+    """
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        UniqueConstraint('scope', 'key'),
+        # Purging expired keys
+        Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    # 'user:<id>': keys only need to be unique per client
+    scope = Column(String(64), nullable=False)
+    key = Column(String(255), nullable=False)
+    # SHA-256 of the method, path and body of the first request
+    fingerprint = Column(String(64), nullable=False)
+    # Identifies the attempt in flight; a lock older than the lock timeout
+    # belongs to a dead process and can be taken over
+    lock_token = Column(String(32), nullable=True)
+    locked_at = Column(DateTime, nullable=True)
+    # NULL while the first request is in flight
+    response_status = Column(Integer, nullable=True)
+    response_content_type = Column(String(255), nullable=True)
+    # [name, value] pairs of the headers in idempotency.REPLAYED_HEADERS
+    response_headers = Column(JSON, nullable=True)
+    response_body = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
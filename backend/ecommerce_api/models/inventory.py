@@ -0,0 +1,100 @@
+from datetime import datetime
+
+from sqlalchemy import CheckConstraint, Column, DateTime, Enum, ForeignKey, Index, Integer, String
+
+from .base import Base
+
+class StockSlot(Base):
+    """One share of a product's stock.
+    
+    A product's stock is split across several slots so that concurrent
+    checkouts of the same product lock different rows. `Product.stock` is
+    the total, refreshed in the background (see ecommerce_api.inventory).
+    """
+    __tablename__ = 'stock_slots'
+    __table_args__ = (
+        CheckConstraint('quantity >= 0', name='quantity_not_negative'),
+    )
+    
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    slot = Column(Integer, primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+
+class StockReservation(Base):
+    """Stock held for a customer's cart until it is ordered or expires."""
+    __tablename__ = 'stock_reservations'
+    __table_args__ = (
+        # Expiry sweep over the reservations still held
+        Index('ix_stock_reservations_status_expires_at', 'status', 'expires_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    # Not foreign keys: reservations outlive deleted products, and orders
+    # is partitioned on PostgreSQL
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    status = Column(Enum('held', 'ordered', 'released', 'expired', name='reservation_status'),
+                    nullable=False, default='held')
+    order_id = Column(Integer, nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'productId': self.product_id,
+            'quantity': self.quantity,
+            'status': self.status,
+            'orderId': self.order_id,
+            'expiresAt': self.expires_at.isoformat() if self.expires_at else None,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+        }
+
+class StockMovement(Base):
+    """Append-only ledger entry: one change to a product's stock.
+    
+    The quantities of a product's movements add up to its stock.
+    """
+    __tablename__ = 'stock_movements'
+    __table_args__ = (
+        # A product's history
+        Index('ix_stock_movements_product_id_id', 'product_id', 'id'),
+        # The rebalancer reading recent movements
+        Index('ix_stock_movements_created_at', 'created_at'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    # Signed: negative when stock leaves
+    quantity = Column(Integer, nullable=False)
+    # initial, adjust, order, reserve, release, expire, cancel
+    reason = Column(String(20), nullable=False)
+    order_id = Column(Integer, nullable=True)
+    reservation_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'productId': self.product_id,
+            'quantity': self.quantity,
+            'reason': self.reason,
+            'orderId': self.order_id,
+            'reservationId': self.reservation_id,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+        }
+
+class InventoryState(Base):
+    """The single row recording where the stock refresh got to.
+
+    Kept in the database so that a new process, such as a recycled
+    serve_prefork worker, carries on instead of starting over.
+    """
+    __tablename__ = 'inventory_state'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    # Start of the last pass that refreshed every product it read
+    rebalanced_at = Column(DateTime, nullable=True)
+    # Start of the last pass over every product with slots
+    full_pass_at = Column(DateTime, nullable=True)
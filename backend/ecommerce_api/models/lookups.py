@@ -0,0 +1,22 @@
+"""Single-row lookups used on every request.
+
+Primary key lookups should use `dbsession.get(Model, id)` instead of
+`query(Model).filter(Model.id == id).first()`: an object already loaded in
+the request's session is returned without a query, and otherwise the
+load runs a statement SQLAlchemy builds once per mapper.
+
+Lookups by other columns execute statements built once at import time
+with a named bind parameter, so neither the statement nor its cache key
+is rebuilt per call. (Lambda statements were measured to be slower than
+this, see benchmarks/bench_lookups.py.)
+"""
+from sqlalchemy import bindparam, select
+
+from .user import User
+
+USER_BY_EMAIL = select(User).where(User.email == bindparam('email'))
+
+
+def get_user_by_email(dbsession, email):
+    """Return the user with `email`, or None."""
+    return dbsession.scalars(USER_BY_EMAIL, {'email': email}).first()
@@ -1,13 +1,24 @@
-from sqlalchemy import Column, Integer, Float, String, Text, DateTime, ForeignKey, Enum, func, JSON
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, Float, String, Text, DateTime, ForeignKey, Enum, Index, func, JSON
 from sqlalchemy.orm import relationship
+from ..tracing import serialization_span
 from .base import Base
 
 class Order(Base):
     """Order model for storing order information."""
     __tablename__ = 'orders'
+    __table_args__ = (
+        # A customer's order history, newest first
+        Index('ix_orders_user_id_created_at', 'user_id', 'created_at'),
+        # Admin order list: sorted by date, status or total
+        Index('ix_orders_created_at', 'created_at'),
+        Index('ix_orders_status_created_at', 'status', 'created_at'),
+        Index('ix_orders_total', 'total'),
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     status = Column(Enum('processing', 'shipped', 'delivered', 'cancelled', name='order_status'), default='processing')
     subtotal = Column(Float, nullable=False)
     shipping_cost = Column(Float, default=0.0)
@@ -16,13 +27,23 @@ class Order(Base):
     shipping_address = Column(JSON, nullable=False)
     payment_method = Column(String(50), nullable=False)
     tracking_number = Column(String(100), nullable=True)
+    # Summary of the items, maintained when the order is written so list
+    # views never have to load order_items or products
+    item_count = Column(Integer, nullable=False, default=0, server_default='0')
+    unit_count = Column(Integer, nullable=False, default=0, server_default='0')
+    first_item_title = Column(String(200), nullable=True)
+    first_item_image = Column(String(500), nullable=True)
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+    # Incremented by every ORM update; see ecommerce_api.versioning
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     # Relationships
     user = relationship('User', back_populates='orders')
     items = relationship('OrderItem', back_populates='order', cascade='all, delete-orphan')
     
+    @serialization_span('Order.to_dict')
     def to_dict(self):
         """Return dictionary representation of the order."""
         return {
@@ -38,18 +59,75 @@ class Order(Base):
             'trackingNumber': self.tracking_number,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
             'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version,
             'items': [item.to_dict() for item in self.items] if self.items else []
         }
+    
+    @serialization_span('Order.to_summary_dict')
+    def to_summary_dict(self):
+        """Return the compact representation used by order list views."""
+        return {
+            'id': self.id,
+            'userId': self.user_id,
+            'status': self.status,
+            'total': self.total,
+            'trackingNumber': self.tracking_number,
+            'itemCount': self.item_count,
+            'unitCount': self.unit_count,
+            'firstItem': {
+                'title': self.first_item_title,
+                'image': self.first_item_image
+            } if self.first_item_title else None,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version
+        }
+
+class OrderEvent(Base):
+    """A change of an order's status or tracking number, as pushed to its customer.
+    
+    The id is the SSE event id: a reconnecting client sends the last one
+    it received and gets the events after it (see ecommerce_api.order_events).
+    """
+    __tablename__ = 'order_events'
+    __table_args__ = (
+        # Resuming a customer's stream after an event id
+        Index('ix_order_events_user_id_id', 'user_id', 'id'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    # Not foreign keys: orders is partitioned on PostgreSQL, and events
+    # are only kept for a while
+    user_id = Column(Integer, nullable=False)
+    order_id = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False)
+    tracking_number = Column(String(100), nullable=True)
+    # Set in Python so the event can be sent without reading it back
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def to_dict(self):
+        """Return the event's data as sent to the customer."""
+        return {
+            'orderId': self.order_id,
+            'status': self.status,
+            'trackingNumber': self.tracking_number,
+            'createdAt': self.created_at.isoformat() if self.created_at else None
+        }
 
 class OrderItem(Base):
     """OrderItem model for storing items within an order."""
     __tablename__ = 'order_items'
     
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
-    product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False, index=True)
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='SET NULL'), nullable=True, index=True)
     quantity = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)  # Price at time of order
+    # Snapshot of the product at time of order, so reading an order never
+    # needs the products table and survives catalog edits and deletions
+    product_title = Column(String(200), nullable=True)
+    product_image = Column(String(500), nullable=True)
+    product_category = Column(String(100), nullable=True)
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
     
@@ -57,13 +135,31 @@ class OrderItem(Base):
     order = relationship('Order', back_populates='items')
     product = relationship('Product', back_populates='order_items')
     
+    def snapshot_product(self, product):
+        """Copy the product details that are shown with the order."""
+        self.product_id = product.id
+        self.product_title = product.title
+        self.product_image = product.image_url
+        self.product_category = product.category
+        self.price = product.price
+    
+    @serialization_span('OrderItem.to_dict')
     def to_dict(self):
         """Return dictionary representation of the order item."""
         return {
             'id': self.id,
             'orderId': self.order_id,
             'productId': self.product_id,
-            'product': self.product.to_dict() if self.product else None,
+            'title': self.product_title,
+            'image': self.product_image,
+            'product': {
+                'id': self.product_id,
+                'title': self.product_title,
+                'category': self.product_category,
+                'image': self.product_image,
+                'imageUrl': self.product_image,
+                'price': self.price
+            },
             'quantity': self.quantity,
             'price': self.price,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
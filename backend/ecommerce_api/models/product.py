@@ -1,26 +1,72 @@
-from sqlalchemy import Column, Integer, String, Text, Float, DateTime, func
+from sqlalchemy import Column, Integer, String, Text, Float, DateTime, Index, func
 from sqlalchemy.orm import relationship
+from ..tracing import serialization_span
 from .base import Base
 
 class Product(Base):
     """Product model for storing product details."""
     __tablename__ = 'products'
+    __table_args__ = (
+        # Category listings, filtered by price and sorted by id, price or rating
+        Index('ix_products_category_id', 'category', 'id'),
+        Index('ix_products_category_price', 'category', 'price'),
+        Index('ix_products_category_rating', 'category', 'rating'),
+        # Catalog-wide sorting and price range filters
+        Index('ix_products_price', 'price'),
+        Index('ix_products_rating', 'rating'),
+        Index('ix_products_created_at', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     title = Column(String(200), nullable=False)
     description = Column(Text, nullable=True)
     price = Column(Float, nullable=False)
-    category = Column(String(100), nullable=False, index=True)
+    category = Column(String(100), nullable=False)
     image_url = Column(String(500), nullable=True)
     rating = Column(Float, default=0.0)
     stock = Column(Integer, default=0)
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+    # Incremented by every ORM update; see ecommerce_api.versioning
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
       # Relationships
-    order_items = relationship('OrderItem', back_populates='product')
+    order_items = relationship('OrderItem', back_populates='product', passive_deletes=True)
     
-    def to_dict(self):
-        """Return dictionary representation of the product."""
+    # Columns read by each key of to_dict(), used for field selection
+    FIELD_COLUMNS = {
+        'id': ['id'],
+        'title': ['title'],
+        'description': ['description'],
+        'price': ['price'],
+        'category': ['category'],
+        'image': ['image_url'],
+        'imageUrl': ['image_url'],
+        'rating': ['rating', 'stock'],
+        'stock': ['stock'],
+        'createdAt': ['created_at'],
+        'updatedAt': ['updated_at'],
+        'version': ['version'],
+    }
+    
+    @serialization_span('Product.to_dict')
+    def to_dict(self, fields=None):
+        """Return dictionary representation of the product.
+        
+        `fields` limits the result to those keys of FIELD_COLUMNS.
+        """
+        if fields is not None:
+            data = {}
+            for name in fields:
+                if name == 'rating':
+                    data[name] = {'rate': self.rating, 'count': self.stock}
+                elif name in ('createdAt', 'updatedAt'):
+                    value = getattr(self, self.FIELD_COLUMNS[name][0])
+                    data[name] = value.isoformat() if value else None
+                else:
+                    data[name] = getattr(self, self.FIELD_COLUMNS[name][0])
+            return data
+        
         return {
             'id': self.id,
             'title': self.title,
@@ -35,5 +81,6 @@ class Product(Base):
             },
             'stock': self.stock,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'updatedAt': self.updated_at.isoformat() if self.updated_at else None
+            'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version
         }
\ No newline at end of file
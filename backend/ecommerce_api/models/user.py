@@ -1,7 +1,8 @@
 import bcrypt
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func
+from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, func
 from sqlalchemy.orm import relationship
 from datetime import datetime
+from ..tracing import serialization_span
 from .base import Base
 
 class User(Base):
@@ -15,8 +16,17 @@ class User(Base):
     password_hash = Column(String(255), nullable=False)
     is_active = Column(Boolean, default=True, nullable=False)
     is_admin = Column(Boolean, default=False, nullable=False)
+    # Order statistics (cancelled orders excluded), maintained incrementally
+    # by the order views and rebuilt with the rebuild_user_stats script
+    order_count = Column(Integer, nullable=False, default=0, server_default='0')
+    lifetime_spend = Column(Float, nullable=False, default=0.0, server_default='0', index=True)
+    # Indexed DESC NULLS LAST on PostgreSQL (see migration 4f8e1b3a6c25)
+    last_order_at = Column(DateTime, nullable=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+    # Incremented by every ORM update; see ecommerce_api.versioning
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     
     # Relationships
     orders = relationship('Order', back_populates='user')
@@ -35,6 +45,7 @@ class User(Base):
         """Check if the provided password matches the stored hash."""
         return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
     
+    @serialization_span('User.to_dict')
     def to_dict(self):
         """Return a dictionary representation of the user."""
         return {
@@ -46,5 +57,14 @@ class User(Base):
             'isActive': self.is_active,
             'isAdmin': self.is_admin,
             'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'updatedAt': self.updated_at.isoformat() if self.updated_at else None
+            'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+            'version': self.version
+        }
+    
+    def stats_dict(self):
+        """Return the user's order statistics."""
+        return {
+            'orderCount': self.order_count,
+            'lifetimeSpend': self.lifetime_spend,
+            'lastOrderAt': self.last_order_at.isoformat() if self.last_order_at else None
         }
@@ -0,0 +1,87 @@
+"""Order status events, streamed to customers as server-sent events.
+
+update_order_status records an OrderEvent in its transaction when an
+order's status or tracking number changes. On PostgreSQL the event is
+also sent with NOTIFY, which is only delivered if the transaction
+commits.
+
+`GET /api/orders/stream` is meant to be routed by the reverse proxy to
+serve_order_events, an asyncio server that holds every open stream in
+one thread and fans the notifications out to the customers' streams (on
+other databases it polls order_events). When the application answers
+the path itself, it sends the events after `Last-Event-ID` and ends the
+stream; EventSource reconnects after `events.retry_ms`, so customers
+still get their events, one indexed query per reconnect.
+
+Event ids are the OrderEvent ids. A stream that starts without
+`Last-Event-ID` first gets the id of the customer's latest event, so a
+reconnect resumes from there even if no event came in between.
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy import delete, func, select
+
+from .models.order import OrderEvent
+
+CHANNEL = 'order_events'
+# Events sent per query when a stream resumes
+REPLAY_BATCH = 100
+
+def event_message(event):
+    """Return the event as it travels to the streams: id, user and data."""
+    return {'id': event.id, 'userId': event.user_id, 'data': event.to_dict()}
+
+def publish_order_event(dbsession, order):
+    """Record the order's current status as an event for its customer."""
+    event = OrderEvent(
+        user_id=order.user_id,
+        order_id=order.id,
+        status=order.status,
+        tracking_number=order.tracking_number,
+    )
+    dbsession.add(event)
+    dbsession.flush()
+    if dbsession.get_bind().dialect.name == 'postgresql':
+        dbsession.execute(select(func.pg_notify(CHANNEL, json.dumps(event_message(event)))))
+    return event
+
+def format_event(message):
+    """Return the message in the text/event-stream format."""
+    return f"id: {message['id']}\nevent: order\ndata: {json.dumps(message['data'])}\n\n"
+
+def parse_event_id(value):
+    """Return the event id sent by a reconnecting client, or None."""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def user_events_after(dbsession, user_id, last_id, limit=REPLAY_BATCH):
+    """Return the messages of the user's events after `last_id`."""
+    events = dbsession.scalars(
+        select(OrderEvent)
+        .where(OrderEvent.user_id == user_id, OrderEvent.id > last_id)
+        .order_by(OrderEvent.id)
+        .limit(limit)
+    ).all()
+    return [event_message(event) for event in events]
+
+def events_after(dbsession, last_id, limit=1000):
+    """Return the messages of everyone's events after `last_id`."""
+    events = dbsession.scalars(
+        select(OrderEvent).where(OrderEvent.id > last_id).order_by(OrderEvent.id).limit(limit)
+    ).all()
+    return [event_message(event) for event in events]
+
+def latest_event_id(dbsession, user_id=None):
+    """Return the id of the user's latest event (anyone's without a user), or 0."""
+    query = select(func.max(OrderEvent.id))
+    if user_id is not None:
+        query = query.where(OrderEvent.user_id == user_id)
+    return dbsession.execute(query).scalar() or 0
+
+def purge_events(dbsession, retention, now=None):
+    """Delete the events older than `retention`; return how many."""
+    cutoff = (now or datetime.utcnow()) - retention
+    return dbsession.execute(delete(OrderEvent).where(OrderEvent.created_at < cutoff)).rowcount
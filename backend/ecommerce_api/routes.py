@@ -23,11 +23,37 @@ def includeme(config):
       # Products routes
     config.add_route('products', f'{api_prefix}/products')
     config.add_route('product_categories', f'{api_prefix}/products/categories')
+    config.add_route('products_suggest', f'{api_prefix}/products/suggest')
+    config.add_route('product_changes', f'{api_prefix}/products/changes')
     config.add_route('products_by_category', f'{api_prefix}/products/category/{{category}}')
     config.add_route('product', f'{api_prefix}/products/{{id}}')    # Orders routes
     config.add_route('orders', f'{api_prefix}/orders')
     config.add_route('user_orders', f'{api_prefix}/orders/user')
+    config.add_route('order_stream', f'{api_prefix}/orders/stream')
     config.add_route('order', f'{api_prefix}/orders/{{id}}')
     
+    # Cart stock reservations
+    config.add_route('stock_reservations', f'{api_prefix}/inventory/reservations')
+    config.add_route('stock_reservation', f'{api_prefix}/inventory/reservations/{{id}}')
+    
+    # Health checks (outside the API prefix, for load balancers)
+    config.add_route('healthz', '/healthz')
+    config.add_route('readyz', '/readyz')
+    
+    # Admin diagnostics routes
+    config.add_route('admin_slow_queries', f'{api_prefix}/admin/slow-queries')
+    config.add_route('admin_slow_queries_dump', f'{api_prefix}/admin/slow-queries/dump')
+    config.add_route('admin_metrics', f'{api_prefix}/admin/metrics')
+    config.add_route('admin_inventory', f'{api_prefix}/admin/inventory/{{id}}')
+    config.add_route('admin_traces', f'{api_prefix}/admin/traces')
+    config.add_route('admin_traces_flame', f'{api_prefix}/admin/traces/flame')
+    config.add_route('admin_memory', f'{api_prefix}/admin/memory')
+    config.add_route('admin_memory_start', f'{api_prefix}/admin/memory/start')
+    config.add_route('admin_memory_stop', f'{api_prefix}/admin/memory/stop')
+    config.add_route('admin_memory_snapshots', f'{api_prefix}/admin/memory/snapshots')
+    config.add_route('admin_memory_top', f'{api_prefix}/admin/memory/top')
+    config.add_route('admin_memory_diff', f'{api_prefix}/admin/memory/diff')
+    config.add_route('admin_memory_routes', f'{api_prefix}/admin/memory/routes')
+    
     # Debug routes (should be disabled in production)
     config.add_route('debug_products', f'{api_prefix}/debug/products')
\ No newline at end of file
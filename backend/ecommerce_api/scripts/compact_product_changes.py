@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Compact the product change feed.
+
+Usage:
+    compact_product_changes <config_uri> [--batch-size N]
+
+Deletes every change followed by a later change to the same product:
+clients only ever need a product's latest one. Then deletes tombstones
+older than `changefeed.tombstone_days` (default 30) and moves the feed's
+horizon past them, so clients that have not synced since are told to
+reset. Superseded changes are deleted in batches, each in its own
+transaction, so the script can run from cron while the application is
+serving.
+"""
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import and_, delete, engine_from_config, exists, func, select, update
+from sqlalchemy.orm import aliased
+
+from ..changefeed import STATE_ID
+from ..models.changefeed import ChangeFeedState, ProductChange
+
+
+def delete_superseded(engine, batch_size):
+    """Delete the changes followed by a later one; return how many."""
+    later = aliased(ProductChange)
+    superseded = (
+        select(ProductChange.token)
+        .where(exists().where(and_(
+            later.product_id == ProductChange.product_id,
+            later.token > ProductChange.token,
+        )))
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            deleted = connection.execute(
+                delete(ProductChange).where(ProductChange.token.in_(superseded))
+            ).rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def expire_tombstones(engine, max_age, now=None):
+    """Delete tombstones older than `max_age`; return how many."""
+    cutoff = (now or datetime.utcnow()) - max_age
+    with engine.begin() as connection:
+        # Locking the state row keeps writers out until the horizon moves
+        horizon = connection.execute(
+            select(ChangeFeedState.horizon)
+            .where(ChangeFeedState.id == STATE_ID)
+            .with_for_update()
+        ).scalar()
+        if horizon is None:
+            return 0
+        newest = connection.execute(
+            select(func.max(ProductChange.token))
+            .where(ProductChange.deleted, ProductChange.changed_at < cutoff)
+        ).scalar()
+        if newest is None:
+            return 0
+        connection.execute(
+            update(ChangeFeedState)
+            .where(ChangeFeedState.id == STATE_ID)
+            .values(horizon=max(horizon, newest))
+        )
+        return connection.execute(
+            delete(ProductChange).where(ProductChange.deleted, ProductChange.token <= newest)
+        ).rowcount
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='compact_product_changes',
+        description='Compact the product change feed.'
+    )
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows deleted per transaction (default: 5000)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+    max_age = timedelta(days=float(settings.get('changefeed.tombstone_days', 30)))
+    superseded = delete_superseded(engine, args.batch_size)
+    tombstones = expire_tombstones(engine, max_age)
+    print(f'Deleted {superseded} superseded changes and {tombstones} expired tombstones')
+
+
+if __name__ == '__main__':
+    main()
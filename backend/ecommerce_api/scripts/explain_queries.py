@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Print the query plan of the queries behind the busiest API endpoints and
+flag the ones that fall back to a full table scan.
+
+Usage:
+    explain_queries <config_uri> [--force-index] [--verbose]
+
+The queries mirror the filters, sort orders and limits the views use, with
+parameter values taken from existing rows. On a small development database
+the planner often prefers a sequential scan even when a suitable index
+exists; `--force-index` (PostgreSQL only) disables sequential scans for the
+session so the output shows whether an index *can* serve each query.
+
+Exits with status 1 when any query scans a whole table, so it can be run in
+CI against a database loaded with representative data.
+"""
+import argparse
+import json
+import sys
+from datetime import datetime, timedelta
+
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config, func, text
+from sqlalchemy.orm import Session
+
+from ..models.order import Order, OrderItem
+from ..models.product import Product
+from ..models.user import User
+
+PER_PAGE = 20
+
+
+def endpoint_queries(dbsession):
+    """Return (name, expected index, query) for each endpoint query."""
+    category = dbsession.query(Product.category).limit(1).scalar() or 'Electronics'
+    user_id = dbsession.query(Order.user_id).limit(1).scalar() or 1
+    order_id = dbsession.query(Order.id).limit(1).scalar() or 1
+    product_id = dbsession.query(Product.id).limit(1).scalar() or 1
+    email = dbsession.query(User.email).limit(1).scalar() or 'admin@example.com'
+    since = datetime.utcnow() - timedelta(days=30)
+
+    products = dbsession.query(Product)
+    orders = dbsession.query(Order)
+    return [
+        ('GET /api/products/category/{category}', 'ix_products_category_id',
+         products.filter(Product.category == category)
+         .order_by(Product.id).limit(PER_PAGE)),
+        ('GET /api/products?category=&sort_by=price&min_price=', 'ix_products_category_price',
+         products.filter(Product.category == category, Product.price >= 10)
+         .order_by(Product.price, Product.id).limit(PER_PAGE)),
+        ('GET /api/products?category=&sort_by=rating&sort_dir=desc', 'ix_products_category_rating',
+         products.filter(Product.category == category)
+         .order_by(Product.rating.desc(), Product.id.desc()).limit(PER_PAGE)),
+        ('GET /api/products?sort_by=price', 'ix_products_price',
+         products.order_by(Product.price, Product.id).limit(PER_PAGE)),
+        ('GET /api/products?min_price=&max_price=', 'ix_products_price',
+         products.filter(Product.price >= 10, Product.price <= 20)
+         .order_by(Product.id).limit(PER_PAGE)),
+        ('GET /api/products?sort_by=rating&sort_dir=desc', 'ix_products_rating',
+         products.order_by(Product.rating.desc(), Product.id.desc()).limit(PER_PAGE)),
+        ('GET /api/products?sort_by=created_at&sort_dir=desc', 'ix_products_created_at',
+         products.order_by(Product.created_at.desc(), Product.id.desc()).limit(PER_PAGE)),
+        ('GET /api/orders', 'ix_orders_created_at',
+         orders.order_by(Order.created_at.desc()).limit(PER_PAGE)),
+        ('GET /api/orders?created_from=', 'ix_orders_created_at',
+         orders.filter(Order.created_at >= since)
+         .order_by(Order.created_at.desc()).limit(PER_PAGE)),
+        ('GET /api/orders?sort_by=status', 'ix_orders_status_created_at',
+         orders.order_by(Order.status).limit(PER_PAGE)),
+        ('GET /api/orders?sort_by=total&sort_dir=desc', 'ix_orders_total',
+         orders.order_by(Order.total.desc()).limit(PER_PAGE)),
+        ('GET /api/orders/user', 'ix_orders_user_id_created_at',
+         orders.filter(Order.user_id == user_id)
+         .order_by(Order.created_at.desc()).limit(PER_PAGE)),
+        ('PATCH /api/orders/{id} (cancel: last order date)', 'ix_orders_user_id_created_at',
+         dbsession.query(func.max(Order.created_at))
+         .filter(Order.user_id == user_id, Order.status != 'cancelled')),
+        ('GET /api/orders?expand=items', 'ix_order_items_order_id',
+         dbsession.query(OrderItem).filter(OrderItem.order_id.in_([order_id]))),
+        ('DELETE /api/products/{id} (detach order items)', 'ix_order_items_product_id',
+         dbsession.query(OrderItem.id).filter(OrderItem.product_id == product_id)),
+        ('POST /api/auth/login', 'uq_users_email',
+         dbsession.query(User).filter(User.email == email)),
+        ('GET /api/users?sort_by=lifetime_spend&sort_dir=desc', 'ix_users_lifetime_spend',
+         dbsession.query(User).order_by(User.lifetime_spend.desc()).limit(PER_PAGE)),
+        ('GET /api/users?sort_by=last_order_at&sort_dir=desc', 'ix_users_last_order_at',
+         dbsession.query(User).order_by(User.last_order_at.desc().nulls_last()).limit(PER_PAGE)),
+    ]
+
+
+def walk_postgresql_plan(node):
+    """Yield every node of a PostgreSQL JSON plan tree."""
+    yield node
+    for child in node.get('Plans', []):
+        yield from walk_postgresql_plan(child)
+
+
+def explain_postgresql(connection, compiled):
+    """Return (plan lines, scans, full scans) for a compiled statement."""
+    plan = connection.exec_driver_sql(
+        'EXPLAIN (FORMAT JSON) ' + compiled.string, compiled.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    lines, scans, full_scans = [], [], []
+    for node in walk_postgresql_plan(plan[0]['Plan']):
+        node_type = node['Node Type']
+        relation = node.get('Relation Name')
+        index = node.get('Index Name')
+        lines.append(f"{node_type}{f' using {index}' if index else ''}{f' on {relation}' if relation else ''}")
+        if index:
+            scans.append(index)
+        if node_type == 'Seq Scan':
+            full_scans.append(relation)
+    return lines, scans, full_scans
+
+
+def explain_sqlite(connection, compiled):
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + compiled.string, params).all()
+
+    lines, scans, full_scans = [], [], []
+    for row in rows:
+        detail = row[-1]
+        lines.append(detail)
+        if ' INDEX ' in detail:
+            scans.append(detail.split(' INDEX ', 1)[1].split(' ')[0])
+        elif detail.startswith('SCAN ') and 'SUBQUERY' not in detail:
+            full_scans.append(detail.split(' ')[1])
+    return lines, scans, full_scans
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='explain_queries',
+        description='Show which index serves each endpoint query.'
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('--force-index', action='store_true',
+                        help='disable sequential scans while planning (PostgreSQL only)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print every plan node')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+
+    if engine.dialect.name == 'postgresql':
+        explain = explain_postgresql
+    elif engine.dialect.name == 'sqlite':
+        explain = explain_sqlite
+    else:
+        print(f"Unsupported database: {engine.dialect.name}")
+        sys.exit(1)
+
+    flagged = checked = 0
+    with engine.connect() as connection:
+        if args.force_index and engine.dialect.name == 'postgresql':
+            connection.execute(text('SET enable_seqscan = off'))
+
+        dbsession = Session(bind=connection)
+        for name, expected, query in endpoint_queries(dbsession):
+            compiled = query.statement.compile(
+                dialect=engine.dialect, compile_kwargs={'render_postcompile': True}
+            )
+            lines, scans, full_scans = explain(connection, compiled)
+            checked += 1
+
+            if full_scans:
+                flagged += 1
+                print(f"SEQ  {name}: full scan of {', '.join(sorted(set(full_scans)))} "
+                      f"(expected {expected})")
+            else:
+                print(f"OK   {name}: {', '.join(scans) or 'no index needed'}")
+            if args.verbose or full_scans:
+                for line in lines:
+                    print(f"       {line}")
+        dbsession.close()
+
+    print(f"\n{flagged} of {checked} queries scan a whole table")
+    sys.exit(1 if flagged else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Fill the database with a synthetic dataset for benchmarking.
+
+Usage:
+    generate_dataset <config_uri> [--products N] [--users N] [--orders N]
+                     [--seed N] [--workers N] [--chunk-size N]
+                     [--months N] [--until YYYY-MM-DD] [--skew S]
+
+Adds the requested number of products, users and orders (with their
+items) after the rows already in the tables. The same options produce
+the same rows: every product and user is derived from the seed and its
+position, and every chunk of orders from the seed and the chunk's
+position, whichever worker writes it.
+
+- Products are spread over weighted categories with log-distributed
+  prices. Their popularity follows a power law (`--skew`, 1.0 ~ Zipf):
+  with a million products the 1% most popular ones get about two thirds
+  of the order items, and they are scattered over the id range.
+- Customers are skewed too: a few order often, most rarely.
+- Orders have 1-10 items, mostly one or two, and are spread over the
+  `--months` months before `--until` (default: today) with ids in date
+  order. Older orders are delivered or cancelled, recent ones still
+  processing or shipped. Orders and items get the same denormalized
+  summaries as orders placed through the API.
+
+Chunks of `--chunk-size` rows are written by `--workers` processes, each
+chunk in its own transaction: with `COPY` on PostgreSQL, otherwise with
+batched inserts (SQLite allows one writer, so it always uses one
+process). Afterwards the id sequences are moved past the new rows, the
+users' order statistics are rebuilt, and clients of the product change
+feed are told to reload the catalogue.
+
+Every synthetic user's password is `--password` (default: `password`).
+On PostgreSQL with partitioned orders, run `manage_partitions maintain`
+(or create the partitions for `--months`) first; rows for months without
+a partition land in the default partition.
+"""
+import argparse
+import functools
+import io
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import bcrypt
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+
+from ..changefeed import force_reset
+from ..database import make_engine
+from ..models.order import Order, OrderItem
+from ..models.product import Product
+from ..models.user import User
+from .rebuild_user_stats import rebuild_user_stats
+
+MASK = (1 << 64) - 1
+
+# Weights roughly follow a general store's catalogue
+CATEGORIES = [
+    ('Electronics', 14), ('Clothing', 18), ('Home & Kitchen', 14), ('Beauty', 9),
+    ('Sports', 8), ('Toys', 7), ('Books', 10), ('Jewelery', 3), ('Garden', 5),
+    ('Automotive', 4), ('Grocery', 6), ('Office', 4),
+]
+ADJECTIVES = ['Classic', 'Premium', 'Compact', 'Wireless', 'Organic', 'Deluxe', 'Smart',
+              'Vintage', 'Portable', 'Eco', 'Ultra', 'Essential', 'Pro', 'Slim', 'Heavy-Duty']
+NOUNS = ['Backpack', 'Lamp', 'Headphones', 'Jacket', 'Mug', 'Blender', 'Sneakers', 'Watch',
+         'Notebook', 'Speaker', 'Chair', 'Bottle', 'Charger', 'Shirt', 'Kettle', 'Camera',
+         'Pillow', 'Wallet', 'Keyboard', 'Tent']
+FIRST_NAMES = ['Olivia', 'Liam', 'Emma', 'Noah', 'Ava', 'John', 'Sophia', 'Lucas', 'Mia',
+               'Ethan', 'Amelia', 'Budi', 'Siti', 'Dewi', 'Agus', 'Putri', 'Rizky', 'Nur']
+LAST_NAMES = ['Smith', 'Johnson', 'Brown', 'Taylor', 'Anderson', 'Thomas', 'Jackson',
+              'White', 'Santoso', 'Wijaya', 'Pratama', 'Saputra', 'Hidayat', 'Lestari']
+CITIES = [('Jakarta', 'DKI Jakarta'), ('Surabaya', 'Jawa Timur'), ('Bandung', 'Jawa Barat'),
+          ('Medan', 'Sumatera Utara'), ('Semarang', 'Jawa Tengah'), ('Makassar', 'Sulawesi Selatan'),
+          ('Denpasar', 'Bali'), ('Yogyakarta', 'DI Yogyakarta')]
+STREETS = ['Jl. Sudirman', 'Jl. Thamrin', 'Jl. Merdeka', 'Jl. Diponegoro', 'Jl. Gatot Subroto',
+           'Jl. Ahmad Yani', 'Jl. Pahlawan', 'Jl. Asia Afrika']
+PAYMENT_METHODS = [('credit_card', 55), ('bank_transfer', 25), ('e_wallet', 15), ('cod', 5)]
+# Items per order: mostly one or two
+ITEM_COUNTS = [(1, 45), (2, 25), (3, 12), (4, 7), (5, 4), (6, 3), (7, 2), (8, 1), (9, 1), (10, 1)]
+QUANTITIES = [(1, 80), (2, 14), (3, 4), (4, 2)]
+
+# Customers are less skewed than products
+USER_SKEW = 0.6
+TAX_RATE = 0.08
+FREE_SHIPPING_FROM = 50.0
+SHIPPING_COST = 5.99
+
+PRODUCT_COLUMNS = ['id', 'title', 'description', 'price', 'category', 'image_url', 'rating',
+                   'stock', 'created_at', 'updated_at', 'version']
+USER_COLUMNS = ['id', 'email', 'first_name', 'last_name', 'password_hash', 'is_active',
+                'is_admin', 'order_count', 'lifetime_spend', 'last_order_at', 'created_at',
+                'updated_at', 'version']
+ORDER_COLUMNS = ['id', 'user_id', 'status', 'subtotal', 'shipping_cost', 'tax', 'total',
+                 'shipping_address', 'payment_method', 'tracking_number', 'item_count',
+                 'unit_count', 'first_item_title', 'first_item_image', 'created_at',
+                 'updated_at', 'version']
+# Item ids come from the table's sequence
+ITEM_COLUMNS = ['order_id', 'product_id', 'quantity', 'price', 'product_title', 'product_image',
+                'product_category', 'created_at', 'updated_at']
+
+TABLES = {
+    'products': Product.__table__,
+    'users': User.__table__,
+    'orders': Order.__table__,
+    'order_items': OrderItem.__table__,
+}
+# Rows per INSERT when COPY is not available
+INSERT_BATCH = 1000
+
+# What every worker needs to derive a chunk's rows
+Plan = namedtuple('Plan', 'seed products users orders product_offset user_offset '
+                          'order_offset start end skew password_hash')
+
+
+def mix(value):
+    """Return a well-mixed 64-bit hash of `value` (splitmix64)."""
+    value = (value + 0x9E3779B97F4A7C15) & MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK
+    return value ^ (value >> 31)
+
+
+def row_hash(seed, table, index):
+    """Return the hash the `index`-th generated row of `table` is derived from."""
+    return mix(mix(seed * 8 + table) ^ index)
+
+
+def unit(value):
+    """Map 53 bits of a hash to [0, 1)."""
+    return (value >> 11) / (1 << 53)
+
+
+def cumulative(weighted):
+    values, totals, total = [], [], 0
+    for value, weight in weighted:
+        total += weight
+        values.append(value)
+        totals.append(total)
+    return values, totals
+
+
+def pick(table, fraction):
+    """Pick from a `cumulative` table with a fraction in [0, 1)."""
+    values, totals = table
+    target = fraction * totals[-1]
+    for value, total in zip(values, totals):
+        if target < total:
+            return value
+    return values[-1]
+
+
+CATEGORY_TABLE = cumulative(CATEGORIES)
+PAYMENT_TABLE = cumulative(PAYMENT_METHODS)
+ITEM_COUNT_TABLE = cumulative(ITEM_COUNTS)
+QUANTITY_TABLE = cumulative(QUANTITIES)
+
+
+def power_law_rank(count, skew, fraction):
+    """Return a rank in [0, count) drawn with P(rank) ~ 1 / (rank + 1) ** skew."""
+    if skew == 1.0:
+        position = (count + 1) ** fraction
+    else:
+        exponent = 1.0 - skew
+        position = (((count + 1) ** exponent - 1) * fraction + 1) ** (1 / exponent)
+    return min(int(position) - 1, count - 1)
+
+
+@functools.lru_cache()
+def scatter_step(count):
+    """Return a step near count / golden ratio with no factor in common with count."""
+    step = max(int(count * 0.6180339887), 1)
+    while math.gcd(step, count) != 1:
+        step += 1
+    return step
+
+
+def scatter(rank, count):
+    """Map a popularity rank to a row index, so popular rows are not all adjacent."""
+    return rank * scatter_step(count) % count
+
+
+def product_row(plan, index):
+    """Return the `index`-th generated product (0-based)."""
+    h = row_hash(plan.seed, 1, index)
+    product_id = plan.product_offset + index + 1
+    adjective = ADJECTIVES[h % len(ADJECTIVES)]
+    noun = NOUNS[(h >> 8) % len(NOUNS)]
+    category = pick(CATEGORY_TABLE, unit(mix(h)))
+    # Prices from 2.99 to about 950, most under 50
+    price = round(2.99 * 10 ** (2.5 * unit(mix(h + 1)) ** 1.5), 2)
+    created_at = plan.start - timedelta(days=365 * unit(mix(h + 2)))
+    return {
+        'id': product_id,
+        'title': f'{adjective} {noun} {product_id}',
+        'description': f'{adjective} {noun.lower()} from our {category.lower()} range.',
+        'price': price,
+        'category': category,
+        'image_url': f'https://images.example.com/products/{product_id}.jpg',
+        'rating': round(5 - 4 * unit(mix(h + 3)) ** 2, 1),
+        'stock': (h >> 16) % 500,
+        'created_at': created_at,
+        'updated_at': created_at,
+        'version': 1,
+    }
+
+
+def user_row(plan, index):
+    """Return the `index`-th generated user (0-based)."""
+    h = row_hash(plan.seed, 2, index)
+    user_id = plan.user_offset + index + 1
+    first_name = FIRST_NAMES[h % len(FIRST_NAMES)]
+    last_name = LAST_NAMES[(h >> 8) % len(LAST_NAMES)]
+    created_at = plan.start - timedelta(days=365 * unit(mix(h)))
+    return {
+        'id': user_id,
+        'email': f'{first_name}.{last_name}.{user_id}@example.com'.lower(),
+        'first_name': first_name,
+        'last_name': last_name,
+        'password_hash': plan.password_hash,
+        'is_active': True,
+        'is_admin': False,
+        # Filled in by rebuild_user_stats once the orders are written
+        'order_count': 0,
+        'lifetime_spend': 0.0,
+        'last_order_at': None,
+        'created_at': created_at,
+        'updated_at': created_at,
+        'version': 1,
+    }
+
+
+def shipping_address(plan, user_index):
+    h = row_hash(plan.seed, 3, user_index)
+    city, province = CITIES[h % len(CITIES)]
+    return {
+        'street': f'{STREETS[(h >> 8) % len(STREETS)]} No. {1 + (h >> 16) % 200}',
+        'city': city,
+        'state': province,
+        'zipCode': f'{10000 + (h >> 24) % 90000}',
+        'country': 'Indonesia',
+    }
+
+
+def order_status(created_at, end, rng):
+    age = end - created_at
+    if age < timedelta(days=2):
+        return 'processing' if rng.random() < 0.8 else 'shipped'
+    if age < timedelta(days=7):
+        return 'shipped' if rng.random() < 0.7 else 'delivered'
+    return 'cancelled' if rng.random() < 0.06 else 'delivered'
+
+
+def order_rows(plan, first, last):
+    """Return the orders with indexes [first, last) and their items."""
+    rng = random.Random(row_hash(plan.seed, 4, first))
+    span = (plan.end - plan.start).total_seconds()
+    orders, items = [], []
+    for index in range(first, last):
+        order_id = plan.order_offset + index + 1
+        # Ids follow the dates, as they do in production
+        created_at = plan.start + timedelta(seconds=span * (index + rng.random()) / plan.orders)
+        user_index = scatter(power_law_rank(plan.users, USER_SKEW, rng.random()), plan.users)
+        status = order_status(created_at, plan.end, rng)
+
+        chosen = []
+        for _ in range(pick(ITEM_COUNT_TABLE, rng.random())):
+            rank = power_law_rank(plan.products, plan.skew, rng.random())
+            product_index = scatter(rank, plan.products)
+            if product_index not in chosen:
+                chosen.append(product_index)
+
+        subtotal, units = 0.0, 0
+        order_items = []
+        for product_index in chosen:
+            product = product_row(plan, product_index)
+            quantity = pick(QUANTITY_TABLE, rng.random())
+            subtotal += product['price'] * quantity
+            units += quantity
+            order_items.append({
+                'order_id': order_id,
+                'product_id': product['id'],
+                'quantity': quantity,
+                'price': product['price'],
+                'product_title': product['title'],
+                'product_image': product['image_url'],
+                'product_category': product['category'],
+                'created_at': created_at,
+                'updated_at': created_at,
+            })
+        subtotal = round(subtotal, 2)
+        shipping_cost = 0.0 if subtotal >= FREE_SHIPPING_FROM else SHIPPING_COST
+        tax = round(subtotal * TAX_RATE, 2)
+        first_item = order_items[0]
+        updated_at = created_at if status == 'processing' else min(
+            created_at + timedelta(days=rng.uniform(0.5, 5)), plan.end)
+        orders.append({
+            'id': order_id,
+            'user_id': plan.user_offset + user_index + 1,
+            'status': status,
+            'subtotal': subtotal,
+            'shipping_cost': shipping_cost,
+            'tax': tax,
+            'total': round(subtotal + shipping_cost + tax, 2),
+            'shipping_address': shipping_address(plan, user_index),
+            'payment_method': pick(PAYMENT_TABLE, rng.random()),
+            'tracking_number': f'JNE{order_id:012d}' if status in ('shipped', 'delivered') else None,
+            'item_count': len(order_items),
+            'unit_count': units,
+            'first_item_title': first_item['product_title'],
+            'first_item_image': first_item['product_image'],
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'version': 1,
+        })
+        items.extend(order_items)
+    return orders, items
+
+
+def copy_value(value):
+    """Format a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(connection, table, columns, rows):
+    """Write `rows` into `table` with COPY (psycopg2 or psycopg 3)."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(row[column]) for column in columns))
+        buffer.write('\n')
+    statement = f'COPY {table} ({", ".join(columns)}) FROM STDIN'
+    cursor = connection.connection.driver_connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+        else:
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def write_rows(connection, table, columns, rows):
+    """Write `rows` into `table`: COPY on PostgreSQL, batched inserts elsewhere."""
+    if connection.dialect.name == 'postgresql':
+        copy_rows(connection, table, columns, rows)
+        return
+    for start in range(0, len(rows), INSERT_BATCH):
+        connection.execute(TABLES[table].insert(), rows[start:start + INSERT_BATCH])
+
+
+# The worker process's engine
+_engine = None
+
+
+def _start_worker(settings):
+    global _engine
+    _engine = make_engine(settings)
+
+
+def write_chunk(task):
+    """Write one chunk in its own transaction; return (table, rows, item rows)."""
+    table, plan, first, last = task
+    with _engine.begin() as connection:
+        if table == 'products':
+            write_rows(connection, 'products', PRODUCT_COLUMNS,
+                       [product_row(plan, index) for index in range(first, last)])
+            return table, last - first, 0
+        if table == 'users':
+            write_rows(connection, 'users', USER_COLUMNS,
+                       [user_row(plan, index) for index in range(first, last)])
+            return table, last - first, 0
+        orders, items = order_rows(plan, first, last)
+        write_rows(connection, 'orders', ORDER_COLUMNS, orders)
+        write_rows(connection, 'order_items', ITEM_COLUMNS, items)
+        return table, len(orders), len(items)
+
+
+def run_phase(pool, table, plan, count, chunk_size):
+    """Write `count` rows of `table` in chunks and print the rows per second."""
+    if not count:
+        return
+    tasks = [(table, plan, first, min(first + chunk_size, count))
+             for first in range(0, count, chunk_size)]
+    started = time.perf_counter()
+    rows = item_rows = 0
+    results = pool.imap_unordered(write_chunk, tasks) if pool else map(write_chunk, tasks)
+    for _, written, items in results:
+        rows += written
+        item_rows += items
+        elapsed = time.perf_counter() - started
+        print(f'\r{table}: {rows:,}/{count:,} ({rows / elapsed:,.0f} rows/s)', end='', flush=True)
+    elapsed = time.perf_counter() - started
+    summary = f'\r{table}: {rows:,} rows in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)'
+    if item_rows:
+        summary += (f', {item_rows:,} items ({item_rows / elapsed:,.0f} rows/s, '
+                    f'{(rows + item_rows) / elapsed:,.0f} rows/s in total)')
+    print(summary)
+
+
+def max_id(connection, model):
+    return connection.execute(select(func.max(model.id))).scalar() or 0
+
+
+def finish(engine, postgresql):
+    """Move the id sequences past the new rows and rebuild the derived data."""
+    with engine.begin() as connection:
+        if postgresql:
+            for table in ('products', 'users', 'orders'):
+                connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT max(id) FROM {table})) "
+                    f"WHERE pg_get_serial_sequence('{table}', 'id') IS NOT NULL"
+                ))
+    started = time.perf_counter()
+    with Session(bind=engine) as dbsession, dbsession.begin():
+        updated = rebuild_user_stats(dbsession)
+        # The products were written without record_changes
+        force_reset(dbsession)
+    print(f'Rebuilt order statistics for {updated:,} users in {time.perf_counter() - started:.1f}s')
+    if postgresql:
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            for table in TABLES:
+                connection.execute(text(f'ANALYZE {table}'))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='generate_dataset',
+        description='Fill the database with a synthetic dataset for benchmarking.'
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('--products', type=int, default=0, help='products to add')
+    parser.add_argument('--users', type=int, default=0, help='users to add')
+    parser.add_argument('--orders', type=int, default=0,
+                        help='orders to add, placed by the users and for the products added')
+    parser.add_argument('--seed', type=int, default=1, help='(default: 1)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='writer processes (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=20000,
+                        help='rows per transaction (default: 20000)')
+    parser.add_argument('--months', type=int, default=12,
+                        help='months the orders are spread over (default: 12)')
+    parser.add_argument('--until', type=date.fromisoformat, default=date.today(),
+                        help='date of the newest orders (default: today)')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='power-law exponent of product popularity (default: 1.0)')
+    parser.add_argument('--password', default='password',
+                        help='password of the synthetic users (default: password)')
+    args = parser.parse_args(argv[1:])
+    if args.orders and not (args.products and args.users):
+        parser.error('--orders needs --products and --users')
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = make_engine(settings)
+    postgresql = engine.dialect.name == 'postgresql'
+    workers = max(args.workers, 1) if postgresql else 1
+
+    end = datetime(args.until.year, args.until.month, args.until.day) + timedelta(days=1)
+    with engine.connect() as connection:
+        plan = Plan(
+            seed=args.seed,
+            products=args.products,
+            users=args.users,
+            orders=args.orders,
+            product_offset=max_id(connection, Product),
+            user_offset=max_id(connection, User),
+            order_offset=max_id(connection, Order),
+            start=end - timedelta(days=round(30.44 * args.months)),
+            end=end,
+            skew=args.skew,
+            # One hash for everyone: bcrypt is slow by design
+            password_hash=bcrypt.hashpw(args.password.encode('utf-8'),
+                                        bcrypt.gensalt()).decode('utf-8'),
+        )
+
+    print(f'Writing with {workers} worker(s), {args.chunk_size:,} rows per transaction')
+    started = time.perf_counter()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _start_worker, (settings,))
+    else:
+        pool = None
+        _start_worker(settings)
+    try:
+        # Users and products first: orders refer to them
+        run_phase(pool, 'products', plan, plan.products, args.chunk_size)
+        run_phase(pool, 'users', plan, plan.users, args.chunk_size)
+        run_phase(pool, 'orders', plan, plan.orders, args.chunk_size)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    finish(engine, postgresql)
+    print(f'Done in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,9 @@ from pyramid.scripts.common import parse_vars
 from sqlalchemy import engine_from_config
 from sqlalchemy.orm import sessionmaker
 
+from ..changefeed import record_changes
 from ..models import Base
+from ..models.inventory import StockSlot
 from ..models.product import Product
 
 
@@ -55,9 +57,13 @@ def main(argv=sys.argv):
         db = Session()
         zope.sqlalchemy.register(db)
         # Optional: clear existing products
+        removed = [product_id for (product_id,) in db.query(Product.id)]
+        # Explicitly: SQLite does not cascade, and a new product given an
+        # old id would inherit its slots
+        db.query(StockSlot).delete()
         db.query(Product).delete()
 
-        count = 0
+        added = []
         for item in items:
             try:
                 prod = Product(
@@ -70,10 +76,14 @@ def main(argv=sys.argv):
                     stock=int(item.get("rating", {}).get("count", 0)),
                 )
                 db.add(prod)
-                count += 1
+                added.append(prod)
             except Exception as err:
                 print(f"Error adding item {item.get('title')}: {err}")
-        print(f"Imported {count} products.")
+        db.flush()
+        # Deletions first: SQLite may give the new products the old ids
+        record_changes(db, removed, deleted=True)
+        record_changes(db, [product.id for product in added])
+        print(f"Imported {len(added)} products.")
 
 
 if __name__ == '__main__':
@@ -1,18 +1,23 @@
 import os
 import sys
 import transaction
+import zope.sqlalchemy
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
 )
 from pyramid.scripts.common import parse_vars
 
-from ..models import Base
+from ..changefeed import record_changes
 from ..models.user import User
 from ..models.product import Product
 from ..models.order import Order, OrderItem
-from sqlalchemy import engine_from_config
+from sqlalchemy import engine_from_config, inspect
 from sqlalchemy.orm import sessionmaker
+from alembic import command
+from alembic.config import Config
+
+BASELINE_REVISION = '5d2b9c4e1a07'
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
@@ -29,11 +34,19 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri, options=options)
     
     engine = engine_from_config(settings, prefix='sqlalchemy.')
-    Base.metadata.create_all(engine)
+    
+    # The schema is created and upgraded by the Alembic migrations. Tables
+    # created by create_all before migrations existed match the baseline.
+    alembic_cfg = Config(config_uri)
+    inspector = inspect(engine)
+    if inspector.has_table('users') and not inspector.has_table('alembic_version'):
+        command.stamp(alembic_cfg, BASELINE_REVISION)
+    command.upgrade(alembic_cfg, 'head')
     
     session_factory = sessionmaker(bind=engine)
     with transaction.manager:
         dbsession = session_factory()
+        zope.sqlalchemy.register(dbsession)
         
         # Create admin user if it doesn't exist
         admin = dbsession.query(User).filter_by(email='admin@example.com').first()
@@ -101,6 +114,8 @@ def main(argv=sys.argv):
             
             for product in products:
                 dbsession.add(product)
+            dbsession.flush()
+            record_changes(dbsession, [product.id for product in products])
             
             print(f'Added {len(products)} sample products')
 
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Maintenance command for the monthly range partitions of `orders` and
+`order_items` (PostgreSQL only).
+
+Usage:
+    manage_partitions <config_uri> setup   [--months-ahead N]
+    manage_partitions <config_uri> maintain [--months-ahead N]
+    manage_partitions <config_uri> archive --before YYYY-MM
+    manage_partitions <config_uri> status
+
+`setup` converts the existing tables into tables partitioned by month on
+`created_at` (run once, ideally during a maintenance window). `maintain`
+pre-creates partitions for the coming months and should be run from cron.
+`archive` detaches every partition that ends on or before the given month
+and rewrites it into a compact table in the `archive` schema.
+"""
+import argparse
+import re
+import sys
+from datetime import date, datetime
+
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import engine_from_config, text
+
+# Parent tables, in the order they have to be converted. order_items goes
+# first because its foreign key to orders has to be dropped before orders
+# can be rebuilt.
+PARTITIONED_TABLES = ('order_items', 'orders')
+ARCHIVE_SCHEMA = 'archive'
+PARTITION_NAME = re.compile(r'^(?P<table>\w+)_p(?P<year>\d{4})_(?P<month>\d{2})$')
+
+
+def month_start(value):
+    """Return the first day of the month containing `value`."""
+    return date(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    """Return the first day of the month `months` after `value`."""
+    index = value.year * 12 + (value.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f'{table}_p{month.year:04d}_{month.month:02d}'
+
+
+def is_partitioned(connection, table):
+    """Return True if `table` is already a partitioned parent table."""
+    relkind = connection.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {'table': table}
+    ).scalar()
+    return relkind == 'p'
+
+
+def list_partitions(connection, table):
+    """Return {month: partition_name} for the monthly partitions of `table`."""
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:table)"
+    ), {'table': table}).scalars()
+
+    partitions = {}
+    for name in rows:
+        match = PARTITION_NAME.match(name)
+        if match and match.group('table') == table:
+            month = date(int(match.group('year')), int(match.group('month')), 1)
+            partitions[month] = name
+    return partitions
+
+
+def create_partition(connection, table, month):
+    """Create the partition of `table` for `month` if it does not exist.
+
+    Rows that were routed to the default partition because the month had
+    no partition yet are moved into the new partition.
+    """
+    name = partition_name(table, month)
+    if connection.execute(text("SELECT to_regclass(:name)"), {'name': name}).scalar():
+        return False
+
+    lower, upper = month, add_months(month, 1)
+    default = f'{table}_default'
+    bounds = {'lower': lower, 'upper': upper}
+    stray_rows = connection.execute(text(
+        f"SELECT count(*) FROM {default} "
+        "WHERE created_at >= :lower AND created_at < :upper"
+    ), bounds).scalar()
+
+    if stray_rows:
+        connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+
+    connection.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+    ))
+
+    if stray_rows:
+        connection.execute(text(
+            f"INSERT INTO {table} SELECT * FROM {default} "
+            "WHERE created_at >= :lower AND created_at < :upper"
+        ), bounds)
+        connection.execute(text(
+            f"DELETE FROM {default} WHERE created_at >= :lower AND created_at < :upper"
+        ), bounds)
+        connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+        print(f"Moved {stray_rows} rows from {default} into {name}")
+
+    return True
+
+
+def convert_table(connection, table, first_month, last_month):
+    """Rebuild `table` as a table partitioned by month on created_at.
+
+    Indexes and outgoing foreign keys of the old table are recreated on the
+    new parent. Foreign keys *referencing* the table are dropped, because
+    PostgreSQL requires the partition key in every unique constraint and
+    the primary key therefore becomes (id, created_at).
+    """
+    new_table = f'{table}_partitioned'
+
+    sequence = connection.execute(
+        text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}
+    ).scalar()
+    indexes = connection.execute(text(
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+        "WHERE i.indrelid = to_regclass(:table) AND NOT i.indisprimary"
+    ), {'table': table}).scalars().all()
+    foreign_keys = connection.execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(:table) AND contype = 'f'"
+    ), {'table': table}).all()
+    referencing = connection.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE confrelid = to_regclass(:table) AND contype = 'f'"
+    ), {'table': table}).all()
+
+    for referencing_table, constraint in referencing:
+        connection.execute(text(f'ALTER TABLE {referencing_table} DROP CONSTRAINT "{constraint}"'))
+        print(f"Dropped foreign key {constraint} on {referencing_table}")
+
+    connection.execute(text(
+        f"CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+        "PARTITION BY RANGE (created_at)"
+    ))
+    connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {new_table} DEFAULT"))
+
+    month = first_month
+    while month <= last_month:
+        name = partition_name(table, month)
+        connection.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {new_table} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        ))
+        month = add_months(month, 1)
+
+    copied = connection.execute(text(f"INSERT INTO {new_table} SELECT * FROM {table}")).rowcount
+
+    if sequence:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    connection.execute(text(f"DROP TABLE {table}"))
+    connection.execute(text(f"ALTER TABLE {new_table} RENAME TO {table}"))
+    if sequence:
+        connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+
+    connection.execute(text(f"ALTER TABLE {table} ADD CONSTRAINT pk_{table} PRIMARY KEY (id, created_at)"))
+    for indexdef in indexes:
+        connection.execute(text(indexdef))
+    for constraint, definition in foreign_keys:
+        if any(f'REFERENCES {parent}(' in definition for parent in PARTITIONED_TABLES):
+            print(f"Skipping foreign key {constraint} (references a partitioned table)")
+            continue
+        connection.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT "{constraint}" {definition}'))
+
+    print(f"Converted {table}: {copied} rows, partitions {first_month:%Y-%m} to {last_month:%Y-%m}")
+
+
+def setup(connection, months_ahead):
+    current = month_start(datetime.utcnow())
+    for table in PARTITIONED_TABLES:
+        if is_partitioned(connection, table):
+            print(f"{table} is already partitioned")
+            continue
+        oldest = connection.execute(text(f"SELECT min(created_at) FROM {table}")).scalar()
+        first_month = month_start(oldest) if oldest else current
+        convert_table(connection, table, first_month, add_months(current, months_ahead))
+
+
+def maintain(connection, months_ahead):
+    current = month_start(datetime.utcnow())
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table):
+            print(f"{table} is not partitioned; run 'setup' first")
+            continue
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            if create_partition(connection, table, month):
+                print(f"Created partition {partition_name(table, month)}")
+
+
+def archive(connection, before):
+    """Detach partitions that end on or before `before` into the archive schema."""
+    connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+    for table in PARTITIONED_TABLES:
+        for month, name in sorted(list_partitions(connection, table).items()):
+            if add_months(month, 1) > before:
+                continue
+            connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+            # Rewriting the rows produces a densely packed heap without the
+            # dead tuples the live partition accumulated from status updates.
+            connection.execute(text(
+                f"CREATE TABLE {ARCHIVE_SCHEMA}.{name} AS SELECT * FROM {name} ORDER BY id"
+            ))
+            connection.execute(text(f"CREATE INDEX ON {ARCHIVE_SCHEMA}.{name} (id)"))
+            if table == 'order_items':
+                connection.execute(text(f"CREATE INDEX ON {ARCHIVE_SCHEMA}.{name} (order_id)"))
+            else:
+                connection.execute(text(f"CREATE INDEX ON {ARCHIVE_SCHEMA}.{name} (user_id)"))
+            connection.execute(text(f"DROP TABLE {name}"))
+            print(f"Archived {name} to {ARCHIVE_SCHEMA}.{name}")
+
+
+def status(connection):
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table):
+            print(f"{table}: not partitioned")
+            continue
+        partitions = list_partitions(connection, table)
+        default_rows = connection.execute(text(f"SELECT count(*) FROM {table}_default")).scalar()
+        print(f"{table}: {len(partitions)} monthly partitions, {default_rows} rows in default")
+        for month, name in sorted(partitions.items()):
+            print(f"  {name}")
+
+
+def parse_month(value):
+    try:
+        return datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid month '{value}', expected YYYY-MM")
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='manage_partitions',
+        description='Manage monthly partitions of the orders tables.'
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('action', choices=['setup', 'maintain', 'archive', 'status'])
+    parser.add_argument('--months-ahead', type=int, default=3,
+                        help='number of future monthly partitions to keep (default: 3)')
+    parser.add_argument('--before', type=parse_month,
+                        help='archive partitions ending on or before this month (YYYY-MM)')
+    args = parser.parse_args(argv[1:])
+
+    if args.action == 'archive' and not args.before:
+        parser.error('archive requires --before YYYY-MM')
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+
+    if engine.dialect.name != 'postgresql':
+        print(f"Partitioning requires PostgreSQL (configured database: {engine.dialect.name})")
+        sys.exit(1)
+
+    # DDL is transactional in PostgreSQL, so every action either completes
+    # or leaves the tables untouched.
+    with engine.begin() as connection:
+        if args.action == 'setup':
+            setup(connection, args.months_ahead)
+        elif args.action == 'maintain':
+            maintain(connection, args.months_ahead)
+        elif args.action == 'archive':
+            archive(connection, args.before)
+        else:
+            status(connection)
+
+
+if __name__ == '__main__':
+    main()
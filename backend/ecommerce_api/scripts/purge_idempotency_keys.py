@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Delete expired idempotency keys.
+
+Usage:
+    purge_idempotency_keys <config_uri> [--batch-size N]
+
+Keys expire `idempotency.ttl_hours` after their first request; expired
+keys are already ignored by the application, this only reclaims the
+space. Rows are deleted in batches, each in its own transaction, so the
+script can run from cron while the application is serving.
+"""
+import argparse
+import sys
+from datetime import datetime
+
+from pyramid.paster import get_appsettings, setup_logging
+from sqlalchemy import delete, engine_from_config, select
+
+from ..models.idempotency import IdempotencyKey
+
+
+def purge_expired(engine, batch_size, now=None):
+    """Delete the keys that expired before `now`; return how many."""
+    now = now or datetime.utcnow()
+    expired = (
+        select(IdempotencyKey.id)
+        .where(IdempotencyKey.expires_at < now)
+        .limit(batch_size)
+        .scalar_subquery()
+    )
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            deleted = connection.execute(
+                delete(IdempotencyKey).where(IdempotencyKey.id.in_(expired))
+            ).rowcount
+        total += deleted
+        if deleted < batch_size:
+            return total
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='purge_idempotency_keys',
+        description='Delete expired idempotency keys.'
+    )
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows deleted per transaction (default: 5000)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+    deleted = purge_expired(engine, args.batch_size)
+    print(f'Deleted {deleted} expired idempotency keys')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import transaction
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+)
+from pyramid.scripts.common import parse_vars
+
+from ..models.user import User
+from ..models.order import Order
+from sqlalchemy import engine_from_config, func
+from sqlalchemy.orm import sessionmaker
+import zope.sqlalchemy
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [var=value]\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def rebuild_user_stats(dbsession):
+    """Recompute every user's order statistics from the orders table."""
+    stats = (
+        dbsession.query(
+            Order.user_id.label('user_id'),
+            func.count(Order.id).label('order_count'),
+            func.coalesce(func.sum(Order.total), 0).label('lifetime_spend'),
+            func.max(Order.created_at).label('last_order_at'),
+        )
+        .filter(Order.status != 'cancelled')
+        .group_by(Order.user_id)
+        .subquery()
+    )
+    
+    def from_stats(column):
+        return (
+            dbsession.query(column)
+            .filter(stats.c.user_id == User.id)
+            .scalar_subquery()
+        )
+    
+    # Users without orders have no row in the subquery and fall back to zero
+    updated = dbsession.query(User).update({
+        User.order_count: func.coalesce(from_stats(stats.c.order_count), 0),
+        User.lifetime_spend: func.coalesce(from_stats(stats.c.lifetime_spend), 0),
+        User.last_order_at: from_stats(stats.c.last_order_at),
+        User.updated_at: User.updated_at,
+    }, synchronize_session=False)
+    
+    return updated
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    
+    engine = engine_from_config(settings, prefix='sqlalchemy.')
+    session_factory = sessionmaker(bind=engine)
+    
+    with transaction.manager:
+        dbsession = session_factory()
+        zope.sqlalchemy.register(dbsession)
+        
+        updated = rebuild_user_stats(dbsession)
+        zope.sqlalchemy.mark_changed(dbsession)
+        print(f'Rebuilt order statistics for {updated} users')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Replay captured traffic and compare latencies between builds.
+
+Usage:
+    replay_traffic run <config_uri> <capture>... --output RESULTS
+                   [--speed X] [--concurrency N] [--limit N]
+    replay_traffic compare <baseline> <candidate> [--threshold PCT] [--min-count N]
+
+`run` loads the application of `config_uri` in this process and re-issues
+the requests recorded by the traffic capture (see ecommerce_api.capture;
+rotated `.gz` files are read too) in their original order and spacing,
+`--speed` times faster (0: as fast as the threads allow). Each captured
+user gets a synthetic account (`replay-customer-N@example.com`,
+`replay-admin-N@example.com`), created if missing and logged in through
+`/api/auth/login` before the replay, so session handling and per-user
+queries run as they did. Logins, logouts and registrations are not
+replayed. Redacted strings are sent as `replay`.
+
+The latency of every request is saved per route in RESULTS. `compare`
+prints the p50/p90/p99 of each route in two result files and marks the
+routes whose p50 or p99 grew by more than `--threshold` percent; it exits
+with status 1 if there are any.
+
+Replaying writes: point `config_uri` at a scratch database, e.g. one
+filled by generate_dataset.
+"""
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+import bcrypt
+from pyramid.paster import get_app, get_appsettings, setup_logging
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from webob import Request
+
+from ..capture import REDACTED
+from ..database import make_engine
+from ..models.user import User
+
+SKIPPED_ROUTES = frozenset(['login', 'logout', 'register'])
+SESSION_COOKIE = 'ecommerce_session'
+PLACEHOLDER = 'replay'
+
+
+def read_captures(paths):
+    """Return the captured requests of every file, oldest first."""
+    entries = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            entries.extend(json.loads(line) for line in f if line.strip())
+    entries.sort(key=lambda entry: entry['ts'])
+    return entries
+
+
+def materialize(value):
+    """Replace the redacted strings of a captured body."""
+    if isinstance(value, dict):
+        return {key: materialize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [materialize(item) for item in value]
+    return PLACEHOLDER if value == REDACTED else value
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted `values`."""
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Replayer:
+    """Issues captured requests against the application, with a session per captured user."""
+
+    def __init__(self, app, password):
+        self.app = app
+        self.password = password
+        self.cookies = {}
+        self.latencies = defaultdict(list)
+        self.captured = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.mismatched = defaultdict(int)
+        self.late = []
+        self._lock = threading.Lock()
+
+    def account(self, entry, accounts):
+        """Return the email of the synthetic account standing in for the entry's user."""
+        if entry['user'] == 'anonymous':
+            return None
+        key = (entry['user'], entry['session'])
+        if key not in accounts:
+            number = sum(1 for user, _ in accounts if user == entry['user']) + 1
+            accounts[key] = f'replay-{entry["user"]}-{number}@example.com'
+        return accounts[key]
+
+    def ensure_accounts(self, engine, accounts):
+        """Create the synthetic accounts that do not exist yet."""
+        # Cheap hashes: every account logs in before the replay starts
+        password_hash = bcrypt.hashpw(self.password.encode('utf-8'),
+                                      bcrypt.gensalt(rounds=4)).decode('utf-8')
+        with Session(bind=engine) as dbsession, dbsession.begin():
+            existing = set(dbsession.scalars(
+                select(User.email).where(User.email.in_(list(accounts.values())))
+            ))
+            for (user, _), email in accounts.items():
+                if email in existing:
+                    continue
+                dbsession.add(User(
+                    email=email, first_name='Replay', last_name=user.title(),
+                    password_hash=password_hash, is_admin=user == 'admin',
+                ))
+            dbsession.execute(
+                User.__table__.update()
+                .where(User.email.in_(list(accounts.values())))
+                .values(password_hash=password_hash, is_active=True)
+            )
+
+    def login(self, email):
+        request = Request.blank('/api/auth/login', method='POST',
+                                content_type='application/json',
+                                body=json.dumps({'email': email, 'password': self.password}).encode('utf-8'))
+        response = request.get_response(self.app)
+        if response.status_code != 200:
+            raise RuntimeError(f'Could not log in {email}: {response.status}')
+        self._keep_cookie(email, response)
+
+    def _keep_cookie(self, email, response):
+        for header in response.headers.getall('Set-Cookie'):
+            cookie = SimpleCookie(header)
+            if SESSION_COOKIE in cookie:
+                self.cookies[email] = cookie[SESSION_COOKIE].value
+
+    def issue(self, entry, email, due, started):
+        late = time.perf_counter() - started - due
+        query = [(name, PLACEHOLDER if value == REDACTED else value) for name, value in entry['query']]
+        url = entry['path'] + ('?' + urlencode(query) if query else '')
+        request = Request.blank(url, method=entry['method'])
+        if email is not None and email in self.cookies:
+            request.headers['Cookie'] = f'{SESSION_COOKIE}={self.cookies[email]}'
+        if 'body' in entry:
+            request.content_type = 'application/json'
+            request.body = json.dumps(materialize(entry['body'])).encode('utf-8')
+
+        timer = time.perf_counter()
+        response = request.get_response(self.app)
+        elapsed = (time.perf_counter() - timer) * 1000
+        route = entry['route'] or '(unmatched)'
+        with self._lock:
+            if email is not None:
+                self._keep_cookie(email, response)
+            self.latencies[route].append(round(elapsed, 3))
+            self.captured[route].append(entry['ms'])
+            self.statuses[route][str(response.status_code)] += 1
+            if response.status_code // 100 != entry['status'] // 100:
+                self.mismatched[route] += 1
+            self.late.append(late)
+
+    def results(self):
+        routes = {}
+        for route, latencies in self.latencies.items():
+            routes[route] = {
+                'latencies': sorted(latencies),
+                'captured': sorted(self.captured[route]),
+                'statuses': dict(self.statuses[route]),
+                'mismatched': self.mismatched[route],
+            }
+        return routes
+
+
+def run(args):
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    entries = [entry for entry in read_captures(args.captures)
+               if entry['route'] not in SKIPPED_ROUTES]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print('Nothing to replay')
+        return 0
+
+    app = get_app(args.config_uri)
+    replayer = Replayer(app, args.password)
+    accounts = {}
+    emails = [replayer.account(entry, accounts) for entry in entries]
+    if accounts:
+        engine = make_engine(settings)
+        replayer.ensure_accounts(engine, accounts)
+        engine.dispose()
+        for email in accounts.values():
+            replayer.login(email)
+    print(f'Replaying {len(entries):,} requests from {len(accounts):,} users '
+          f'at {"full" if not args.speed else f"{args.speed:g}x"} speed')
+
+    first = entries[0]['ts']
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = []
+        for entry, email in zip(entries, emails):
+            due = (entry['ts'] - first) / args.speed if args.speed else 0
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(replayer.issue, entry, email, due, started))
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+
+    routes = replayer.results()
+    late = sorted(replayer.late)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'config': args.config_uri,
+            'captures': args.captures,
+            'speed': args.speed,
+            'concurrency': args.concurrency,
+            'requests': len(entries),
+            'seconds': round(wall, 3),
+            'routes': routes,
+        }, f)
+
+    print(f'{"route":<24} {"count":>7} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8} '
+          f'{"captured p50":>13} {"5xx":>5} {"status differs":>15}')
+    for route, result in sorted(routes.items(), key=lambda item: -len(item[1]['latencies'])):
+        latencies = result['latencies']
+        errors = sum(count for status, count in result['statuses'].items() if status.startswith('5'))
+        print(f'{route:<24} {len(latencies):>7} {percentile(latencies, 0.5):>8.1f} '
+              f'{percentile(latencies, 0.9):>8.1f} {percentile(latencies, 0.99):>8.1f} '
+              f'{latencies[-1]:>8.1f} {percentile(result["captured"], 0.5):>13.1f} '
+              f'{errors:>5} {result["mismatched"]:>15}')
+    print(f'{len(entries):,} requests in {wall:.1f}s ({len(entries) / wall:,.0f}/s); '
+          f'started late by p99 {percentile(late, 0.99) * 1000:.0f} ms. Results in {args.output}')
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)['routes']
+    with open(args.candidate) as f:
+        candidate = json.load(f)['routes']
+
+    regressions = 0
+    print(f'{"route":<24} {"count":>7} {"p50":>18} {"p90":>18} {"p99":>18} {"p50 %":>7} {"p99 %":>7}')
+    for route in sorted(set(baseline) & set(candidate)):
+        before = baseline[route]['latencies']
+        after = candidate[route]['latencies']
+        if min(len(before), len(after)) < args.min_count:
+            continue
+        cells = []
+        for fraction in (0.5, 0.9, 0.99):
+            cells.append(f'{percentile(before, fraction):>7.1f} -> {percentile(after, fraction):<7.1f}')
+        changes = [
+            (percentile(after, fraction) - percentile(before, fraction))
+            / max(percentile(before, fraction), 0.001) * 100
+            for fraction in (0.5, 0.99)
+        ]
+        regressed = any(change > args.threshold for change in changes)
+        regressions += regressed
+        print(f'{route:<24} {len(after):>7} {" ".join(cells)} '
+              f'{changes[0]:>+6.0f}% {changes[1]:>+6.0f}%{"  slower" if regressed else ""}')
+    for route in sorted(set(baseline) ^ set(candidate)):
+        print(f'{route:<24} only in {"baseline" if route in baseline else "candidate"}')
+    print(f'{regressions} route(s) more than {args.threshold:g}% slower')
+    return 1 if regressions else 0
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='replay_traffic',
+        description='Replay captured traffic and compare latencies between builds.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='replay captured requests')
+    run_parser.add_argument('config_uri', help='e.g. development.ini')
+    run_parser.add_argument('captures', nargs='+', help='capture files (.gz too)')
+    run_parser.add_argument('--output', required=True, help='file the results are written to')
+    run_parser.add_argument('--speed', type=float, default=1.0,
+                            help='speed-up over the captured pace, 0 for no pauses (default: 1)')
+    run_parser.add_argument('--concurrency', type=int, default=16,
+                            help='requests in flight at most (default: 16)')
+    run_parser.add_argument('--limit', type=int, default=0, help='replay the first N requests only')
+    run_parser.add_argument('--password', default='replay-password',
+                            help='password of the synthetic accounts')
+
+    compare_parser = commands.add_parser('compare', help='compare two replay results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='percent slower that counts as a regression (default: 10)')
+    compare_parser.add_argument('--min-count', type=int, default=20,
+                                help='skip routes with fewer requests (default: 20)')
+
+    args = parser.parse_args(argv[1:])
+    if args.command == 'run':
+        return run(args)
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
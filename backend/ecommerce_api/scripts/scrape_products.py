@@ -9,13 +9,16 @@ import os
 import sys
 import requests
 import transaction
+import zope.sqlalchemy
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
 )
 from pyramid.scripts.common import parse_vars
 
+from ..changefeed import record_changes
 from ..models import Base
+from ..models.inventory import StockSlot
 from ..models.product import Product
 from sqlalchemy import engine_from_config
 from sqlalchemy.orm import sessionmaker
@@ -94,24 +97,33 @@ def main(argv=sys.argv):
     
     with transaction.manager:
         dbsession = session_factory()
+        zope.sqlalchemy.register(dbsession)
         
         # Clear existing products (optional - remove this if you want to keep existing products)
         print("Clearing existing products...")
+        removed = [product_id for (product_id,) in dbsession.query(Product.id)]
+        # Explicitly: SQLite does not cascade, and a new product given an
+        # old id would inherit its slots
+        dbsession.query(StockSlot).delete()
         dbsession.query(Product).delete()
         
         # Add scraped products
-        added_count = 0
+        added = []
         for product_data in products_data:
             try:
                 product = create_product_from_api_data(product_data)
                 dbsession.add(product)
-                added_count += 1
+                added.append(product)
                 print(f"Added product: {product.title}")
             except Exception as e:
                 print(f"Error adding product {product_data.get('title', 'Unknown')}: {e}")
                 continue
         
-        print(f"Successfully added {added_count} products to the database")
+        dbsession.flush()
+        # Deletions first: SQLite may give the new products the old ids
+        record_changes(dbsession, removed, deleted=True)
+        record_changes(dbsession, [product.id for product in added])
+        print(f"Successfully added {len(added)} products to the database")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Serve GET /api/orders/stream: customers' order status events over SSE.
+
+Usage:
+    serve_order_events <config_uri> [--listen HOST:PORT]
+
+Runs next to the WSGI application; the reverse proxy routes
+/api/orders/stream here (with buffering off) and everything else to the
+application. Customers are identified by the application's session
+cookie.
+
+All streams live in one asyncio event loop, so an idle customer costs a
+socket and a queue rather than a thread. One thread LISTENs for the
+events committed by update_order_status (PostgreSQL), or polls
+order_events every `events.poll_interval` seconds (other databases), and
+the hub hands each event to its customer's streams. A stream resuming
+with `Last-Event-ID` first gets the events it missed from the database.
+A stream that falls `events.queue_size` events behind is closed and
+resumes on reconnect. `GET /healthz` reports the open streams.
+
+Settings: events.listen, events.heartbeat (seconds between keep-alive
+comments), events.retry_ms, events.max_streams, events.queue_size,
+events.poll_interval, events.retention_hours (events older than this
+are deleted hourly).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import select
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import timedelta
+from urllib.parse import parse_qs, urlsplit
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.request import Request
+from sqlalchemy.orm import sessionmaker
+
+from .. import make_session_factory
+from ..database import make_engine
+from ..order_events import (
+    CHANNEL, REPLAY_BATCH, events_after, format_event, latest_event_id,
+    parse_event_id, purge_events, user_events_after,
+)
+
+log = logging.getLogger(__name__)
+
+STREAM_PATH = '/api/orders/stream'
+# Seconds a client has to send its request headers
+HEADER_TIMEOUT = 10
+PURGE_INTERVAL = 3600
+
+
+class Hub:
+    """The open streams of each customer."""
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.streams = defaultdict(set)
+        self.count = 0
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(self.queue_size)
+        self.streams[user_id].add(queue)
+        self.count += 1
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        streams = self.streams.get(user_id)
+        if streams is not None and queue in streams:
+            streams.discard(queue)
+            self.count -= 1
+            if not streams:
+                del self.streams[user_id]
+
+    def publish(self, message):
+        for queue in list(self.streams.get(message['userId'], ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind: end the stream, the client resumes from
+                # its last event id
+                self.close(queue)
+
+    def close(self, queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def close_all(self):
+        for streams in self.streams.values():
+            for queue in streams:
+                self.close(queue)
+
+
+class EventServer:
+    def __init__(self, engine, session_factory, settings):
+        self.engine = engine
+        self.dbmaker = sessionmaker(bind=engine)
+        self.session_factory = session_factory
+        self.heartbeat = float(settings.get('events.heartbeat', 15))
+        self.retry_ms = int(settings.get('events.retry_ms', 5000))
+        self.max_streams = int(settings.get('events.max_streams', 10000))
+        self.poll_interval = float(settings.get('events.poll_interval', 2))
+        self.retention = timedelta(hours=float(settings.get('events.retention_hours', 72)))
+        self.hub = Hub(int(settings.get('events.queue_size', 100)))
+        self.loop = None
+        self.stopping = threading.Event()
+        # Highest event id handed to the hub, to catch up after a lost
+        # database connection
+        self.last_id = 0
+
+    # Database access, off the event loop
+
+    def query(self, function, *args):
+        def run():
+            session = self.dbmaker()
+            try:
+                result = function(session, *args)
+                session.commit()
+                return result
+            finally:
+                session.close()
+        return self.loop.run_in_executor(None, run)
+
+    def deliver(self, messages):
+        for message in messages:
+            self.last_id = max(self.last_id, message['id'])
+            self.hub.publish(message)
+
+    def catch_up(self):
+        """Hand the hub the events committed since the last one it got."""
+        session = self.dbmaker()
+        try:
+            while not self.stopping.is_set():
+                messages = events_after(session, self.last_id)
+                if messages:
+                    self.loop.call_soon_threadsafe(self.deliver, messages)
+                    # deliver() runs later on the loop; page on from here
+                    self.last_id = messages[-1]['id']
+                if len(messages) < 1000:
+                    return
+        finally:
+            session.close()
+
+    def watch_events(self):
+        """Feed the hub from the database; runs in its own thread."""
+        session = self.dbmaker()
+        try:
+            self.last_id = latest_event_id(session)
+        finally:
+            session.close()
+        while not self.stopping.is_set():
+            try:
+                if self.engine.dialect.name == 'postgresql':
+                    self.listen()
+                else:
+                    self.catch_up()
+                    self.stopping.wait(self.poll_interval)
+            except Exception:
+                log.exception('Lost the order event feed; reconnecting')
+                self.stopping.wait(5)
+
+    def listen(self):
+        fairy = self.engine.raw_connection()
+        connection = fairy.driver_connection
+        try:
+            connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f'LISTEN {CHANNEL}')
+            # Events committed while no connection was listening
+            self.catch_up()
+            while not self.stopping.is_set():
+                for payload in self.notifications(connection):
+                    message = json.loads(payload)
+                    self.loop.call_soon_threadsafe(self.deliver, [message])
+        finally:
+            fairy.invalidate()
+
+    def notifications(self, connection, timeout=5):
+        if hasattr(connection, 'poll'):
+            # psycopg2
+            if select.select([connection], [], [], timeout)[0]:
+                connection.poll()
+                while connection.notifies:
+                    yield connection.notifies.pop(0).payload
+        else:
+            # psycopg 3.2+
+            for notify in connection.notifies(timeout=timeout):
+                yield notify.payload
+
+    async def purge(self):
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL)
+            try:
+                deleted = await self.query(purge_events, self.retention)
+                if deleted:
+                    log.info('Deleted %s order events older than %s', deleted, self.retention)
+            except Exception:
+                log.exception('Could not delete old order events')
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEADER_TIMEOUT)
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = request_line.split(' ', 2)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, ValueError):
+                return
+            headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                if value:
+                    headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            if method == 'OPTIONS':
+                await self.preflight(writer, headers)
+            elif method != 'GET':
+                await self.respond(writer, 405, {'error': 'Method not allowed'}, headers)
+            elif url.path == '/healthz':
+                await self.respond(writer, 200, {'status': 'ok', 'streams': self.hub.count}, headers)
+            elif url.path != STREAM_PATH:
+                await self.respond(writer, 404, {'error': 'Not found'}, headers)
+            else:
+                await self.stream(writer, headers, parse_qs(url.query))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            log.exception('Order event stream failed')
+        finally:
+            writer.close()
+
+    def cors_headers(self, headers):
+        origin = headers.get('origin')
+        if not origin:
+            return ''
+        return f'Access-Control-Allow-Origin: {origin}\r\nAccess-Control-Allow-Credentials: true\r\n'
+
+    async def preflight(self, writer, headers):
+        writer.write((
+            'HTTP/1.1 204 No Content\r\n'
+            f'{self.cors_headers(headers)}'
+            'Access-Control-Allow-Methods: GET,OPTIONS\r\n'
+            'Access-Control-Allow-Headers: Last-Event-ID, Cache-Control\r\n'
+            'Access-Control-Max-Age: 86400\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+        ).encode('latin-1'))
+        await writer.drain()
+
+    async def respond(self, writer, status, body, headers):
+        reasons = {200: 'OK', 401: 'Unauthorized', 404: 'Not Found',
+                   405: 'Method Not Allowed', 503: 'Service Unavailable'}
+        data = json.dumps(body).encode('utf-8')
+        writer.write((
+            f'HTTP/1.1 {status} {reasons[status]}\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n'
+            f'{self.cors_headers(headers)}Connection: close\r\n\r\n'
+        ).encode('latin-1') + data)
+        await writer.drain()
+
+    def user_id(self, headers):
+        # A session due for reissue registers a response callback, hence
+        # a Pyramid request; the cookie it would set is not needed here
+        request = Request.blank('/', headers={'Cookie': headers.get('cookie', '')})
+        return self.session_factory(request).get('user_id')
+
+    async def stream(self, writer, headers, params):
+        user_id = self.user_id(headers)
+        if not user_id:
+            return await self.respond(writer, 401, {'error': 'Authentication required'}, headers)
+        if self.hub.count >= self.max_streams:
+            return await self.respond(writer, 503, {'error': 'Too many open streams'}, headers)
+
+        # Subscribe before reading the missed events so none falls between
+        queue = self.hub.subscribe(user_id)
+        try:
+            writer.write((
+                'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n'
+                'Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n'
+                f'{self.cors_headers(headers)}Connection: keep-alive\r\n\r\n'
+                f'retry: {self.retry_ms}\n\n'
+            ).encode('latin-1'))
+
+            replayed = set()
+            last_id = parse_event_id(headers.get('last-event-id') or params.get('lastEventId', [''])[0])
+            if last_id is None:
+                writer.write(f'id: {await self.query(latest_event_id, user_id)}\n\n'.encode())
+            else:
+                while True:
+                    messages = await self.query(user_events_after, user_id, last_id)
+                    for message in messages:
+                        writer.write(format_event(message).encode('utf-8'))
+                        replayed.add(message['id'])
+                        last_id = message['id']
+                    await writer.drain()
+                    if len(messages) < REPLAY_BATCH:
+                        break
+            await writer.drain()
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from timing the stream out, and finds
+                    # clients that went away
+                    writer.write(b': keep-alive\n\n')
+                    await writer.drain()
+                    continue
+                if message is None:
+                    return
+                if message['id'] in replayed:
+                    continue
+                writer.write(format_event(message).encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.hub.unsubscribe(user_id, queue)
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, host, port, backlog=2048)
+        watcher = threading.Thread(target=self.watch_events, name='order-events', daemon=True)
+        watcher.start()
+        purger = asyncio.ensure_future(self.purge())
+
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, stop.set)
+        log.info('Serving order events on %s:%s', host, port)
+        async with server:
+            await stop.wait()
+            log.info('Closing %s order event streams', self.hub.count)
+            server.close()
+            self.stopping.set()
+            purger.cancel()
+            self.hub.close_all()
+            # Give the streams a moment to end cleanly
+            deadline = time.monotonic() + 5
+            while self.hub.count and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='serve_order_events',
+        description='Stream order status events to customers over SSE.'
+    )
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('--listen', help='HOST:PORT (default: events.listen or localhost:8001)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    listen = args.listen or settings.get('events.listen', 'localhost:8001')
+    host, _, port = listen.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+    if host == '*':
+        host = '0.0.0.0'
+
+    engine = make_engine(settings)
+    server = EventServer(engine, make_session_factory(settings), settings)
+    asyncio.run(server.serve(host, int(port)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Serve the application from several pre-forked worker processes.
+
+Usage:
+    serve_prefork <config_uri> [--workers N] [--threads N] [--listen HOST:PORT]
+                  [--max-requests N] [--max-rss MB] [--graceful-timeout SECONDS]
+
+The application is loaded once in the master process, which then forks
+the workers; they share the loaded code copy-on-write and accept
+connections from one listening socket, each with its own waitress thread
+pool. Database engines are reset in each child (see database.includeme),
+so no connection is shared across processes.
+
+Signals handled by the master:
+    SIGHUP           reload: start a new master with fresh code on the same
+                     socket, then drain the old workers
+    SIGTERM, SIGINT  drain all workers and exit
+    SIGTTIN, SIGTTOU add or remove a worker
+
+A worker drains (stops accepting, finishes its requests, exits) and is
+replaced after --max-requests requests or when its RSS exceeds --max-rss.
+"""
+import argparse
+import logging
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import plaster
+from pyramid.paster import get_app, setup_logging
+
+from ..process import current_rss
+
+log = logging.getLogger(__name__)
+
+LISTEN_FD_ENV = 'PREFORK_LISTEN_FD'
+OLD_WORKERS_ENV = 'PREFORK_OLD_WORKERS'
+
+
+def bind_socket(listen, backlog=2048):
+    host, _, port = listen.rpartition(':')
+    host = host.strip('[]') or '0.0.0.0'
+    if host == '*':
+        host = '0.0.0.0'
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, int(port)))
+    sock.listen(backlog)
+    return sock
+
+
+class Worker:
+    """One forked serving process."""
+
+    def __init__(self, app, sock, options, notify_fd):
+        self.app = app
+        self.sock = sock
+        self.options = options
+        self.notify_fd = notify_fd
+        self.requests = 0
+        self.draining = False
+        self.server = None
+        # Guards the count and the start of draining, reached from every
+        # waitress thread. Reentrant: the SIGTERM handler may interrupt a
+        # drain() already running in the main thread.
+        self._lock = threading.RLock()
+        jitter = options.max_requests_jitter
+        self.max_requests = options.max_requests + random.randint(0, jitter) if options.max_requests else 0
+
+    def run(self):
+        from waitress.server import create_server
+
+        for signum in (signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.drain('SIGTERM'))
+
+        self.server = create_server(self.count_requests, sockets=[self.sock], threads=self.options.threads)
+        log.info('Worker %s serving', os.getpid())
+        self.server.run()
+        self.server.task_dispatcher.shutdown()
+
+    def count_requests(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            with self._lock:
+                self.requests += 1
+                served = self.requests
+            if not self.draining:
+                if self.max_requests and served >= self.max_requests:
+                    self.drain(f'served {served} requests')
+                elif self.options.max_rss and current_rss() > self.options.max_rss:
+                    self.drain(f'RSS {current_rss() // 2**20} MB over the limit')
+
+    def drain(self, reason):
+        """Stop accepting connections, finish in-flight requests, then exit."""
+        with self._lock:
+            if self.draining:
+                return
+            self.draining = True
+        log.info('Worker %s draining: %s', os.getpid(), reason)
+        # Let the master start a replacement right away
+        try:
+            os.write(self.notify_fd, f'{os.getpid()}\n'.encode())
+        except OSError:
+            pass
+        self.server.trigger.pull_trigger(self._stop_accepting)
+        threading.Thread(target=self._wait_idle, name='drain', daemon=True).start()
+
+    def _stop_accepting(self):
+        # Runs in the server loop. Only this process's descriptor is closed;
+        # the other workers keep accepting on the shared socket.
+        self.server.accepting = False
+        self.server.del_channel()
+        self.server.socket.close()
+
+    def _busy_channels(self):
+        busy = 0
+        for channel in list(self.server.active_channels.values()):
+            if channel.requests or channel.total_outbufs_len:
+                busy += 1
+            else:
+                # Idle keep-alive connection: close it after this turn
+                channel.will_close = True
+        return busy
+
+    def _wait_idle(self):
+        deadline = time.monotonic() + self.options.graceful_timeout
+        while time.monotonic() < deadline:
+            if not self._busy_channels() and not self.server.task_dispatcher.queue:
+                break
+            self.server.pull_trigger()
+            time.sleep(0.05)
+        else:
+            log.warning('Worker %s still busy after %ss, exiting', os.getpid(), self.options.graceful_timeout)
+        self.server.trigger.pull_trigger(self._close_all)
+        # Fallback if the loop does not wake up
+        time.sleep(5)
+        os._exit(0)
+
+    def _close_all(self):
+        for dispatcher in list(self.server._map.values()):
+            dispatcher.close()
+
+
+class Master:
+    """Fork, supervise and replace the workers."""
+
+    def __init__(self, app, sock, options):
+        self.app = app
+        self.sock = sock
+        self.options = options
+        self.workers = {}
+        # Draining workers, no longer counted towards the target
+        self.retiring = {}
+        self.notify_r, self.notify_w = os.pipe()
+        os.set_blocking(self.notify_r, False)
+        self.target = options.workers
+        self.stopping = False
+        self.reload_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reload())
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGTTIN, lambda signum, frame: self.resize(1))
+        signal.signal(signal.SIGTTOU, lambda signum, frame: self.resize(-1))
+
+        host, port = self.sock.getsockname()[:2]
+        log.info('Master %s listening on %s:%s with %d workers', os.getpid(), host, port, self.target)
+
+        self.spawn_missing()
+        self.retire_previous_generation()
+
+        while True:
+            self.read_notifications()
+            self.reap()
+            if self.stopping:
+                if not self.workers and not self.retiring:
+                    log.info('All workers stopped')
+                    return
+            elif self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            else:
+                self.spawn_missing()
+                self.trim()
+            time.sleep(0.2)
+
+    def spawn_missing(self):
+        while len(self.workers) < self.target:
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    os.close(self.notify_r)
+                    Worker(self.app, self.sock, self.options, self.notify_w).run()
+                except Exception:
+                    log.exception('Worker %s crashed', os.getpid())
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.workers[pid] = time.monotonic()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            code = os.waitstatus_to_exitcode(status)
+            if self.workers.pop(pid, None) is not None and not self.stopping:
+                log.warning('Worker %s exited unexpectedly (%s), replacing it', pid, code)
+            elif self.retiring.pop(pid, None) is not None:
+                log.info('Worker %s finished draining (%s)', pid, code)
+
+    def read_notifications(self):
+        """Move workers that announced they are draining to `retiring`."""
+        try:
+            data = os.read(self.notify_r, 4096)
+        except BlockingIOError:
+            return
+        for pid in map(int, data.split()):
+            if pid in self.workers:
+                self.retiring[pid] = self.workers.pop(pid)
+
+    def trim(self):
+        # Drain the newest workers when the target was lowered
+        extra = len(self.workers) - self.target
+        for pid in sorted(self.workers, key=self.workers.get, reverse=True)[:max(extra, 0)]:
+            self.signal_worker(pid, signal.SIGTERM)
+            self.retiring[pid] = self.workers.pop(pid)
+
+    def resize(self, delta):
+        self.target = max(self.target + delta, 1)
+        log.info('Worker target is now %d', self.target)
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        log.info('Stopping: draining %d workers', len(self.workers))
+        for pid in list(self.workers):
+            self.signal_worker(pid, signal.SIGTERM)
+            self.retiring[pid] = self.workers.pop(pid)
+
+    def request_reload(self):
+        # Handled in the main loop, outside the signal handler
+        self.reload_requested = True
+
+    def reload(self):
+        """Re-execute the master with fresh code, keeping the socket and workers.
+
+        The new master loads the application, forks a new generation of
+        workers and then drains the old ones, so no request is refused.
+        """
+        check = subprocess.run(
+            [sys.executable, '-c', 'import sys; from pyramid.paster import get_app; get_app(sys.argv[1])',
+             self.options.config_uri],
+            capture_output=True, text=True
+        )
+        if check.returncode != 0:
+            log.error('Reload aborted, the application fails to load:\n%s', check.stderr[-2000:])
+            return
+
+        log.info('Reloading: re-executing the master')
+        os.set_inheritable(self.sock.fileno(), True)
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in [*self.workers, *self.retiring])
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def retire_previous_generation(self):
+        """After a reload, drain the workers of the previous master."""
+        old = os.environ.pop(OLD_WORKERS_ENV, '')
+        for pid in map(int, filter(None, old.split(','))):
+            self.signal_worker(pid, signal.SIGTERM)
+            self.retiring[pid] = time.monotonic()
+
+    @staticmethod
+    def signal_worker(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def parse_size(value):
+    """Parse a size in megabytes into bytes."""
+    try:
+        return int(float(value) * 2**20)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size '{value}', expected megabytes")
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='serve_prefork',
+        description='Serve the application from pre-forked worker processes.'
+    )
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='waitress threads per worker (default: 4)')
+    parser.add_argument('--listen',
+                        help='HOST:PORT (default: listen from [server:main])')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='replace a worker after this many requests (default: never)')
+    parser.add_argument('--max-requests-jitter', type=int, default=0,
+                        help='random extra requests so workers do not recycle together')
+    parser.add_argument('--max-rss', type=parse_size, default=0,
+                        help='replace a worker whose RSS exceeds this many MB')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds a draining worker may take to finish (default: 30)')
+    options = parser.parse_args(argv[1:])
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    setup_logging(options.config_uri)
+    listen = options.listen
+    if not listen:
+        server_settings = plaster.get_settings(options.config_uri, 'server:main')
+        listen = server_settings.get('listen', '0.0.0.0:8000').split()[0]
+
+    inherited = os.environ.pop(LISTEN_FD_ENV, None)
+    if inherited:
+        sock = socket.socket(fileno=int(inherited))
+    else:
+        sock = bind_socket(listen)
+
+    # Loaded once here; the workers inherit it when they are forked
+    app = get_app(options.config_uri)
+    Master(app, sock, options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Report where a worker's start-up time goes.
+
+Usage:
+    startup_report <config_uri> [--top N]
+
+Starts a fresh interpreter with `python -X importtime`, builds the WSGI
+application from the given configuration and serves one /healthz
+request. Prints the time of each phase, the import time per top-level
+package and the slowest individual modules.
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+# Runs in the child interpreter; prints the phase timings as JSON
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+from pyramid.paster import get_app
+from webob import Request
+imported = time.perf_counter()
+app = get_app(sys.argv[1])
+built = time.perf_counter()
+Request.blank('/healthz').get_response(app)
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'get_app_ms': (built - imported) * 1000,
+    'first_request_ms': (served - built) * 1000,
+}))
+'''
+
+
+def measure_startup(config_uri, importtime=False):
+    """Start a worker in a new interpreter and return its timings.
+
+    The result has the phase timings in milliseconds, `total_ms` measured
+    from process start, and with `importtime` the list of
+    (module, self_us, cumulative_us, depth) imports.
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', CHILD, config_uri]
+
+    started = time.perf_counter()
+    process = subprocess.run(command, capture_output=True, text=True)
+    total_ms = (time.perf_counter() - started) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(f'Application failed to start:\n{process.stderr[-2000:]}')
+
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['total_ms'] = total_ms
+    if importtime:
+        imports = []
+        for line in process.stderr.splitlines():
+            match = IMPORT_TIME.match(line)
+            if match:
+                self_us, cumulative_us, indent, module = match.groups()
+                imports.append((module, int(self_us), int(cumulative_us), len(indent) // 2))
+        result['imports'] = imports
+    return result
+
+
+def print_report(result, top):
+    phases = result['import_ms'] + result['get_app_ms'] + result['first_request_ms']
+    print(f"{'phase':<24} {'ms':>8}")
+    print(f"{'interpreter start':<24} {result['total_ms'] - phases:>8.1f}")
+    print(f"{'import pyramid':<24} {result['import_ms']:>8.1f}")
+    print(f"{'get_app (main)':<24} {result['get_app_ms']:>8.1f}")
+    print(f"{'first request':<24} {result['first_request_ms']:>8.1f}")
+    print(f"{'total':<24} {result['total_ms']:>8.1f}")
+
+    by_package = defaultdict(int)
+    for module, self_us, cumulative_us, depth in result['imports']:
+        by_package[module.split('.')[0]] += self_us
+    total_us = sum(by_package.values())
+
+    print(f'\nImport time by package ({total_us / 1000:.1f} ms in total)')
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f'  {package:<32} {self_us / 1000:>8.1f} ms {self_us * 100 / total_us:>5.1f}%')
+
+    print('\nSlowest modules (own time)')
+    slowest = sorted(result['imports'], key=lambda entry: -entry[1])[:top]
+    for module, self_us, cumulative_us, depth in slowest:
+        print(f'  {module:<48} {self_us / 1000:>8.1f} ms')
+
+    app_modules = [entry for entry in result['imports'] if entry[0].startswith('ecommerce_api')]
+    print(f'\necommerce_api modules imported: {len(app_modules)}')
+    for module, self_us, cumulative_us, depth in sorted(app_modules, key=lambda entry: -entry[2])[:top]:
+        print(f'  {module:<48} {cumulative_us / 1000:>8.1f} ms incl. imports')
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog='startup_report',
+        description='Show an import-time breakdown of application start-up.'
+    )
+    parser.add_argument('config_uri', help='e.g. production.ini')
+    parser.add_argument('--top', type=int, default=15, help='rows per section (default: 15)')
+    args = parser.parse_args(argv[1:])
+
+    try:
+        result = measure_startup(args.config_uri, importtime=True)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    print_report(result, args.top)
+
+
+if __name__ == '__main__':
+    main()
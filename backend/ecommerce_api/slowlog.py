@@ -0,0 +1,143 @@
+"""Slow-query recorder.
+
+Every statement is timed with two perf_counter() calls; anything above
+the configured threshold is kept in a bounded ring buffer together with
+the route that issued it. On PostgreSQL the plan can be captured with
+EXPLAIN (FORMAT JSON) on a separate connection in a background thread,
+so the request that ran the slow query is not delayed further.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+from time import perf_counter
+
+from pyramid.settings import asbool
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+def redact(parameters):
+    """Replace parameter values with their type, keeping the shape."""
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) for value in parameters]
+    if parameters is None:
+        return None
+    return f'<{type(parameters).__name__}>'
+
+class SlowQueryLog:
+    """Bounded log of statements slower than `threshold_ms`."""
+    
+    def __init__(self, engine, threshold_ms, size=200, explain=False, dump_path=None):
+        self.engine = engine
+        self.threshold = threshold_ms / 1000.0
+        self.entries = deque(maxlen=size)
+        self.explain = explain and engine.dialect.name == 'postgresql'
+        self.dump_path = dump_path
+        self._explain_queue = queue.Queue(maxsize=100)
+        self._pid = None
+        self._lock = threading.Lock()
+        
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+    
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context.slowlog_started = perf_counter()
+    
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = perf_counter() - context.slowlog_started
+        if duration < self.threshold:
+            return
+        if conn.info.get('slowlog_explain'):
+            return  # The EXPLAIN issued by this log
+        self.record(statement, parameters, duration, executemany)
+    
+    def record(self, statement, parameters, duration, executemany=False):
+        request = get_current_request()
+        route = None
+        if request is not None and request.matched_route is not None:
+            route = request.matched_route.name
+        
+        entry = {
+            'recorded_at': datetime.utcnow().isoformat(),
+            'route': route,
+            'duration_ms': round(duration * 1000, 2),
+            'statement': statement,
+            'parameters': redact(parameters),
+            'executemany': executemany,
+            'plan': None,
+        }
+        self.entries.append(entry)
+        log.warning('Slow query (%.1f ms) on route %s: %s', duration * 1000, route, statement[:200])
+        
+        is_select = statement.lstrip()[:6].upper() in ('SELECT', 'WITH')
+        if self.explain and is_select and not executemany:
+            self._ensure_explain_worker()
+            try:
+                # The real parameters only live in the queue until explained
+                self._explain_queue.put_nowait((entry, statement, parameters))
+            except queue.Full:
+                pass
+    
+    def _ensure_explain_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._explain_worker, name='slowlog-explain', daemon=True)
+            thread.start()
+    
+    def _explain_worker(self):
+        while True:
+            entry, statement, parameters = self._explain_queue.get()
+            try:
+                with self.engine.connect() as connection:
+                    connection.info['slowlog_explain'] = True
+                    try:
+                        plan = connection.exec_driver_sql(
+                            'EXPLAIN (FORMAT JSON) ' + statement, parameters
+                        ).scalar()
+                    finally:
+                        connection.info.pop('slowlog_explain', None)
+                entry['plan'] = plan if not isinstance(plan, str) else json.loads(plan)
+            except Exception as e:
+                entry['plan'] = {'error': str(e)}
+    
+    def snapshot(self):
+        """Return the recorded entries, newest first."""
+        return list(reversed(self.entries))
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def dump(self, path=None):
+        """Append the recorded entries to `path` as JSON lines."""
+        path = path or self.dump_path
+        entries = list(self.entries)
+        with open(path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, default=str) + '\n')
+        return path, len(entries)
+
+def includeme(config):
+    settings = config.get_settings()
+    threshold = settings.get('slowlog.threshold_ms')
+    if not threshold:
+        config.registry.slow_query_log = None
+        return
+    
+    config.registry.slow_query_log = SlowQueryLog(
+        config.registry.dbengine,
+        threshold_ms=float(threshold),
+        size=int(settings.get('slowlog.buffer_size', 200)),
+        explain=asbool(settings.get('slowlog.explain', False)),
+        dump_path=settings.get('slowlog.dump_path') or None,
+    )
@@ -0,0 +1,268 @@
+"""In-memory prefix index behind the search box's autocomplete.
+
+Every word of a product's title and category is a term. The terms are
+kept in a sorted list, and each term maps to its products in rank order
+(in stock first, then by rating, then by stock). A query looks up the
+range of terms starting with the typed prefix with bisect and merges
+their product lists. No request touches the database.
+
+Product views update the index after their transaction commits. A
+background thread rebuilds it from the database every
+`suggest.refresh_interval` seconds, which picks up writes made by other
+processes and by the import scripts.
+
+Lookups take no lock: a write builds new lists and then swaps them in.
+"""
+import bisect
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import select
+
+from .models.product import Product
+
+log = logging.getLogger(__name__)
+
+WORD = re.compile(r'\w+')
+
+def tokenize(text):
+    """Return the lowercased words of `text`."""
+    return WORD.findall(text.lower()) if text else []
+
+def prefix_end(prefix):
+    """Return the smallest string that sorts after every string starting with `prefix`."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class SuggestIndex:
+    """Prefix index over product titles and categories."""
+
+    def __init__(self, dbmaker, refresh_interval, max_scan=2000):
+        self.dbmaker = dbmaker
+        self.refresh_interval = refresh_interval
+        # Candidates examined per lookup when some query words filter them out
+        self.max_scan = max_scan
+        self.ready = False
+        self.built_at = None
+        # product id -> (rank key, title, image, terms)
+        self._products = {}
+        # sorted distinct terms
+        self._terms = []
+        # term -> rank keys of its products, sorted
+        self._postings = {}
+        self._write_lock = threading.Lock()
+        # Writes seen while a rebuild is loading rows, applied after it
+        self._replay = None
+        self._built = threading.Event()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def rank_key(product_id, rating, stock):
+        # Ascending order: in stock first, highest rating, most stock
+        stock = stock or 0
+        return (stock <= 0, -(rating or 0.0), -stock, product_id)
+
+    @staticmethod
+    def terms_for(title, category):
+        return frozenset(tokenize(title)) | frozenset(tokenize(category))
+
+    def ensure_running(self):
+        """Start the refresh thread in this process if it is not running.
+
+        Checked on every call so that worker processes forked from a
+        preloaded application start their own thread.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='suggest-index', daemon=True)
+            thread.start()
+
+    def wait_ready(self, timeout):
+        """Block until the first build has finished, at most `timeout` seconds."""
+        if not self.ready:
+            self._built.wait(timeout)
+        return self.ready
+
+    def _run(self):
+        while True:
+            try:
+                self.rebuild()
+            except Exception as e:
+                log.warning('Rebuilding the suggest index failed: %s', e)
+            time.sleep(self.refresh_interval)
+
+    def rebuild(self):
+        """Load every product from the database and replace the index."""
+        started = time.perf_counter()
+        with self._write_lock:
+            self._replay = []
+        session = self.dbmaker()
+        try:
+            rows = session.execute(select(
+                Product.id, Product.title, Product.image_url,
+                Product.category, Product.rating, Product.stock,
+            )).all()
+        except Exception:
+            with self._write_lock:
+                self._replay = None
+            raise
+        finally:
+            session.close()
+        self.load(rows)
+        log.info('Suggest index built: %d products, %d terms in %.0f ms',
+                 len(self._products), len(self._terms), (time.perf_counter() - started) * 1000)
+
+    def load(self, rows):
+        """Replace the index with `rows` of (id, title, image, category, rating, stock)."""
+        products = {}
+        postings = {}
+        for product_id, title, image, category, rating, stock in rows:
+            key = self.rank_key(product_id, rating, stock)
+            terms = self.terms_for(title, category)
+            products[product_id] = (key, title, image, terms)
+            for term in terms:
+                postings.setdefault(term, []).append(key)
+        for keys in postings.values():
+            keys.sort()
+
+        with self._write_lock:
+            self._products, self._postings, self._terms = products, postings, sorted(postings)
+            # Writes committed while the rows were loading may be missing from them
+            for apply, args in self._replay or ():
+                apply(*args)
+            self._replay = None
+        self.built_at = time.time()
+        self.ready = True
+        self._built.set()
+
+    def upsert(self, product_id, title, image, category, rating, stock):
+        """Add a product or replace its entry."""
+        with self._write_lock:
+            self._upsert(product_id, title, image, category, rating, stock)
+            if self._replay is not None:
+                self._replay.append((self._upsert, (product_id, title, image, category, rating, stock)))
+
+    def remove(self, product_id):
+        with self._write_lock:
+            self._remove(product_id)
+            if self._replay is not None:
+                self._replay.append((self._remove, (product_id,)))
+
+    def _upsert(self, product_id, title, image, category, rating, stock):
+        key = self.rank_key(product_id, rating, stock)
+        terms = self.terms_for(title, category)
+        self._remove(product_id)
+        self._products[product_id] = (key, title, image, terms)
+        new_terms = []
+        for term in terms:
+            keys = self._postings.get(term)
+            if keys is None:
+                new_terms.append(term)
+                self._postings[term] = [key]
+            else:
+                keys = list(keys)
+                bisect.insort(keys, key)
+                self._postings[term] = keys
+        if new_terms:
+            self._terms = sorted(self._terms + new_terms)
+
+    def _remove(self, product_id):
+        entry = self._products.pop(product_id, None)
+        if entry is None:
+            return
+        key, _, _, terms = entry
+        dropped = set()
+        for term in terms:
+            keys = [other for other in self._postings.get(term, ()) if other != key]
+            if keys:
+                self._postings[term] = keys
+            else:
+                dropped.add(term)
+        if dropped:
+            # Swap in the shorter list before the postings disappear
+            self._terms = [term for term in self._terms if term not in dropped]
+            for term in dropped:
+                self._postings.pop(term, None)
+
+    def search(self, query, limit=8):
+        """Return up to `limit` (id, title, image) matching every word of `query`.
+
+        Each query word matches a term it is a prefix of. The longest word
+        selects the candidates; the others filter them.
+        """
+        words = tokenize(query)
+        if not words or limit <= 0:
+            return []
+        words.sort(key=len, reverse=True)
+        lead, others = words[0], words[1:]
+
+        terms, postings, products = self._terms, self._postings, self._products
+        start = bisect.bisect_left(terms, lead)
+        end = bisect.bisect_left(terms, prefix_end(lead), start)
+        candidates = heapq.merge(*[postings.get(term, ()) for term in terms[start:end]])
+
+        results = []
+        seen = set()
+        scanned = 0
+        for key in candidates:
+            product_id = key[-1]
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+            scanned += 1
+            if scanned > self.max_scan:
+                break
+            entry = products.get(product_id)
+            if entry is None or entry[0] != key:
+                # Changed after this lookup started
+                continue
+            if others and not all(any(term.startswith(word) for term in entry[3]) for word in others):
+                continue
+            results.append((product_id, entry[1], entry[2]))
+            if len(results) >= limit:
+                break
+        return results
+
+    def stats(self):
+        return {
+            'ready': self.ready,
+            'products': len(self._products),
+            'terms': len(self._terms),
+            'built_at': self.built_at,
+        }
+
+def _after_commit(apply):
+    def hook(success):
+        if success:
+            try:
+                apply()
+            except Exception:
+                log.exception('Updating the suggest index failed')
+    return hook
+
+def product_saved(request, product):
+    """Update the suggest index with `product` once the request commits."""
+    index = request.registry.suggest_index
+    values = (product.id, product.title, product.image_url, product.category,
+              product.rating, product.stock)
+    request.tm.get().addAfterCommitHook(_after_commit(lambda: index.upsert(*values)))
+
+def product_deleted(request, product_id):
+    """Drop the product from the suggest index once the request commits."""
+    index = request.registry.suggest_index
+    request.tm.get().addAfterCommitHook(_after_commit(lambda: index.remove(product_id)))
+
+def includeme(config):
+    settings = config.get_settings()
+    config.registry.suggest_index = SuggestIndex(
+        config.registry.dbmaker,
+        refresh_interval=float(settings.get('suggest.refresh_interval', 300)),
+    )
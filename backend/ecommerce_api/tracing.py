@@ -0,0 +1,491 @@
+"""Request tracing: spans for the tween chain, views, SQL, serialization and rendering.
+
+Enabled by `tracing.sample_rate` (the share of requests traced; 0
+disables tracing and installs none of the hooks). A request that carries
+a W3C `traceparent` header continues that trace and follows its sampled
+flag, so traces started by a proxy or another service line up. Each
+traced request gets a tree of spans:
+
+- `GET /api/orders/{id}`: the whole tween chain, with `transaction`
+  (everything under pyramid_tm) and `commit` (the rest, i.e. the commit);
+- `view <name>`: the view deriver chain, with `callable` (the view
+  function) and `render` (turning its result into the response);
+- `SELECT orders`, `UPDATE products`, ...: each SQL statement, wherever it
+  runs, e.g. a lazy load inside a serializer;
+- `Order.to_dict`, ...: model serialization, outermost call only.
+
+A trace holds at most `tracing.max_spans` spans. Finished traces are kept
+in memory (`tracing.buffer_size`) for the flame summary at
+`/api/admin/traces/flame`, and exported in batches by a background thread
+as OTLP/JSON: appended to `tracing.export_path` (one ExportTraceService
+request per line, readable by the OpenTelemetry collector's
+`otlpjsonfile` receiver; `{pid}` is replaced by the process id) and/or
+posted to the collector at `tracing.otlp_endpoint`.
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from collections import deque
+
+from pyramid.threadlocal import get_current_request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# Set by includeme; the serialization hooks cost one global read when off
+ENABLED = False
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)', re.IGNORECASE)
+MAX_STATEMENT_LENGTH = 2000
+
+def _new_id(bits):
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+def sql_span_name(statement):
+    """Return `<operation> <table>`, e.g. `SELECT orders`."""
+    words = statement.split(None, 1)
+    operation = words[0].upper() if words else 'SQL'
+    table = SQL_TABLE.search(statement)
+    return f'{operation} {table.group(1)}' if table else operation
+
+class Span:
+    __slots__ = ('span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, span_id, parent_id, name, kind, start, attributes):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def duration_ms(self):
+        return (self.end - self.start) / 1e6
+
+class Trace:
+    """The spans of one request, opened and closed on the request's thread."""
+
+    def __init__(self, trace_id, parent_id, max_spans):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self._stack = []
+        # Bookkeeping of the tweens, view derivers and serializers
+        self.transaction = None
+        self.callable_end = None
+        self.serializing = False
+
+    def start(self, name, kind=INTERNAL, attributes=None, start=None):
+        """Open a span under the current one; return it, or None past max_spans."""
+        if len(self.spans) >= self.max_spans:
+            self.dropped += 1
+            return None
+        parent = self._stack[-1].span_id if self._stack else self.parent_id
+        span = Span(_new_id(64), parent, name, kind, start or time.time_ns(), attributes or {})
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def end(self, span, error=None):
+        if span is None:
+            return
+        span.end = time.time_ns()
+        span.error = error
+        # Spans close in order, except when an exception skipped some ends
+        while self._stack:
+            if self._stack.pop() is span:
+                break
+
+    def add(self, name, start, end, kind=INTERNAL):
+        """Record an already finished span under the current one."""
+        span = self.start(name, kind, start=start)
+        if span is not None:
+            self.end(span)
+            span.end = end
+        return span
+
+    @property
+    def root(self):
+        return self.spans[0] if self.spans else None
+
+def current_trace():
+    """Return the trace of the request on this thread, or None."""
+    if not ENABLED:
+        return None
+    return getattr(get_current_request(), 'trace', None)
+
+def serialization_span(name):
+    """Trace calls of the decorated serializer as `name`, outermost call only."""
+    def decorate(method):
+        @functools.wraps(method)
+        def traced(*args, **kwargs):
+            trace = current_trace()
+            if trace is None or trace.serializing:
+                return method(*args, **kwargs)
+            trace.serializing = True
+            span = trace.start(name, attributes={'code.function': name})
+            try:
+                return method(*args, **kwargs)
+            finally:
+                trace.serializing = False
+                trace.end(span)
+        return traced
+    return decorate
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def otlp_request(traces, service_name):
+    """Return an OTLP/JSON ExportTraceServiceRequest holding `traces`."""
+    spans = []
+    for trace in traces:
+        for span in trace.spans:
+            otlp_span = {
+                'traceId': trace.trace_id,
+                'spanId': span.span_id,
+                'name': span.name,
+                'kind': span.kind,
+                'startTimeUnixNano': str(span.start),
+                'endTimeUnixNano': str(span.end or span.start),
+                'attributes': [
+                    {'key': key, 'value': _otlp_value(value)} for key, value in span.attributes.items()
+                ],
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            if span.error:
+                otlp_span['status'] = {'code': STATUS_ERROR, 'message': span.error}
+            spans.append(otlp_span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': service_name}},
+            {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+        ]},
+        'scopeSpans': [{'scope': {'name': __name__}, 'spans': spans}],
+    }]}
+
+def flame_tree(traces):
+    """Merge the span trees of `traces` by span name path.
+
+    Returns nested nodes `{name, count, total_ms, self_ms, children}`,
+    children sorted by total time.
+    """
+    root = {'name': 'all', 'count': 0, 'total_ms': 0.0, 'self_ms': 0.0, 'children': {}}
+    for trace in traces:
+        children = {}
+        for span in trace.spans:
+            children.setdefault(span.parent_id, []).append(span)
+
+        def merge(node, span):
+            child = node['children'].setdefault(span.name, {
+                'name': span.name, 'count': 0, 'total_ms': 0.0, 'self_ms': 0.0, 'children': {},
+            })
+            kids = children.get(span.span_id, [])
+            duration = span.duration_ms if span.end else 0.0
+            child['count'] += 1
+            child['total_ms'] += duration
+            child['self_ms'] += max(duration - sum(kid.duration_ms for kid in kids if kid.end), 0.0)
+            for kid in kids:
+                merge(child, kid)
+
+        if trace.root is not None and trace.root.end:
+            root['count'] += 1
+            root['total_ms'] += trace.root.duration_ms
+            merge(root, trace.root)
+
+    def finish(node):
+        node['total_ms'] = round(node['total_ms'], 3)
+        node['self_ms'] = round(node['self_ms'], 3)
+        node['children'] = sorted(
+            (finish(child) for child in node['children'].values()),
+            key=lambda child: -child['total_ms'],
+        )
+        return node
+    return finish(root)
+
+def folded_stacks(node, prefix=()):
+    """Yield `a;b;c <self microseconds>` lines, the input of flame graph tools."""
+    path = prefix + (node['name'],) if prefix or node['name'] != 'all' else ()
+    if path and node['self_ms'] > 0:
+        yield f'{";".join(path)} {round(node["self_ms"] * 1000)}'
+    for child in node['children']:
+        yield from folded_stacks(child, path)
+
+class Tracer:
+    """Sampling decisions, the buffer of recent traces and the exporter thread."""
+
+    def __init__(self, sample_rate, max_spans=1000, buffer_size=500, export_path=None,
+                 otlp_endpoint=None, export_interval=5.0, service_name='ecommerce_api',
+                 metrics=None):
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.traces = deque(maxlen=buffer_size)
+        self.export_path = export_path
+        self.otlp_endpoint = otlp_endpoint
+        self.export_interval = export_interval
+        self.service_name = service_name
+        self.metrics = metrics
+        self._export_queue = queue.Queue(maxsize=10000)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _count(self, name, value=1, **labels):
+        if self.metrics is not None:
+            self.metrics.incr(name, value, **labels)
+
+    def begin(self, request):
+        """Return a new Trace if the request is sampled, else None."""
+        parent = TRACEPARENT.match(request.headers.get('traceparent', ''))
+        if parent is not None:
+            if not int(parent.group(3), 16) & 1:
+                return None
+            return Trace(parent.group(1), parent.group(2), self.max_spans)
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        return Trace(_new_id(128), None, self.max_spans)
+
+    def finish(self, trace):
+        self.traces.append(trace)
+        self._count('traces_sampled_total')
+        if trace.dropped:
+            self._count('trace_spans_dropped_total', trace.dropped)
+        if self.export_path or self.otlp_endpoint:
+            self._ensure_exporter()
+            try:
+                self._export_queue.put_nowait(trace)
+            except queue.Full:
+                self._count('trace_exports_dropped_total')
+
+    def snapshot(self, route=None):
+        traces = list(self.traces)
+        if route is not None:
+            traces = [trace for trace in traces
+                      if trace.root is not None and trace.root.attributes.get('http.route_name') == route]
+        return traces
+
+    def clear(self):
+        self.traces.clear()
+
+    def _ensure_exporter(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._export_queue = queue.Queue(maxsize=self._export_queue.maxsize)
+            thread = threading.Thread(target=self._export_worker, args=(self._export_queue,),
+                                      name='trace-export', daemon=True)
+            thread.start()
+
+    def _export_worker(self, traces):
+        while True:
+            batch = [traces.get()]
+            deadline = time.monotonic() + self.export_interval
+            while len(batch) < 512:
+                try:
+                    batch.append(traces.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            self.export(batch)
+
+    def export(self, batch):
+        body = json.dumps(otlp_request(batch, self.service_name), separators=(',', ':'))
+        if self.export_path:
+            try:
+                with open(self.export_path.format(pid=os.getpid()), 'a') as f:
+                    f.write(body + '\n')
+                self._count('trace_exports_total', exporter='file')
+            except OSError:
+                log.exception('Could not write traces to %s', self.export_path)
+                self._count('trace_export_errors_total', exporter='file')
+        if self.otlp_endpoint:
+            request = urllib.request.Request(
+                self.otlp_endpoint, data=body.encode('utf-8'), method='POST',
+                headers={'Content-Type': 'application/json'},
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+                self._count('trace_exports_total', exporter='otlp')
+            except OSError as e:
+                log.warning('Could not send traces to %s: %s', self.otlp_endpoint, e)
+                self._count('trace_export_errors_total', exporter='otlp')
+
+def tracing_tween_factory(handler, registry):
+    """Open the root span of sampled requests, around pyramid_tm."""
+    tracer = registry.tracer
+
+    def tracing_tween(request):
+        trace = tracer.begin(request)
+        if trace is None:
+            return handler(request)
+        request.trace = trace
+        root = trace.start(f'{request.method} {request.path}', SERVER, {
+            'http.method': request.method,
+            'http.target': request.path_qs,
+        })
+        error = None
+        try:
+            response = handler(request)
+            return response
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if trace.transaction is not None and trace.transaction.end:
+                trace.add('commit', trace.transaction.end, time.time_ns())
+            if request.matched_route is not None:
+                root.name = f'{request.method} {request.matched_route.pattern}'
+                root.attributes['http.route'] = request.matched_route.pattern
+                root.attributes['http.route_name'] = request.matched_route.name
+            if error is None:
+                root.attributes['http.status_code'] = response.status_code
+            trace.end(root, error)
+            tracer.finish(trace)
+
+    return tracing_tween
+
+def transaction_tween_factory(handler, registry):
+    """Span of everything pyramid_tm runs in the transaction."""
+    def transaction_tween(request):
+        trace = getattr(request, 'trace', None)
+        if trace is None:
+            return handler(request)
+        trace.transaction = span = trace.start('transaction')
+        error = None
+        try:
+            return handler(request)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            trace.end(span, error)
+
+    return transaction_tween
+
+def view_span_deriver(view, info):
+    """Span of the view, including rendering its result."""
+    name = f'view {getattr(info.original_view, "__name__", type(info.original_view).__name__)}'
+
+    def traced_view(context, request):
+        trace = getattr(request, 'trace', None)
+        if trace is None:
+            return view(context, request)
+        span = trace.start(name)
+        trace.callable_end = None
+        error = None
+        try:
+            return view(context, request)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if trace.callable_end is not None:
+                trace.add('render', trace.callable_end, time.time_ns())
+            trace.end(span, error)
+
+    return traced_view
+
+def callable_span_deriver(view, info):
+    """Span of the view callable alone, before its result is rendered."""
+    def traced_callable(context, request):
+        trace = getattr(request, 'trace', None)
+        if trace is None:
+            return view(context, request)
+        span = trace.start('callable')
+        error = None
+        try:
+            return view(context, request)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            trace.end(span, error)
+            if span is not None:
+                trace.callable_end = span.end
+
+    return traced_callable
+
+def instrument_engine(engine):
+    """Open a span for every statement run while a traced request is current."""
+    system = engine.dialect.name
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = current_trace()
+        if trace is not None:
+            span = trace.start(sql_span_name(statement), CLIENT, {
+                'db.system': system,
+                'db.statement': statement[:MAX_STATEMENT_LENGTH],
+                'db.executemany': executemany,
+            })
+            context.trace_span = (trace, span)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace, span = getattr(context, 'trace_span', (None, None))
+        if span is not None:
+            trace.end(span)
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                span.attributes['db.rows'] = cursor.rowcount
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        trace, span = getattr(exception_context.execution_context, 'trace_span', (None, None))
+        if span is not None:
+            trace.end(span, type(exception_context.original_exception).__name__)
+
+def includeme(config):
+    global ENABLED
+    settings = config.get_settings()
+    sample_rate = float(settings.get('tracing.sample_rate') or 0)
+    if sample_rate <= 0:
+        config.registry.tracer = None
+        return
+
+    config.registry.tracer = Tracer(
+        sample_rate,
+        max_spans=int(settings.get('tracing.max_spans', 1000)),
+        buffer_size=int(settings.get('tracing.buffer_size', 500)),
+        export_path=settings.get('tracing.export_path') or None,
+        otlp_endpoint=settings.get('tracing.otlp_endpoint') or None,
+        export_interval=float(settings.get('tracing.export_interval', 5)),
+        service_name=settings.get('tracing.service_name', 'ecommerce_api'),
+        metrics=getattr(config.registry, 'metrics', None),
+    )
+    ENABLED = True
+    instrument_engine(config.registry.dbengine)
+    config.add_tween(
+        'ecommerce_api.tracing.tracing_tween_factory',
+        over='pyramid_tm.tm_tween_factory',
+    )
+    config.add_tween(
+        'ecommerce_api.tracing.transaction_tween_factory',
+        under='pyramid_tm.tm_tween_factory',
+    )
+    config.add_view_deriver(view_span_deriver, under='decorated_view', over='rendered_view')
+    config.add_view_deriver(callable_span_deriver, under='rendered_view', over='mapped_view')
@@ -0,0 +1,55 @@
+"""Optimistic concurrency control for edits to products, orders and users.
+
+Those tables have a `version` column that SQLAlchemy increments on every
+ORM update (`version_id_col`), adding `WHERE version = <version read>` to
+the UPDATE. Responses carry the version as their ETag, and an edit:
+
+- is refused with 412 when its `If-Match` header does not name the
+  current version, so the client reloads before editing again;
+- is refused with 409 when another edit commits between reading the row
+  and writing it, instead of silently overwriting that edit.
+
+Neither takes a lock. `If-Match` is optional; without it the version
+check still catches edits that race within one request. Stock moved by
+checkouts is not an edit and leaves the version alone.
+"""
+from pyramid.httpexceptions import HTTPConflict, HTTPPreconditionFailed
+from sqlalchemy.orm.exc import StaleDataError
+
+def set_etag(request, obj):
+    """Send the version of `obj` as the response's ETag."""
+    request.response.etag = str(obj.version)
+
+def _count_conflict(request, resource, reason):
+    metrics = getattr(request.registry, 'metrics', None)
+    if metrics is not None:
+        metrics.incr('edit_conflicts_total', resource=resource, reason=reason)
+
+def check_if_match(request, obj, resource):
+    """Return a 412 response if `If-Match` names another version of `obj`."""
+    if str(obj.version) in request.if_match:
+        return None
+    _count_conflict(request, resource, 'if_match')
+    response = HTTPPreconditionFailed(json={
+        'error': f'The {resource} has changed since it was read; reload it and try again'
+    })
+    response.etag = str(obj.version)
+    return response
+
+def save_changes(request, obj, resource):
+    """Write the pending edit to `obj` now rather than at commit.
+
+    Returns a 409 response, with the request's changes rolled back, if
+    another edit to `obj` committed first; otherwise sets the new ETag.
+    """
+    try:
+        request.db.flush()
+    except StaleDataError:
+        request.db.rollback()
+        request.tm.doom()
+        _count_conflict(request, resource, 'concurrent_edit')
+        return HTTPConflict(json={
+            'error': f'The {resource} was changed by another request; reload it and try again'
+        })
+    set_etag(request, obj)
+    return None
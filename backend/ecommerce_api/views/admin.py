@@ -0,0 +1,220 @@
+import os
+
+from pyramid.view import view_config
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.response import Response
+from sqlalchemy import func, select
+
+from ..models.inventory import StockMovement, StockReservation, StockSlot
+from ..memprof import GROUPINGS, describe_statistic
+from ..models.product import Product
+from ..tracing import flame_tree, folded_stacks
+
+def get_slow_query_log(request):
+    slow_query_log = request.registry.slow_query_log
+    if slow_query_log is None:
+        raise HTTPNotFound(json={'error': 'Slow query log is disabled (set slowlog.threshold_ms)'})
+    return slow_query_log
+
+@view_config(route_name='admin_slow_queries', request_method='GET', renderer='json', permission='admin')
+def get_slow_queries(request):
+    """List recorded slow queries, newest first. Admin only."""
+    slow_query_log = get_slow_query_log(request)
+    entries = slow_query_log.snapshot()
+    if 'route' in request.params:
+        entries = [entry for entry in entries if entry['route'] == request.params['route']]
+    return {
+        'threshold_ms': slow_query_log.threshold * 1000,
+        'items': entries,
+        'total': len(entries)
+    }
+
+@view_config(route_name='admin_slow_queries', request_method='DELETE', renderer='json', permission='admin')
+def clear_slow_queries(request):
+    """Clear the slow query log. Admin only."""
+    get_slow_query_log(request).clear()
+    return {'message': 'Slow query log cleared'}
+
+@view_config(route_name='admin_slow_queries_dump', request_method='POST', renderer='json', permission='admin')
+def dump_slow_queries(request):
+    """Append the slow query log to the configured dump file. Admin only."""
+    slow_query_log = get_slow_query_log(request)
+    if not slow_query_log.dump_path:
+        return HTTPBadRequest(json={'error': 'No dump file configured (set slowlog.dump_path)'})
+    path, count = slow_query_log.dump()
+    return {'message': f'Wrote {count} entries', 'path': path}
+
+@view_config(route_name='admin_metrics', request_method='GET', renderer='json', permission='admin')
+def get_metrics(request):
+    """Process metrics as JSON, or Prometheus text with ?format=prometheus. Admin only."""
+    metrics = request.registry.metrics
+    if request.params.get('format') == 'prometheus':
+        return Response(metrics.prometheus(), content_type='text/plain', charset='utf-8')
+    return metrics.snapshot()
+
+def get_tracer(request):
+    tracer = request.registry.tracer
+    if tracer is None:
+        raise HTTPNotFound(json={'error': 'Tracing is disabled (set tracing.sample_rate)'})
+    return tracer
+
+@view_config(route_name='admin_traces', request_method='GET', renderer='json', permission='admin')
+def get_traces(request):
+    """List the buffered traces, newest first. Admin only."""
+    traces = get_tracer(request).snapshot(request.params.get('route'))
+    items = [{
+        'traceId': trace.trace_id,
+        'name': trace.root.name,
+        'durationMs': round(trace.root.duration_ms, 3),
+        'spans': len(trace.spans),
+        'droppedSpans': trace.dropped,
+        'error': trace.root.error,
+    } for trace in reversed(traces) if trace.root is not None and trace.root.end]
+    return {'items': items, 'total': len(items)}
+
+@view_config(route_name='admin_traces', request_method='DELETE', renderer='json', permission='admin')
+def clear_traces(request):
+    """Clear the buffered traces. Admin only."""
+    get_tracer(request).clear()
+    return {'message': 'Traces cleared'}
+
+@view_config(route_name='admin_traces_flame', request_method='GET', renderer='json', permission='admin')
+def get_trace_flame(request):
+    """Buffered traces merged by span path, as a tree or folded stacks (?format=folded). Admin only."""
+    tree = flame_tree(get_tracer(request).snapshot(request.params.get('route')))
+    if request.params.get('format') == 'folded':
+        return Response('\n'.join(folded_stacks(tree)) + '\n', content_type='text/plain', charset='utf-8')
+    return tree
+
+def get_memory_profiler(request, tracing=False):
+    profiler = request.registry.memory_profiler
+    if profiler is None:
+        raise HTTPNotFound(json={'error': 'Memory profiling is disabled (set memprof.enabled)'})
+    if tracing and not profiler.tracing:
+        raise HTTPBadRequest(json={'error': 'tracemalloc is not running; POST /api/admin/memory/start'})
+    return profiler
+
+def get_int_param(request, name, default):
+    try:
+        return int(request.params.get(name, default))
+    except ValueError:
+        raise HTTPBadRequest(json={'error': f'{name} must be an integer'})
+
+def get_group_by(request):
+    group_by = request.params.get('group_by', 'lineno')
+    if group_by not in GROUPINGS:
+        raise HTTPBadRequest(json={'error': f'group_by must be one of {", ".join(GROUPINGS)}'})
+    return group_by
+
+@view_config(route_name='admin_memory', request_method='GET', renderer='json', permission='admin')
+def get_memory_status(request):
+    """tracemalloc state, traced and resident memory, and snapshots of this process. Admin only."""
+    return get_memory_profiler(request).status()
+
+@view_config(route_name='admin_memory_start', request_method='POST', renderer='json', permission='admin')
+def start_memory_tracing(request):
+    """Start tracemalloc (optionally `{"frames": N}`). Admin only."""
+    profiler = get_memory_profiler(request)
+    body = request.json_body if request.body else {}
+    frames = body.get('frames')
+    if frames is not None and (not isinstance(frames, int) or not 1 <= frames <= 100):
+        return HTTPBadRequest(json={'error': 'frames must be an integer from 1 to 100'})
+    started = profiler.start(frames)
+    return dict(profiler.status(), message='Started' if started else 'Already running')
+
+@view_config(route_name='admin_memory_stop', request_method='POST', renderer='json', permission='admin')
+def stop_memory_tracing(request):
+    """Stop tracemalloc and drop the snapshots. Per-route measurements are kept. Admin only."""
+    profiler = get_memory_profiler(request)
+    stopped = profiler.stop()
+    return dict(profiler.status(), message='Stopped' if stopped else 'Not running')
+
+@view_config(route_name='admin_memory_snapshots', request_method='POST', renderer='json', permission='admin')
+def take_memory_snapshot(request):
+    """Take a tracemalloc snapshot (optionally `{"label": "..."}`). Admin only."""
+    profiler = get_memory_profiler(request, tracing=True)
+    body = request.json_body if request.body else {}
+    return profiler.take_snapshot(body.get('label'))
+
+@view_config(route_name='admin_memory_top', request_method='GET', renderer='json', permission='admin')
+def get_memory_top(request):
+    """Largest allocation sites of a snapshot (`?snapshot=id`) or of now. Admin only."""
+    profiler = get_memory_profiler(request, tracing=True)
+    group_by = get_group_by(request)
+    limit = min(get_int_param(request, 'limit', 20), 500)
+    if 'snapshot' in request.params:
+        snapshot = profiler.get_snapshot(get_int_param(request, 'snapshot', 0))
+        if snapshot is None:
+            return HTTPNotFound(json={'error': 'Snapshot not found'})
+    else:
+        snapshot = profiler.current_snapshot()
+    statistics = snapshot.statistics(group_by)
+    return {
+        'pid': os.getpid(),
+        'items': [describe_statistic(statistic, group_by) for statistic in statistics[:limit]],
+    }
+
+@view_config(route_name='admin_memory_diff', request_method='GET', renderer='json', permission='admin')
+def get_memory_diff(request):
+    """What grew between snapshot `from` and snapshot `to` (default: now). Admin only."""
+    profiler = get_memory_profiler(request, tracing=True)
+    group_by = get_group_by(request)
+    limit = min(get_int_param(request, 'limit', 20), 500)
+    before = profiler.get_snapshot(get_int_param(request, 'from', 0))
+    if 'to' in request.params:
+        after = profiler.get_snapshot(get_int_param(request, 'to', 0))
+    else:
+        after = profiler.current_snapshot()
+    if before is None or after is None:
+        return HTTPNotFound(json={'error': 'Snapshot not found'})
+    diff = after.compare_to(before, group_by)
+    return {
+        'pid': os.getpid(),
+        'sizeDiffKb': round(sum(statistic.size_diff for statistic in diff) / 1024, 1),
+        'items': [describe_statistic(statistic, group_by) for statistic in diff[:limit]],
+    }
+
+@view_config(route_name='admin_memory_routes', request_method='GET', renderer='json', permission='admin')
+def get_memory_routes(request):
+    """Peak and held memory of sampled requests, and their top allocation sites, per route. Admin only."""
+    profiler = get_memory_profiler(request)
+    top = min(get_int_param(request, 'top', 10), 100)
+    return {'pid': os.getpid(), 'routes': profiler.route_report(top)}
+
+@view_config(route_name='admin_inventory', request_method='GET', renderer='json', permission='admin')
+def get_inventory(request):
+    """A product's stock slots, held reservations and latest ledger entries. Admin only."""
+    product_id = int(request.matchdict['id'])
+    product = request.db.get(Product, product_id)
+    if not product:
+        return HTTPNotFound(json={'error': 'Product not found'})
+    
+    try:
+        limit = min(int(request.params.get('limit', 50)), 500)
+    except ValueError:
+        return HTTPBadRequest(json={'error': 'limit must be an integer'})
+    
+    slots = request.db.execute(
+        select(StockSlot.slot, StockSlot.quantity)
+        .where(StockSlot.product_id == product_id)
+        .order_by(StockSlot.slot)
+    ).all()
+    held_count, held_quantity = request.db.execute(
+        select(func.count(), func.coalesce(func.sum(StockReservation.quantity), 0))
+        .where(StockReservation.product_id == product_id, StockReservation.status == 'held')
+    ).one()
+    movements = request.db.scalars(
+        select(StockMovement)
+        .where(StockMovement.product_id == product_id)
+        .order_by(StockMovement.id.desc())
+        .limit(limit)
+    ).all()
+    return {
+        'productId': product_id,
+        # Refreshed in the background; `available` is the live total
+        'stock': product.stock,
+        'available': sum(quantity for _, quantity in slots),
+        'slots': [{'slot': slot, 'quantity': quantity} for slot, quantity in slots],
+        'reservations': {'held': held_count, 'quantity': held_quantity},
+        'movements': [movement.to_dict() for movement in movements],
+    }
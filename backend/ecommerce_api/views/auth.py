@@ -7,6 +7,7 @@ from pyramid.response import Response
 import json
 
 from ..models.user import User
+from ..models.lookups import get_user_by_email
 
 @view_config(route_name='register', request_method='POST', renderer='json')
 def register(request):
@@ -22,7 +23,7 @@ def register(request):
             return HTTPBadRequest(json={'error': f'Missing required field: {field}'})
     
     # Check if user with email already exists
-    existing_user = request.db.query(User).filter(User.email == body['email']).first()
+    existing_user = get_user_by_email(request.db, body['email'])
     if existing_user:
         return HTTPConflict(json={'error': 'User with this email already exists'})
       # Create new user
@@ -70,7 +71,7 @@ def login(request):
             return HTTPBadRequest(json={'error': f'Missing required field: {field}'})
     
     # Find user by email
-    user = request.db.query(User).filter(User.email == body['email']).first()
+    user = get_user_by_email(request.db, body['email'])
     if not user or not user.check_password(body['password']):
         return HTTPUnauthorized(json={'error': 'Invalid email or password'})
     
@@ -98,7 +99,7 @@ def current_user(request):
     if not user_id:
         return HTTPUnauthorized(json={'error': 'Authentication required'})
     
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
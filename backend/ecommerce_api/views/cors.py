@@ -12,7 +12,7 @@ def options_view(request):
     response.headers.update({
         'Access-Control-Allow-Origin': origin,
         'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,PATCH,OPTIONS',
-        'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept, Authorization, X-Requested-With, X-Client-Version, X-Registration-Source',
+        'Access-Control-Allow-Headers': 'Origin, Content-Type, Accept, Authorization, X-Requested-With, If-Match, Last-Event-ID, traceparent, X-Client-Version, X-Registration-Source',
         'Access-Control-Allow-Credentials': 'true',
         'Access-Control-Max-Age': '86400',  # 24 hours
     })
@@ -2,22 +2,21 @@ from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPOk
 from ..models.product import Product
 
-@view_config(route_name='debug_products', request_method='GET', renderer='json')
+@view_config(route_name='debug_products', request_method='GET', renderer='json', permission='admin')
 def debug_products(request):
-    """Debug endpoint to check the products table."""
+    """Debug endpoint to check the products table. Admin only."""
     result = {
         'status': 'ok',
         'request_info': {
             'path': request.path,
             'params': dict(request.params),
-            'headers': {k: v for k, v in request.headers.items()},
             'has_db': hasattr(request, 'db'),
         },
         'database': {}
     }
     
     try:
-        result['database']['connection'] = str(request.db.bind.url)
+        result['database']['backend'] = request.db.bind.dialect.name
         # Get product count
         product_count = request.db.query(Product).count()
         result['database']['product_count'] = product_count
@@ -0,0 +1,49 @@
+from pyramid.view import view_config
+
+from ..health import pool_status
+
+@view_config(route_name='healthz', request_method='GET', renderer='json')
+def healthz(request):
+    """Liveness probe. Never touches the database."""
+    return {'status': 'ok'}
+
+@view_config(route_name='readyz', request_method='GET', renderer='json')
+def readyz(request):
+    """Readiness probe: pool warm-up, a pool checkout and the cached schema check."""
+    engine = request.registry.dbengine
+    schema_check = request.registry.schema_check
+    schema_check.ensure_running()
+    pool_warmer = request.registry.pool_warmer
+    pool_warmer.ensure_running()
+    suggest_index = request.registry.suggest_index
+    suggest_index.ensure_running()
+    request.registry.inventory.ensure_running()
+    
+    result = {'status': 'ready', 'pool': pool_status(engine), 'schema': schema_check.result}
+    problems = []
+    
+    if not pool_warmer.ready:
+        problems.append('connection pool warming up')
+    elif result['pool'].get('saturated'):
+        # Checking out would block for pool_timeout; report instead
+        problems.append('connection pool saturated')
+    else:
+        try:
+            connection = engine.connect()
+            connection.close()
+        except Exception as e:
+            problems.append(f'database unavailable: {e.__class__.__name__}')
+    
+    if not suggest_index.ready:
+        problems.append('suggest index building')
+    
+    if schema_check.result is None:
+        problems.append('schema check pending')
+    elif not schema_check.result['ok']:
+        problems.append('schema out of date')
+    
+    if problems:
+        request.response.status = 503
+        result['status'] = 'unavailable'
+        result['problems'] = problems
+    return result
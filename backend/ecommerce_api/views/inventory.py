@@ -0,0 +1,77 @@
+from pyramid.view import view_config
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from sqlalchemy import select
+from datetime import datetime
+
+from ..inventory import OutOfStock, ReservationError
+from ..models.inventory import StockReservation
+from ..models.product import Product
+
+@view_config(route_name='stock_reservations', request_method='POST', renderer='json')
+def create_reservation(request):
+    """Hold stock for the current user's cart.
+    
+    The stock is taken now and given back when the reservation is
+    released or expires; pass its id as `reservation_id` with the order
+    item to buy it.
+    """
+    if not request.authenticated_userid:
+        return HTTPForbidden(json={'error': 'Authentication required'})
+    
+    try:
+        body = request.json_body
+        product_id = int(body['product_id'])
+        quantity = int(body['quantity'])
+    except (ValueError, TypeError, KeyError):
+        return HTTPBadRequest(json={'error': 'product_id and quantity are required integers'})
+    if quantity <= 0:
+        return HTTPBadRequest(json={'error': 'Quantity must be positive'})
+    
+    product = request.db.get(Product, product_id)
+    if not product:
+        return HTTPNotFound(json={'error': 'Product not found'})
+    
+    try:
+        reservation = request.registry.inventory.reserve(
+            request.db, request.authenticated_userid, product_id, quantity
+        )
+    except OutOfStock:
+        request.tm.doom()
+        return HTTPBadRequest(json={'error': f'Not enough stock for product {product.title}'})
+    
+    return reservation.to_dict()
+
+@view_config(route_name='stock_reservations', request_method='GET', renderer='json')
+def get_reservations(request):
+    """List the current user's reservations that still hold stock."""
+    if not request.authenticated_userid:
+        return HTTPForbidden(json={'error': 'Authentication required'})
+    
+    reservations = request.db.scalars(
+        select(StockReservation)
+        .where(StockReservation.user_id == request.authenticated_userid,
+               StockReservation.status == 'held',
+               StockReservation.expires_at > datetime.utcnow())
+        .order_by(StockReservation.id)
+    ).all()
+    return [reservation.to_dict() for reservation in reservations]
+
+@view_config(route_name='stock_reservation', request_method='DELETE', renderer='json')
+def release_reservation(request):
+    """Release a reservation, putting its stock back on sale."""
+    if not request.authenticated_userid:
+        return HTTPForbidden(json={'error': 'Authentication required'})
+    
+    try:
+        reservation_id = int(request.matchdict['id'])
+    except ValueError:
+        return HTTPNotFound(json={'error': 'Reservation not found'})
+    
+    try:
+        reservation = request.registry.inventory.release(
+            request.db, reservation_id, request.authenticated_userid
+        )
+    except ReservationError as e:
+        return HTTPBadRequest(json={'error': str(e)})
+    
+    return reservation.to_dict()
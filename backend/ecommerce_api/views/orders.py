@@ -1,14 +1,95 @@
 from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPForbidden
+from pyramid.response import Response
+from sqlalchemy import case, func
+from sqlalchemy.orm import selectinload
+from datetime import datetime
 import json
 
+from ..inventory import OutOfStock, ReservationError
 from ..models.order import Order, OrderItem
 from ..models.product import Product
+from ..models.user import User
+from ..order_events import format_event, latest_event_id, parse_event_id, publish_order_event, user_events_after
+from ..versioning import check_if_match, save_changes, set_etag
+
+def reject_order(request, message):
+    """Return a 400 and roll back everything the request has written."""
+    request.tm.doom()
+    return HTTPBadRequest(json={'error': message})
+
+def apply_date_filters(query, request):
+    """Restrict an orders query to the `created_from`/`created_to` range.
+
+    Both bounds are ISO dates or datetimes. Filtering on `created_at` lets
+    PostgreSQL skip every monthly partition outside the range.
+    """
+    if 'created_from' in request.params:
+        try:
+            created_from = datetime.fromisoformat(request.params['created_from'])
+            query = query.filter(Order.created_at >= created_from)
+        except ValueError:
+            pass
+    
+    if 'created_to' in request.params:
+        try:
+            created_to = datetime.fromisoformat(request.params['created_to'])
+            query = query.filter(Order.created_at < created_to)
+        except ValueError:
+            pass
+    
+    return query
+
+def apply_expand(query, request):
+    """Eager-load items when the full order tree is requested."""
+    if request.params.get('expand') == 'items':
+        query = query.options(selectinload(Order.items))
+    return query
+
+def serialize_order(order, request):
+    """Serialize an order for a list view.
+
+    List views return the summary stored on the order itself unless the
+    client asks for the full tree with `?expand=items`.
+    """
+    if request.params.get('expand') == 'items':
+        return order.to_dict()
+    return order.to_summary_dict()
+
+def adjust_user_stats(request, order, sign):
+    """Add (sign=1) or remove (sign=-1) an order from its user's statistics.
+
+    The counters are updated in SQL so concurrent orders by the same user
+    do not overwrite each other.
+    """
+    if sign > 0:
+        placed_at = order.created_at or func.now()
+        last_order_at = case(
+            (User.last_order_at == None, placed_at),
+            (User.last_order_at < placed_at, placed_at),
+            else_=User.last_order_at
+        )
+    else:
+        last_order_at = (
+            request.db.query(func.max(Order.created_at))
+            .filter(Order.user_id == order.user_id)
+            .filter(Order.id != order.id)
+            .filter(Order.status != 'cancelled')
+            .scalar_subquery()
+        )
+    
+    request.db.query(User).filter(User.id == order.user_id).update({
+        User.order_count: User.order_count + sign,
+        User.lifetime_spend: User.lifetime_spend + sign * order.total,
+        User.last_order_at: last_order_at,
+        User.updated_at: User.updated_at,  # Statistics are not a profile change
+    }, synchronize_session=False)
 
 @view_config(route_name='orders', request_method='GET', renderer='json', permission='admin')
 def get_orders(request):
     """Get all orders. Admin only."""
     query = request.db.query(Order)
+    query = apply_date_filters(query, request)
     
     # Sorting
     sort_by = request.params.get('sort_by', 'created_at')
@@ -30,10 +111,10 @@ def get_orders(request):
     
     total = query.count()
     offset = (page - 1) * per_page
-    orders = query.offset(offset).limit(per_page).all()
+    orders = apply_expand(query, request).offset(offset).limit(per_page).all()
     
     return {
-        'items': [order.to_dict() for order in orders],
+        'items': [serialize_order(order, request) for order in orders],
         'total': total,
         'page': page,
         'per_page': per_page,
@@ -44,7 +125,7 @@ def get_orders(request):
 def get_order(request):
     """Get an order by ID."""
     order_id = int(request.matchdict['id'])
-    order = request.db.query(Order).filter(Order.id == order_id).first()
+    order = request.db.get(Order, order_id)
     
     if not order:
         return HTTPNotFound(json={'error': 'Order not found'})
@@ -53,6 +134,7 @@ def get_order(request):
     if order.user_id != request.authenticated_userid and not request.has_permission('admin'):
         return HTTPForbidden(json={'error': 'You do not have permission to view this order'})
     
+    set_etag(request, order)
     return order.to_dict()
 
 @view_config(route_name='orders', request_method='POST', renderer='json')
@@ -88,6 +170,8 @@ def create_order(request):
         shipping_cost=shipping_cost,
         tax=tax,
         total=0,  # Will update after calculating items
+        item_count=0,
+        unit_count=0,
         shipping_address=body['shipping_address'],
         payment_method=body['payment_method']
     )
@@ -95,60 +179,86 @@ def create_order(request):
     request.db.add(order)
     request.db.flush()  # Get the order ID
     
-    # Process items
+    # Process items. The order is already flushed, so failures roll back
+    # the whole request rather than leave a partial order.
+    inventory = request.registry.inventory
     for item_data in body['items']:
         if not all(key in item_data for key in ['product_id', 'quantity']):
-            return HTTPBadRequest(json={'error': 'Invalid item data'})
+            return reject_order(request, 'Invalid item data')
         
         product_id = item_data['product_id']
         quantity = item_data['quantity']
         
         if quantity <= 0:
-            return HTTPBadRequest(json={'error': 'Item quantity must be positive'})
+            return reject_order(request, 'Item quantity must be positive')
         
         # Get product from database
-        product = request.db.query(Product).filter(Product.id == product_id).first()
+        product = request.db.get(Product, product_id)
         if not product:
-            return HTTPBadRequest(json={'error': f'Product with ID {product_id} not found'})
-        
-        # Check stock availability
-        if product.stock < quantity:
-            return HTTPBadRequest(json={
-                'error': f'Not enough stock for product {product.title}'
-            })
+            return reject_order(request, f'Product with ID {product_id} not found')
         
-        # Update product stock
-        product.stock -= quantity
+        # Take the stock from one of the product's slots, or use the
+        # stock already held by a cart reservation
+        try:
+            if item_data.get('reservation_id') is not None:
+                inventory.use_reservation(request.db, item_data['reservation_id'],
+                                          request.authenticated_userid, product_id, quantity, order.id)
+            else:
+                inventory.take(request.db, product_id, quantity, 'order', order_id=order.id)
+        except OutOfStock:
+            return reject_order(request, f'Not enough stock for product {product.title}')
+        except ReservationError as e:
+            return reject_order(request, str(e))
         
         # Calculate item price
         item_subtotal = product.price * quantity
         subtotal += item_subtotal
         
-        # Create order item
+        # Create order item with a snapshot of the product as bought
         order_item = OrderItem(
             order_id=order.id,
-            product_id=product_id,
-            quantity=quantity,
-            price=product.price
+            quantity=quantity
         )
+        order_item.snapshot_product(product)
         
         request.db.add(order_item)
+        
+        # Maintain the summary shown in order lists
+        if order.item_count == 0:
+            order.first_item_title = product.title
+            order.first_item_image = product.image_url
+        order.item_count += 1
+        order.unit_count += quantity
     
     # Update order totals
     order.subtotal = subtotal
     order.total = subtotal + shipping_cost + tax
     
+    adjust_user_stats(request, order, 1)
+    
+    # Filling in the totals updated the flushed order: send the version
+    # it is committed with
+    request.db.flush()
+    set_etag(request, order)
     return order.to_dict()
 
 @view_config(route_name='order', request_method='PATCH', renderer='json', permission='admin')
 def update_order_status(request):
-    """Update an order's status. Admin only."""
+    """Update an order's status. Admin only.
+    
+    Honours `If-Match` like update_product, so two admins cannot cancel
+    and ship the same order at once.
+    """
     order_id = int(request.matchdict['id'])
-    order = request.db.query(Order).filter(Order.id == order_id).first()
+    order = request.db.get(Order, order_id)
     
     if not order:
         return HTTPNotFound(json={'error': 'Order not found'})
     
+    conflict = check_if_match(request, order, 'order')
+    if conflict is not None:
+        return conflict
+    
     try:
         body = request.json_body
     except:
@@ -160,15 +270,68 @@ def update_order_status(request):
     if body['status'] not in ['processing', 'shipped', 'delivered', 'cancelled']:
         return HTTPBadRequest(json={'error': 'Invalid status value'})
     
-    # Update status
+    previous_status = order.status
+    previous_tracking_number = order.tracking_number
     order.status = body['status']
     
     # Add tracking number if provided
     if 'tracking_number' in body:
         order.tracking_number = body['tracking_number']
     
+    # Write the order first: once it is saved, concurrent edits of it wait
+    # for this transaction and then get a 409 themselves
+    conflict = save_changes(request, order, 'order')
+    if conflict is not None:
+        return conflict
+    
+    # Keep the customer's statistics in step with the status. A cancelled
+    # order's stock goes back on sale, and is taken again if it is reopened.
+    inventory = request.registry.inventory
+    if previous_status != 'cancelled' and order.status == 'cancelled':
+        adjust_user_stats(request, order, -1)
+        for item in order.items:
+            if item.product_id is not None:
+                inventory.give(request.db, item.product_id, item.quantity, 'cancel', order_id=order.id)
+    elif previous_status == 'cancelled' and order.status != 'cancelled':
+        for item in order.items:
+            if item.product_id is None:
+                continue
+            try:
+                inventory.take(request.db, item.product_id, item.quantity, 'order', order_id=order.id)
+            except OutOfStock:
+                return reject_order(request, f'Not enough stock left for {item.product_title}')
+        adjust_user_stats(request, order, 1)
+    
+    # Pushed to the customer's open order pages once this commits
+    if order.status != previous_status or order.tracking_number != previous_tracking_number:
+        publish_order_event(request.db, order)
+    
     return order.to_dict()
 
+@view_config(route_name='order_stream', request_method='GET')
+def stream_order_events(request):
+    """Stream the current user's order status events (text/event-stream).
+    
+    Normally routed to serve_order_events, which keeps the stream open.
+    Served here, it sends the events after `Last-Event-ID` and ends the
+    stream; the browser reconnects after `events.retry_ms`.
+    """
+    user_id = request.authenticated_userid
+    if not user_id:
+        return HTTPForbidden(json={'error': 'Authentication required'})
+    
+    retry_ms = int(request.registry.settings.get('events.retry_ms', 5000))
+    chunks = [f'retry: {retry_ms}\n\n']
+    last_id = parse_event_id(request.headers.get('Last-Event-ID') or request.params.get('lastEventId'))
+    if last_id is None:
+        chunks.append(f'id: {latest_event_id(request.db, user_id)}\n\n')
+    else:
+        chunks.extend(format_event(message) for message in user_events_after(request.db, user_id, last_id))
+    
+    response = Response(''.join(chunks), content_type='text/event-stream', charset='utf-8')
+    response.cache_control = 'no-cache'
+    return response
+
 @view_config(route_name='user_orders', request_method='GET', renderer='json')
 def get_user_orders(request):
     """Get orders for the current authenticated user."""
@@ -183,6 +346,7 @@ def get_user_orders(request):
         
         # Get orders for the user
         query = request.db.query(Order).filter(Order.user_id == user_id)
+        query = apply_date_filters(query, request)
         
         # Sorting
         sort_by = request.params.get('sort_by', 'created_at')
@@ -207,7 +371,7 @@ def get_user_orders(request):
             total = query.count()
             print(f"Total orders found for user {user_id}: {total}")
             offset = (page - 1) * per_page
-            orders = query.offset(offset).limit(per_page).all()
+            orders = apply_expand(query, request).offset(offset).limit(per_page).all()
             
             # Return empty list if no orders
             if not orders:
@@ -224,7 +388,7 @@ def get_user_orders(request):
             order_dicts = []
             for order in orders:
                 try:
-                    order_dict = order.to_dict()
+                    order_dict = serialize_order(order, request)
                     order_dicts.append(order_dict)
                 except Exception as e:
                     print(f"Error converting order {order.id} to dict: {str(e)}")
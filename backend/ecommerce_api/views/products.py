@@ -1,12 +1,310 @@
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
-    HTTPBadRequest, HTTPNotFound, HTTPForbidden
+    HTTPBadRequest, HTTPNotFound, HTTPForbidden, HTTPServiceUnavailable
 )
-from sqlalchemy import func
+from pyramid.response import Response
+from sqlalchemy import (
+    String, and_, case, cast, func, literal, literal_column, or_, select, tuple_, union_all
+)
+from sqlalchemy.orm import load_only
+from datetime import datetime
+import base64
+import json
 
+from ..changefeed import read_changes, record_changes
 from ..models.product import Product
+from ..suggest import product_deleted, product_saved
+from ..versioning import check_if_match, save_changes, set_etag
+
+SORT_COLUMNS = ['id', 'title', 'price', 'rating', 'created_at']
+
+# Rows fetched per round trip when streaming a full product list
+STREAM_BATCH_SIZE = 500
+
+FACETS = ('category', 'price', 'rating')
+# Upper bounds of the histogram buckets; the last bucket is open-ended
+PRICE_BUCKETS = (10, 25, 50, 100, 250, 500, 1000)
+RATING_BUCKETS = (1, 2, 3, 4)
+RATING_MAX = 5
+
+SUGGEST_DEFAULT_LIMIT = 8
+SUGGEST_MAX_LIMIT = 20
+# How long the first request of a process waits for the suggest index
+SUGGEST_BUILD_WAIT = 10
+
+CHANGES_DEFAULT_LIMIT = 500
+CHANGES_MAX_LIMIT = 2000
+
+def encode_cursor(product, sort_by):
+    """Encode the keyset position after `product` as an opaque token."""
+    value = getattr(product, sort_by)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, product.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(token, sort_by):
+    """Decode a cursor token into (sort value, product id)."""
+    value, product_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    if sort_by == 'created_at' and value is not None:
+        value = datetime.fromisoformat(value)
+    return value, int(product_id)
+
+def sort_order(sort_by, descending):
+    """Return the ORDER BY of a listing sorted on `sort_by`, ties broken by id.
+
+    NULLs sort above every value: last ascending, first descending. That
+    is PostgreSQL's default, so its indexes on the column serve both.
+    """
+    column = getattr(Product, sort_by)
+    nullable = Product.__table__.c[sort_by].nullable
+    if descending:
+        return [column.desc().nulls_first() if nullable else column.desc(), Product.id.desc()]
+    return [column.asc().nulls_last() if nullable else column, Product.id]
+
+def after_cursor(sort_by, descending, value, last_id):
+    """Return the filter of the rows after a cursor position, in sort_order()."""
+    column = getattr(Product, sort_by)
+    nullable = Product.__table__.c[sort_by].nullable
+    if value is None:
+        # Only NULLs are left ascending; descending, every value is
+        ties = column.is_(None)
+        if descending:
+            return or_(column.is_not(None), and_(ties, Product.id < last_id))
+        return and_(ties, Product.id > last_id)
+    if descending:
+        return or_(column < value, and_(column == value, Product.id < last_id))
+    after = or_(column > value, and_(column == value, Product.id > last_id))
+    return or_(after, column.is_(None)) if nullable else after
+
+def get_fields(request):
+    """Return the product fields selected with `?fields=`, or None for all."""
+    if not request.params.get('fields'):
+        return None
+    fields = [name.strip() for name in request.params['fields'].split(',')]
+    fields = [name for name in fields if name in Product.FIELD_COLUMNS]
+    return fields or None
+
+def apply_fields(query, fields):
+    """Load only the columns needed to render the selected fields."""
+    if fields is None:
+        return query
+    columns = {'id'}
+    for name in fields:
+        columns.update(Product.FIELD_COLUMNS[name])
+    return query.options(load_only(*[getattr(Product, column) for column in columns]))
+
+def get_facets(request):
+    """Return the facets requested with `?facets=`, raising ValueError for unknown ones."""
+    if not request.params.get('facets'):
+        return []
+    names = [name.strip() for name in request.params['facets'].split(',') if name.strip()]
+    unknown = [name for name in names if name not in FACETS]
+    if unknown:
+        raise ValueError(f"Unknown facet: {unknown[0]} (expected {', '.join(FACETS)})")
+    return [name for name in FACETS if name in names]
+
+def bucket_number(column, bounds):
+    """Return a CASE numbering the histogram bucket `column` falls into."""
+    # Literals rather than bound parameters, so the expression is the same
+    # text in SELECT and GROUP BY even when parameters are bound server-side
+    return case(
+        *[(column < literal_column(repr(bound)), literal_column(str(number)))
+          for number, bound in enumerate(bounds)],
+        else_=literal_column(str(len(bounds)))
+    )
+
+def facet_rows(dbsession, query, names):
+    """Yield (facet, value, count, min price, max price) for the rows of `query`.
+    
+    The facet is None for the totals over all matching rows. PostgreSQL
+    counts every facet in one pass over the rows with GROUPING SETS; other
+    databases run one GROUP BY per facet, combined into a single statement
+    with UNION ALL.
+    """
+    expressions = {
+        'category': Product.category,
+        'price': bucket_number(Product.price, PRICE_BUCKETS),
+        'rating': bucket_number(func.coalesce(Product.rating, 0), RATING_BUCKETS),
+    }
+    aggregates = [func.count(), func.min(Product.price), func.max(Product.price)]
+    
+    def restrict(statement):
+        statement = statement.select_from(Product)
+        if query.whereclause is not None:
+            statement = statement.where(query.whereclause)
+        return statement
+    
+    columns = [expressions[name] for name in names]
+    if dbsession.bind.dialect.name == 'postgresql':
+        statement = restrict(select(*columns, func.grouping(*columns), *aggregates)).group_by(
+            func.grouping_sets(*[tuple_(column) for column in columns], tuple_())
+        )
+        everything = 2 ** len(names) - 1
+        for row in dbsession.execute(statement):
+            mask = row[len(names)]
+            if mask == everything:
+                yield (None, None, *row[-3:])
+                continue
+            # GROUPING() sets one bit per column not grouped by; the first
+            # column is the most significant bit
+            position = next(i for i in range(len(names)) if not mask & (1 << (len(names) - 1 - i)))
+            yield (names[position], row[position], *row[-3:])
+        return
+    
+    parts = [
+        restrict(select(literal(name).label('facet'), cast(column, String).label('value'), *aggregates))
+        .group_by(column)
+        for name, column in zip(names, columns)
+    ]
+    parts.append(restrict(select(literal(None, String).label('facet'), literal(None, String).label('value'), *aggregates)))
+    for facet, value, count, low, high in dbsession.execute(union_all(*parts)):
+        if facet in ('price', 'rating'):
+            value = int(value)
+        yield facet, value, count, low, high
+
+def buckets(counts, bounds, upper):
+    lowers = (0,) + bounds
+    uppers = bounds + (upper,)
+    return [{'from': low, 'to': high, 'count': counts.get(number, 0)}
+            for number, (low, high) in enumerate(zip(lowers, uppers))]
+
+def compute_facets(dbsession, query, names):
+    """Return the facet counts of the products matched by `query`.
+    
+    `total` is the number of matching products. `category` lists the
+    categories by count, `price` and `rating` are histograms (`to` is
+    exclusive, None for an open-ended bucket) and `price_range` has the
+    lowest and highest matching price.
+    """
+    counts = {name: {} for name in names}
+    facets = {'total': 0}
+    for facet, value, count, low, high in facet_rows(dbsession, query, names):
+        if facet is None:
+            facets['total'] = count
+            if 'price' in names:
+                facets['price_range'] = {'min': low, 'max': high}
+        else:
+            counts[facet][value] = count
+    
+    if 'category' in names:
+        facets['category'] = [
+            {'value': value, 'count': count}
+            for value, count in sorted(counts['category'].items(), key=lambda item: (-item[1], item[0]))
+        ]
+    if 'price' in names:
+        facets['price'] = buckets(counts['price'], PRICE_BUCKETS, None)
+    if 'rating' in names:
+        facets['rating'] = buckets(counts['rating'], RATING_BUCKETS, RATING_MAX)
+    return facets
+
+def stream_products(request, query, fields):
+    """Stream every product matched by `query` as one JSON array.
+    
+    Rows come from a server-side cursor in batches and are encoded one
+    batch at a time, so memory stays flat however many rows match. The
+    stream runs on its own session because the request transaction has
+    already ended by the time the response body is sent.
+    """
+    statement = apply_fields(query, fields).statement
+    session = request.registry.dbmaker()
+    encoder = json.JSONEncoder()
+    
+    def generate():
+        try:
+            result = session.execute(statement.execution_options(yield_per=STREAM_BATCH_SIZE))
+            yield b'['
+            first = True
+            for batch in result.scalars().partitions():
+                chunk = ','.join(encoder.encode(product.to_dict(fields)) for product in batch)
+                yield (chunk if first else ',' + chunk).encode('utf-8')
+                first = False
+                session.expunge_all()
+            yield b']'
+        finally:
+            session.close()
+    
+    return Response(app_iter=generate(), content_type='application/json', charset='utf-8')
+
+def list_products(request, query):
+    """Sort, paginate and serialize a filtered products query.
+    
+    Supports page-based pagination (`page`, `per_page`, `paginated`),
+    keyset pagination (`cursor`, empty to start), field selection
+    (`fields=id,title,price`) and facet counts over all matching products
+    (`facets=category,price,rating`), which wrap a plain product list
+    into `{"products": [...], "facets": {...}}`.
+    """
+    fields = get_fields(request)
+    try:
+        facet_names = get_facets(request)
+    except ValueError as e:
+        return HTTPBadRequest(json={'error': str(e)})
+    # Counted before the cursor narrows the query down
+    facets = compute_facets(request.db, query, facet_names) if facet_names else None
+    
+    # Sorting
+    sort_by = request.params.get('sort_by', 'id')
+    sort_dir = request.params.get('sort_dir', 'asc')
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'id'
+    descending = sort_dir.lower() == 'desc'
+    
+    query = query.order_by(*sort_order(sort_by, descending))
+    
+    # Pagination
+    try:
+        page = int(request.params.get('page', 1))
+        per_page = int(request.params.get('per_page', 10))
+    except ValueError:
+        page = 1
+        per_page = 10
+    
+    if 'cursor' in request.params:
+        # Keyset pagination: continue after the last row of the previous
+        # page instead of counting and skipping rows
+        if request.params['cursor']:
+            try:
+                value, last_id = decode_cursor(request.params['cursor'], sort_by)
+            except (ValueError, TypeError):
+                return HTTPBadRequest(json={'error': 'Invalid cursor'})
+            query = query.filter(after_cursor(sort_by, descending, value, last_id))
+        
+        products = apply_fields(query, fields).limit(per_page + 1).all()
+        has_more = len(products) > per_page
+        products = products[:per_page]
+        result = {
+            'products': [product.to_dict(fields) for product in products],
+            'per_page': per_page,
+            'next_cursor': encode_cursor(products[-1], sort_by) if has_more else None
+        }
+        if facets is not None:
+            result['facets'] = facets
+        return result
+    
+    # The facet query has already counted the matching rows
+    total = facets['total'] if facets is not None else query.count()
+    offset = (page - 1) * per_page
+    products = apply_fields(query, fields).offset(offset).limit(per_page).all()
+      # Format response to match client expectations
+    # If client expects pagination metadata, return it
+    if request.params.get('paginated', 'false').lower() == 'true':
+        result = {
+            'products': [product.to_dict(fields) for product in products],
+            'total': total,
+            'page': page,
+            'per_page': per_page,
+            'pages': (total + per_page - 1) // per_page  # Ceiling division
+        }
+        if facets is not None:
+            result['facets'] = facets
+        return result
+    if facets is not None:
+        return {'products': [product.to_dict(fields) for product in products], 'facets': facets}
+    # Otherwise, just return the products array
+    return [product.to_dict(fields) for product in products]
 
-@view_config(route_name='products', request_method='GET', renderer='json')
+@view_config(route_name='products', request_method='GET', renderer='json', coalesce=True)
 def get_products(request):
     """Get all products with optional filtering."""
     query = request.db.query(Product)
@@ -33,49 +331,66 @@ def get_products(request):
         except ValueError:
             pass
     
-    # Sorting
-    sort_by = request.params.get('sort_by', 'id')
-    sort_dir = request.params.get('sort_dir', 'asc')
+    return list_products(request, query)
+
+@view_config(route_name='products_suggest', request_method='GET', renderer='json')
+def suggest_products(request):
+    """Autocomplete product titles for the search box.
+    
+    Served from the in-memory suggest index, without a database query.
+    Each query word matches the start of a word in a product's title or
+    category; results come in stock first, then by rating.
+    """
+    try:
+        limit = int(request.params.get('limit', SUGGEST_DEFAULT_LIMIT))
+    except ValueError:
+        return HTTPBadRequest(json={'error': 'limit must be an integer'})
+    limit = max(1, min(limit, SUGGEST_MAX_LIMIT))
     
-    if sort_by in ['id', 'title', 'price', 'rating', 'created_at']:
-        column = getattr(Product, sort_by)
-        if sort_dir.lower() == 'desc':
-            column = column.desc()
-        query = query.order_by(column)
+    index = request.registry.suggest_index
+    index.ensure_running()
+    if not index.wait_ready(SUGGEST_BUILD_WAIT):
+        return HTTPServiceUnavailable(json={'error': 'Suggestions are not available yet'})
     
-    # Pagination
+    matches = index.search(request.params.get('q', ''), limit)
+    return [{'id': product_id, 'title': title, 'image': image} for product_id, title, image in matches]
+
+@view_config(route_name='product_changes', request_method='GET', renderer='json')
+def get_product_changes(request):
+    """Return the products changed since the `since` token, for delta sync.
+    
+    `products` are the changed products in full and `deleted` the ids of
+    deleted ones; ask again with `since=<token>`, at once if `hasMore`.
+    With `reset`, the token is unknown or too old: reload the catalogue
+    from /api/products, then continue from `token`.
+    """
     try:
-        page = int(request.params.get('page', 1))
-        per_page = int(request.params.get('per_page', 10))
+        limit = int(request.params.get('limit', CHANGES_DEFAULT_LIMIT))
+        since = request.params.get('since')
+        since = int(since) if since else None
     except ValueError:
-        page = 1
-        per_page = 10
+        return HTTPBadRequest(json={'error': 'since and limit must be integers'})
+    limit = max(1, min(limit, CHANGES_MAX_LIMIT))
     
-    total = query.count()
-    offset = (page - 1) * per_page
-    products = query.offset(offset).limit(per_page).all()
-      # Format response to match client expectations
-    # If client expects pagination metadata, return it
-    if request.params.get('paginated', 'false').lower() == 'true':
-        return {
-            'products': [product.to_dict() for product in products],
-            'total': total,
-            'page': page,
-            'per_page': per_page,
-            'pages': (total + per_page - 1) // per_page  # Ceiling division
-        }
-    # Otherwise, just return the products array
-    return [product.to_dict() for product in products]
+    changes = read_changes(request.db, since, limit)
+    return {
+        'reset': changes.reset,
+        'token': str(changes.token),
+        'products': [product.to_dict() for product in changes.products],
+        'deleted': changes.deleted,
+        'hasMore': changes.has_more,
+    }
 
 @view_config(route_name='product', request_method='GET', renderer='json')
 def get_product(request):
     """Get a product by ID."""
     product_id = int(request.matchdict['id'])
-    product = request.db.query(Product).filter(Product.id == product_id).first()
+    product = request.db.get(Product, product_id)
     
     if not product:
         return HTTPNotFound(json={'error': 'Product not found'})
     
+    set_etag(request, product)
     return product.to_dict()
 
 @view_config(route_name='products', request_method='POST', renderer='json', permission='admin')
@@ -104,18 +419,30 @@ def create_product(request):
     
     request.db.add(product)
     request.db.flush()  # Get the ID assigned by the database
+    request.registry.inventory.initialize(request.db, product.id, product.stock or 0)
+    record_changes(request.db, [product.id])
+    product_saved(request, product)
     
+    set_etag(request, product)
     return product.to_dict()
 
 @view_config(route_name='product', request_method='PUT', renderer='json', permission='admin')
 def update_product(request):
-    """Update a product. Admin only."""
+    """Update a product. Admin only.
+    
+    Send the product's ETag in `If-Match` to be refused with 412 instead
+    of overwriting an edit made since it was read.
+    """
     product_id = int(request.matchdict['id'])
-    product = request.db.query(Product).filter(Product.id == product_id).first()
+    product = request.db.get(Product, product_id)
     
     if not product:
         return HTTPNotFound(json={'error': 'Product not found'})
     
+    conflict = check_if_match(request, product, 'product')
+    if conflict is not None:
+        return conflict
+    
     try:
         body = request.json_body
     except:
@@ -137,22 +464,36 @@ def update_product(request):
     if 'rating' in body:
         product.rating = float(body['rating'])
     
+    # Before anything else queries the session, whose autoflush would
+    # raise the conflict outside save_changes
+    conflict = save_changes(request, product, 'product')
+    if conflict is not None:
+        return conflict
+    if 'stock' in body:
+        # Spread over the product's stock slots; recorded in the ledger
+        request.registry.inventory.set_stock(request.db, product.id, product.stock)
+    record_changes(request.db, [product.id])
+    product_saved(request, product)
+    
     return product.to_dict()
 
 @view_config(route_name='product', request_method='DELETE', renderer='json', permission='admin')
 def delete_product(request):
     """Delete a product. Admin only."""
     product_id = int(request.matchdict['id'])
-    product = request.db.query(Product).filter(Product.id == product_id).first()
+    product = request.db.get(Product, product_id)
     
     if not product:
         return HTTPNotFound(json={'error': 'Product not found'})
     
+    request.registry.inventory.forget(request.db, product_id)
     request.db.delete(product)
+    record_changes(request.db, [product_id], deleted=True)
+    product_deleted(request, product_id)
     
     return {'message': 'Product deleted successfully'}
 
-@view_config(route_name='product_categories', request_method='GET', renderer='json')
+@view_config(route_name='product_categories', request_method='GET', renderer='json', coalesce=True)
 def get_categories(request):
     """Get all product categories."""
     try:
@@ -229,21 +570,27 @@ def get_categories(request):
             'error_details': str(e)
         }
 
-@view_config(route_name='products_by_category', request_method='GET', renderer='json')
+@view_config(route_name='products_by_category', request_method='GET', renderer='json', coalesce=True)
 def get_products_by_category(request):
-    """Get products by category."""
+    """Get products by category.
+    
+    Paginated like the main listing; `?all=true` streams the whole
+    category instead.
+    """
     category = request.matchdict['category']
     query = request.db.query(Product).filter(Product.category == category)
     
-    # Sorting (optional)
-    sort_by = request.params.get('sort_by', 'id')
-    sort_dir = request.params.get('sort_dir', 'asc')
-    
-    if sort_by in ['id', 'title', 'price', 'rating', 'created_at']:
-        column = getattr(Product, sort_by)
-        if sort_dir.lower() == 'desc':
-            column = column.desc()
-        query = query.order_by(column)
+    if request.params.get('all', 'false').lower() == 'true':
+        # Sorting (optional)
+        sort_by = request.params.get('sort_by', 'id')
+        sort_dir = request.params.get('sort_dir', 'asc')
+        
+        if sort_by in SORT_COLUMNS:
+            column = getattr(Product, sort_by)
+            if sort_dir.lower() == 'desc':
+                column = column.desc()
+            query = query.order_by(column)
         
-    products = query.all()
-    return [product.to_dict() for product in products]
+        return stream_products(request, query, get_fields(request))
+    
+    return list_products(request, query)
@@ -1,10 +1,64 @@
+import re
+
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPBadRequest, HTTPNotFound, HTTPForbidden,
     HTTPUnauthorized
 )
+from sqlalchemy import func, text
 
 from ..models.user import User
+from ..models.lookups import get_user_by_email
+from ..versioning import check_if_match, save_changes, set_etag
+
+# A whole address: local part, @, and a domain with a dot
+EMAIL_ADDRESS = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+def has_trigram_search(request):
+    """Return True if the database has the pg_trgm extension installed."""
+    registry = request.registry
+    if not hasattr(registry, 'user_search_trigram'):
+        available = False
+        if request.db.bind.dialect.name == 'postgresql':
+            available = request.db.execute(
+                text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            ).scalar() is not None
+        registry.user_search_trigram = available
+    return registry.user_search_trigram
+
+def apply_search(query, request, term):
+    """Filter a users query by a search term.
+    
+    Returns the filtered query and a relevance expression to order by, or
+    None when the database cannot rank matches.
+    """
+    term = term.strip()
+    
+    # Looking up a whole address is a prefix match on the lowercased email,
+    # served by the PostgreSQL text_pattern_ops index instead of a substring
+    # scan. Partial addresses ('doe@example', 'smith@') are searched like
+    # any other term.
+    if EMAIL_ADDRESS.fullmatch(term) and request.db.bind.dialect.name == 'postgresql':
+        pattern = term.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return query.filter(func.lower(User.email).like(pattern, escape='\\')), None
+    
+    # On PostgreSQL these predicates use the pg_trgm GIN indexes
+    search_term = f"%{term}%"
+    query = query.filter(
+        User.email.ilike(search_term) | 
+        User.first_name.ilike(search_term) | 
+        User.last_name.ilike(search_term)
+    )
+    
+    if not has_trigram_search(request):
+        return query, None
+    
+    rank = func.greatest(
+        func.similarity(User.email, term),
+        func.similarity(User.first_name, term),
+        func.similarity(User.last_name, term)
+    )
+    return query, rank
 
 @view_config(route_name='users', request_method='GET', renderer='json', permission='admin')
 def get_users(request):
@@ -17,22 +71,26 @@ def get_users(request):
         query = query.filter(User.is_active == is_active)
     
     # Search by name or email
+    rank = None
     if 'search' in request.params:
-        search_term = f"%{request.params['search']}%"
-        query = query.filter(
-            User.email.ilike(search_term) | 
-            User.first_name.ilike(search_term) | 
-            User.last_name.ilike(search_term)
-        )
-    
-    # Sorting
+        query, rank = apply_search(query, request, request.params['search'])
+    
+    # Sorting (the order statistics columns are indexed for this)
     sort_by = request.params.get('sort_by', 'id')
     sort_dir = request.params.get('sort_dir', 'asc')
     
-    if sort_by in ['id', 'email', 'first_name', 'last_name', 'created_at']:
+    if rank is not None and 'sort_by' not in request.params:
+        # Best matches first when searching without an explicit sort
+        query = query.order_by(rank.desc(), User.id)
+    elif sort_by in ['id', 'email', 'first_name', 'last_name', 'created_at',
+                   'order_count', 'lifetime_spend', 'last_order_at']:
         column = getattr(User, sort_by)
         if sort_dir.lower() == 'desc':
             column = column.desc()
+            # Customers without orders go last; the index is declared in
+            # this order, so only add NULLS LAST where the column is nullable
+            if sort_by == 'last_order_at':
+                column = column.nulls_last()
         query = query.order_by(column)
     
     # Pagination
@@ -47,8 +105,17 @@ def get_users(request):
     offset = (page - 1) * per_page
     users = query.offset(offset).limit(per_page).all()
     
+    # Order statistics are optional fields: ?include=stats
+    include_stats = 'stats' in request.params.get('include', '').split(',')
+    items = []
+    for user in users:
+        user_dict = user.to_dict()
+        if include_stats:
+            user_dict['stats'] = user.stats_dict()
+        items.append(user_dict)
+    
     return {
-        'items': [user.to_dict() for user in users],
+        'items': items,
         'total': total,
         'page': page,
         'per_page': per_page,
@@ -64,11 +131,12 @@ def get_user(request):
     if user_id != request.authenticated_userid and not request.has_permission('admin'):
         return HTTPForbidden(json={'error': 'You do not have permission to view this user'})
     
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
     
+    set_etag(request, user)
     return user.to_dict()
 
 @view_config(route_name='user', request_method='PUT', renderer='json')
@@ -80,27 +148,33 @@ def update_user(request):
     if user_id != request.authenticated_userid and not request.has_permission('admin'):
         return HTTPForbidden(json={'error': 'You do not have permission to update this user'})
     
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
     
+    conflict = check_if_match(request, user, 'user')
+    if conflict is not None:
+        return conflict
+    
     try:
         body = request.json_body
     except:
         return HTTPBadRequest(json={'error': 'Invalid JSON body'})
     
+    # Check if email is being changed and if it's already in use, before
+    # any field changes: the lookup would flush them
+    if 'email' in body and body['email'] != user.email:
+        existing_user = get_user_by_email(request.db, body['email'])
+        if existing_user:
+            return HTTPBadRequest(json={'error': 'Email already in use'})
+    
     # Update user fields
     if 'first_name' in body:
         user.first_name = body['first_name']
     if 'last_name' in body:
         user.last_name = body['last_name']
     if 'email' in body:
-        # Check if email is being changed and if it's already in use
-        if body['email'] != user.email:
-            existing_user = request.db.query(User).filter(User.email == body['email']).first()
-            if existing_user:
-                return HTTPBadRequest(json={'error': 'Email already in use'})
         user.email = body['email']
     
     # Only admins can change admin status
@@ -115,13 +189,17 @@ def update_user(request):
     if 'password' in body:
         user.set_password(body['password'])
     
+    conflict = save_changes(request, user, 'user')
+    if conflict is not None:
+        return conflict
+    
     return user.to_dict()
 
 @view_config(route_name='user', request_method='DELETE', renderer='json', permission='admin')
 def delete_user(request):
     """Delete a user. Admin only."""
     user_id = int(request.matchdict['id'])
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
@@ -137,11 +215,12 @@ def get_user_profile(request):
         return HTTPUnauthorized(json={'error': 'Authentication required'})
     
     user_id = request.authenticated_userid
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
     
+    set_etag(request, user)
     return user.to_dict()
 
 @view_config(route_name='user_profile', request_method='PUT', renderer='json')
@@ -151,31 +230,41 @@ def update_user_profile(request):
         return HTTPUnauthorized(json={'error': 'Authentication required'})
     
     user_id = request.authenticated_userid
-    user = request.db.query(User).filter(User.id == user_id).first()
+    user = request.db.get(User, user_id)
     
     if not user:
         return HTTPNotFound(json={'error': 'User not found'})
     
+    conflict = check_if_match(request, user, 'user')
+    if conflict is not None:
+        return conflict
+    
     try:
         body = request.json_body
     except:
         return HTTPBadRequest(json={'error': 'Invalid JSON body'})
     
+    # Check if email is being changed and if it's already in use, before
+    # any field changes: the lookup would flush them
+    if 'email' in body and body['email'] != user.email:
+        existing_user = get_user_by_email(request.db, body['email'])
+        if existing_user:
+            return HTTPBadRequest(json={'error': 'Email already in use'})
+    
     # Update user fields
     if 'first_name' in body:
         user.first_name = body['first_name']
     if 'last_name' in body:
         user.last_name = body['last_name']
     if 'email' in body:
-        # Check if email is being changed and if it's already in use
-        if body['email'] != user.email:
-            existing_user = request.db.query(User).filter(User.email == body['email']).first()
-            if existing_user:
-                return HTTPBadRequest(json={'error': 'Email already in use'})
         user.email = body['email']
     
     # Update password if provided
     if 'password' in body:
         user.set_password(body['password'])
     
+    conflict = save_changes(request, user, 'user')
+    if conflict is not None:
+        return conflict
+    
     return user.to_dict()
@@ -11,6 +11,7 @@ requires = [
     'zope.sqlalchemy',
     'waitress',
     'psycopg2-binary',  # PostgreSQL driver
+    'psycopg[binary]',  # PostgreSQL driver with prepared statements (postgresql+psycopg:// URLs)
     'alembic',  # Database migrations
     'marshmallow',  # Object serialization/deserialization    'PyJWT',  # JSON Web Token implementation
     'bcrypt',  # Password hashing
@@ -54,6 +55,16 @@ setup(
             'initialize_db = ecommerce_api.scripts.initialize_db:main',
             'import_products = ecommerce_api.scripts.import_products:main',
             'scrape_products = ecommerce_api.scripts.scrape_products:main',
+            'manage_partitions = ecommerce_api.scripts.manage_partitions:main',
+            'rebuild_user_stats = ecommerce_api.scripts.rebuild_user_stats:main',
+            'explain_queries = ecommerce_api.scripts.explain_queries:main',
+            'startup_report = ecommerce_api.scripts.startup_report:main',
+            'serve_prefork = ecommerce_api.scripts.serve_prefork:main',
+            'purge_idempotency_keys = ecommerce_api.scripts.purge_idempotency_keys:main',
+            'compact_product_changes = ecommerce_api.scripts.compact_product_changes:main',
+            'serve_order_events = ecommerce_api.scripts.serve_order_events:main',
+            'generate_dataset = ecommerce_api.scripts.generate_dataset:main',
+            'replay_traffic = ecommerce_api.scripts.replay_traffic:main',
         ],
     },
 )
\ No newline at end of file
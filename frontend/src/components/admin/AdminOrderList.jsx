@@ -226,7 +226,7 @@ const AdminOrderList = () => {
                     </span>
                   </td>
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-500">
-                    {order.items?.length || 0} item(s)
+                    {order.itemCount ?? order.items?.length ?? 0} item(s)
                   </td>
                   <td className="px-6 py-4 whitespace-nowrap text-right text-sm font-medium">
                     <div className="flex justify-end space-x-2">